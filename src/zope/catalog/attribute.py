@@ -15,12 +15,88 @@
 """
 __docformat__ = 'restructuredtext'
 
+import datetime
+import hashlib
+import operator
+
+import BTrees
 import zope.interface
+from BTrees.Length import Length
 
 from zope.catalog.interfaces import IAttributeIndex
+from zope.catalog.interfaces import IBulkInjection
+from zope.catalog.interfaces import IIndexGeneration
+
+
+# Types whose repr() tells their values apart.
+_FINGERPRINTED_TYPES = frozenset([
+    str, bytes, int, float, bool,
+    datetime.date, datetime.datetime, datetime.time, datetime.timedelta,
+])
+
+
+def _fingerprintable(value):
+    if type(value) in (tuple, list, set, frozenset):
+        return all(_fingerprintable(item) for item in value)
+    return type(value) in _FINGERPRINTED_TYPES
+
+
+def _fingerprint(value):
+    """Return a fingerprint of *value*, or ``None`` if it can't have
+    one."""
+    if not _fingerprintable(value):
+        return None
+    data = repr(value).encode('utf-8', 'surrogatepass')
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+# What AttributeIndex._value returns for objects that can't be adapted.
+_NOT_ADAPTED = object()
+
+# The fingerprint of values that don't need to be indexed again.
+_UNCHANGED = object()
+
+
+def _compileAccessor(field_name, field_callable):
+    # Return a function getting the field *field_name* of an object,
+    # or None, calling it if *field_callable* is true.
+    if not field_callable:
+        return lambda object: getattr(object, field_name, None)
 
+    def accessor(object):
+        value = getattr(object, field_name, None)
+        if value is not None:
+            # do not eat the exception raised below
+            value = value()
+        return value
+    return accessor
+
+
+class _Adaptations:
+    """An object to index, and what it was adapted to so far.
+
+    A catalog passes one to each of its attribute indexes instead of
+    the object when it indexes a document, so that the object is
+    adapted to the interface of several indexes only once.
+    """
+
+    __slots__ = ('object', '_adapted')
 
-@zope.interface.implementer(IAttributeIndex)
+    def __init__(self, object):
+        self.object = object
+        self._adapted = {}
+
+    def adapt(self, interface):
+        """Return the object adapted to *interface*, or ``None``."""
+        try:
+            return self._adapted[interface]
+        except KeyError:
+            adapted = self._adapted[interface] = interface(self.object, None)
+            return adapted
+
+
+@zope.interface.implementer(IAttributeIndex, IBulkInjection,
+                            IIndexGeneration)
 class AttributeIndex:
     """Index interface-defined attributes
 
@@ -135,6 +211,32 @@ class AttributeIndex:
          >>> index.data
          [(11, 9), (22, 4)]
 
+       Every change to the index increases its generation:
+
+         >>> index.generation()
+         2
+         >>> index.unindex_doc(11)
+         >>> index.generation()
+         3
+
+       If ``skip_unchanged`` is set, the index keeps a fingerprint of
+       the value of each document, and doesn't index a document again
+       if its value hasn't changed:
+
+         >>> index.skip_unchanged = True
+         >>> index.index_doc(11, Data(3))
+         >>> index.index_doc(11, Data(3))
+         >>> index.data
+         [(22, 4), (11, 9)]
+         >>> index.skipped()
+         1
+         >>> index.generation()
+         4
+
+       Only values of builtin types like strings, numbers, dates and
+       sequences of these get fingerprints; documents with other values
+       are always indexed.
+
        """
 
     #: Subclasses can set this to a string if they want to allow
@@ -146,6 +248,17 @@ class AttributeIndex:
     #: ``interface``.
     default_interface = None
 
+    #: If true, a fingerprint of the value of each document is kept,
+    #: and indexing a document whose value hasn't changed does
+    #: nothing.
+    skip_unchanged = False
+
+    # A BTrees.Length.Length counting the changes, see generation().
+    _generation = None
+
+    # Maps docids to the fingerprints of their values.
+    _fingerprints = None
+
     def __init__(self, field_name=None, interface=None, field_callable=False,
                  *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -171,20 +284,159 @@ class AttributeIndex:
         calls ``unindex_doc``. Otherwise, passes the *docid* and the value to
         the superclass's implementation of ``index_doc``.
         """
-        if self.interface is not None:
-            object = self.interface(object, None)
-            if object is None:
-                return None
-
-        value = getattr(object, self.field_name, None)
-
-        if value is not None and self.field_callable:
-            # do not eat the exception raised below
-            value = value()
+        value = self._value(object)
+        if value is _NOT_ADAPTED:
+            return None
+        return self._indexValue(docid, value)
 
+    def index_docs(self, documents, executor=None):
+        """
+        Indexes several documents at once.
+
+        The values of all the *documents*, ``(docid, object)`` pairs,
+        are derived first, like ``index_doc`` does. Then the documents
+        are indexed in the order `_indexingOrder` puts them in, so
+        that the data structures of the index are updated in key
+        order. Subclasses can do part of the work in the *executor*,
+        see `_indexValues`.
+
+        If a subclass overrides ``index_doc``, the documents are passed
+        to it one by one instead, so that they are indexed the same way
+        either way.
+        """
+        if type(self).index_doc is not AttributeIndex.index_doc:
+            for docid, object in documents:
+                self.index_doc(docid, object)
+            return
+        values = {}
+        for docid, object in documents:
+            value = self._value(object)
+            if value is not _NOT_ADAPTED:
+                values[docid] = value
+        self._indexValues(self._indexingOrder(values.items()), executor)
+
+    def _indexValues(self, values, executor):
+        """Index the ``(docid, value)`` pairs *values*.
+
+        The *executor* is a :class:`concurrent.futures.Executor` or
+        ``None``; it isn't used here.
+        """
+        for docid, value in values:
+            self._indexValue(docid, value)
+
+    def unindex_docs(self, docids):
+        """See :class:`zope.catalog.interfaces.IBulkInjection`"""
+        for docid in sorted(docids):
+            self.unindex_doc(docid)
+
+    def _indexingOrder(self, values):
+        """Return the ``(docid, value)`` pairs *values* in the order to
+        index them in; by default by docid."""
+        return sorted(values, key=operator.itemgetter(0))
+
+    def _value(self, object):
+        # The value to index for *object*, or _NOT_ADAPTED if it can't
+        # be adapted to the interface.
+        if type(object) is _Adaptations:
+            if self.interface is not None:
+                object = object.adapt(self.interface)
+            else:
+                object = object.object
+        elif self.interface is not None:
+            object = self.interface(object, None)
+        if object is None and self.interface is not None:
+            return _NOT_ADAPTED
+        return self._accessor()(object)
+
+    def _accessor(self):
+        # A function getting the field of an adapted object, compiled
+        # once for the field_name and field_callable of the index.
+        key = (self.field_name, self.field_callable)
+        compiled = getattr(self, '_v_accessor', None)
+        if compiled is None or compiled[0] != key:
+            compiled = self._v_accessor = (key, _compileAccessor(*key))
+        return compiled[1]
+
+    def _indexValue(self, docid, value):
         if value is None:
             # unindex the previous value!
+            self._changed()
+            self._setFingerprint(docid, None)
             super().unindex_doc(docid)
             return None
 
-        return super().index_doc(docid, value)
+        fingerprint = self._fingerprintIfChanged(docid, value)
+        if fingerprint is _UNCHANGED:
+            return None
+
+        self._changed()
+        result = super().index_doc(docid, value)
+        self._setFingerprint(docid, fingerprint)
+        return result
+
+    def _fingerprintIfChanged(self, docid, value):
+        # The fingerprint to keep for the new *value* of *docid*, or
+        # _UNCHANGED if indexing it can be skipped.
+        if not self.skip_unchanged:
+            return None
+        fingerprint = _fingerprint(value)
+        if (fingerprint is not None and
+                self._fingerprints is not None and
+                self._fingerprints.get(docid) == fingerprint):
+            self._v_skipped = self.skipped() + 1
+            return _UNCHANGED
+        return fingerprint
+
+    def unindex_doc(self, docid):
+        self._changed()
+        self._setFingerprint(docid, None)
+        return super().unindex_doc(docid)
+
+    def clear(self):
+        self._changed()
+        self._fingerprints = None
+        return super().clear()
+
+    def _emptyCopy(self, *args):
+        # A new, empty index configured like this one. The *args are
+        # passed to the constructor after the field and interface.
+        copy = type(self)(self.field_name, self.interface,
+                          self.field_callable, *args)
+        family = getattr(self, 'family', None)
+        if family is not getattr(copy, 'family', None):
+            copy.family = family
+            copy.clear()
+        if 'skip_unchanged' in vars(self):
+            copy.skip_unchanged = self.skip_unchanged
+        return copy
+
+    def _setFingerprint(self, docid, fingerprint):
+        fingerprints = self._fingerprints
+        if fingerprint is None:
+            if fingerprints is not None:
+                fingerprints.pop(docid, None)
+            return
+        if fingerprints is None:
+            family = getattr(self, 'family', BTrees.family32)
+            fingerprints = self._fingerprints = family.IO.BTree()
+        fingerprints[docid] = fingerprint
+
+    def skipped(self):
+        """Return how often indexing a document was skipped because its
+        value hadn't changed.
+
+        The count is kept in memory only, and starts over whenever the
+        index is loaded from the database.
+        """
+        return getattr(self, '_v_skipped', 0)
+
+    def _changed(self):
+        if self._generation is None:
+            self._generation = Length()
+        self._generation.change(1)
+
+    def generation(self):
+        """See :class:`zope.catalog.interfaces.IIndexGeneration`"""
+        if self._generation is None:
+            return 0
+        return self._generation()
@@ -0,0 +1,161 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Building BTrees from sorted data
+
+Inserting keys into a BTree one at a time leaves its buckets half
+full, because a bucket that overflows is split in two, and changes the
+same buckets over and over. :func:`buildTree` builds a BTree bottom-up
+from data that is sorted already, filling each bucket completely.
+:class:`ExternalSorter` sorts data that may not fit into memory.
+"""
+__docformat__ = 'restructuredtext'
+
+import heapq
+import itertools
+import pickle
+import tempfile
+
+
+def buildTree(tree_type, items):
+    """Return a new *tree_type* holding *items*.
+
+    *tree_type* is a BTree or TreeSet class, and *items* are the
+    ``(key, value)`` pairs or the keys to put into it. They must be
+    sorted by key, without duplicate keys.
+
+      >>> from BTrees.OOBTree import OOBTree
+      >>> from BTrees.check import check
+      >>> tree = buildTree(OOBTree, ((i, str(i)) for i in range(1000)))
+      >>> check(tree)
+      >>> len(tree), tree[999], tree.minKey(), tree.maxKey()
+      (1000, '999', 0, 999)
+    """
+    mapping = hasattr(tree_type, 'values')
+    bucket_type = tree_type._bucket_type
+    # (first key, node, first bucket) of the nodes of the level built
+    nodes = []
+    previous = None
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, tree_type.max_leaf_size))
+        if not chunk:
+            break
+        if mapping:
+            state = tuple(itertools.chain.from_iterable(chunk))
+            key = chunk[0][0]
+        else:
+            state = tuple(chunk)
+            key = chunk[0]
+        bucket = bucket_type()
+        # a bucket's state refers to the next bucket
+        if previous is not None:
+            previous[0].__setstate__((previous[1], bucket))
+        previous = bucket, state
+        nodes.append((key, bucket, bucket))
+    tree = tree_type()
+    if not nodes:
+        return tree
+    if len(nodes) == 1:
+        # the state of a single bucket is inlined
+        tree.__setstate__((((previous[1],),),))
+        return tree
+    previous[0].__setstate__((previous[1],))
+    while len(nodes) > tree_type.max_internal_size:
+        level = []
+        for start in range(0, len(nodes), tree_type.max_internal_size):
+            children = nodes[start:start + tree_type.max_internal_size]
+            node = tree_type()
+            node.__setstate__((_children(children), children[0][2]))
+            level.append((children[0][0], node, children[0][2]))
+        nodes = level
+    tree.__setstate__((_children(nodes), nodes[0][2]))
+    return tree
+
+
+def _children(nodes):
+    # The children and separating keys in the state of a BTree node.
+    children = [nodes[0][1]]
+    for key, node, first in nodes[1:]:
+        children.append(key)
+        children.append(node)
+    return tuple(children)
+
+
+class ExternalSorter:
+    """Sort items that may not fit into memory.
+
+    Items are collected in runs of *run_size* items. Full runs are
+    sorted and written to temporary files, which are merged when the
+    sorted items are asked for. Items must be picklable.
+
+      >>> sorter = ExternalSorter(run_size=3)
+      >>> for item in [5, 3, 8, 1, 9, 2, 7]:
+      ...     sorter.add(item)
+      >>> len(sorter)
+      7
+      >>> list(sorter.sorted())
+      [1, 2, 3, 5, 7, 8, 9]
+    """
+
+    #: How many items are pickled together.
+    block_size = 1000
+
+    def __init__(self, run_size=100000):
+        self.run_size = run_size
+        self._run = []
+        self._files = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, item):
+        """Add *item*."""
+        self._run.append(item)
+        self._count += 1
+        if len(self._run) >= self.run_size:
+            self._spill()
+
+    def _spill(self):
+        self._run.sort()
+        file = tempfile.TemporaryFile()
+        for start in range(0, len(self._run), self.block_size):
+            pickle.dump(self._run[start:start + self.block_size], file,
+                        pickle.HIGHEST_PROTOCOL)
+        self._files.append(file)
+        self._run = []
+
+    def sorted(self):
+        """Return an iterator over the items added, in sorted order.
+
+        This can only be called once.
+        """
+        self._run.sort()
+        runs = [_read(file) for file in self._files]
+        runs.append(iter(self._run))
+        return heapq.merge(*runs)
+
+
+def _read(file):
+    # The items pickled into *file*; closes it when they are exhausted.
+    try:
+        file.seek(0)
+        while True:
+            try:
+                block = pickle.load(file)
+            except EOFError:
+                return
+            yield from block
+    finally:
+        file.close()
@@ -0,0 +1,58 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Search result caching
+"""
+__docformat__ = 'restructuredtext'
+
+import collections
+
+
+#: Returned by :meth:`ResultCache.get` for queries that are not cached.
+MISS = object()
+
+
+class ResultCache:
+    """A bounded cache of search results.
+
+    Every result is stored with a stamp of the state of the indexes it
+    was computed from and is only returned as long as the stamp
+    doesn't change. When the cache is full, the least recently used
+    result is dropped.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key, stamp):
+        """Return the result cached for *key* and *stamp* or `MISS`."""
+        entry = self._results.get(key)
+        if entry is None or entry[0] != stamp:
+            self.misses += 1
+            return MISS
+        self._results.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, stamp, result):
+        """Cache *result* for *key* and *stamp*."""
+        self._results[key] = (stamp, result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
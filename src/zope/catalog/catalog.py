@@ -13,8 +13,18 @@
 ##############################################################################
 """Catalog
 """
+import collections
+import functools
+import heapq
+import itertools
+import operator
+import time
+
 import BTrees
 import zope.index.interfaces
+from BTrees.Length import Length
+from persistent import Persistent
+from persistent.mapping import PersistentMapping
 from zope.annotation.interfaces import IAttributeAnnotatable
 from zope.container.btree import BTreeContainer
 from zope.interface import implementer
@@ -22,144 +32,1162 @@ from zope.intid.interfaces import IIntIdAddedEvent
 from zope.intid.interfaces import IIntIdRemovedEvent
 from zope.intid.interfaces import IIntIds
 from zope.lifecycleevent import IObjectModifiedEvent
+from zope.lifecycleevent.interfaces import IAttributes
 from zope.lifecycleevent.interfaces import IObjectAddedEvent
-from zope.location import location
 from zope.location.interfaces import ILocationInfo
 
 from zope import component
+from zope.catalog import deferred
+from zope.catalog import pending
+from zope.catalog.attribute import AttributeIndex
+from zope.catalog.attribute import _Adaptations
+from zope.catalog.cache import MISS
+from zope.catalog.cache import ResultCache
+from zope.catalog.interfaces import IAttributeIndex
+from zope.catalog.interfaces import IBulkInjection
 from zope.catalog.interfaces import ICatalog
 from zope.catalog.interfaces import ICatalogIndex
+from zope.catalog.interfaces import IIndexBuild
+from zope.catalog.interfaces import IIndexFacets
+from zope.catalog.interfaces import IIndexGeneration
+from zope.catalog.interfaces import IIndexValue
 from zope.catalog.interfaces import INoAutoIndex
 from zope.catalog.interfaces import INoAutoReindex
+from zope.catalog.query import And
+from zope.catalog.query import Query
+from zope.catalog.query import SearchContext
+from zope.catalog.query import Term
+from zope.catalog.query import queryKey
+
+
+# Stands in for the value of documents missing from a sort index.
+_MISSING = object()
+
+
+class _SortKey:
+    """Orders documents by several sort values.
+
+    *reverse* holds a flag for each value. Missing values sort last,
+    whatever the direction.
+    """
+
+    __slots__ = ('values', 'reverse')
+
+    def __init__(self, values, reverse):
+        self.values = values
+        self.reverse = reverse
+
+    def __lt__(self, other):
+        for a, b, reverse in zip(self.values, other.values, self.reverse):
+            if a is b or a == b:
+                continue
+            if a is _MISSING:
+                return False
+            if b is _MISSING:
+                return True
+            return b < a if reverse else a < b
+        return False
+
+
+def _prefetch(objects):
+    """Prefetch the state of the ghosts among *objects*.
+
+    Does nothing for objects whose connection can't prefetch.
+    """
+    ghosts = collections.defaultdict(list)
+    for obj in objects:
+        jar = getattr(obj, '_p_jar', None)
+        if jar is not None and getattr(obj, '_p_changed', False) is None:
+            ghosts[jar].append(obj)
+    for jar, objs in ghosts.items():
+        prefetch = getattr(jar, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(objs)
+
+
+def _lookupCache(sm):
+    """Return a mapping to cache lookups in the site manager *sm*.
+
+    The mapping is emptied whenever a component is registered or
+    unregistered in *sm* or one of its bases, which changes the
+    generation of the utility registry concerned. The generations of
+    all the registries in the resolution order are compared, since a
+    base changed by another transaction or process doesn't notify its
+    subregistries. Returns ``None`` if the site manager can't tell.
+    """
+    utilities = getattr(sm, 'utilities', None)
+    registries = tuple(getattr(utilities, 'ro', ()))
+    generations = tuple(getattr(registry, '_generation', None)
+                        for registry in registries)
+    if not generations or None in generations:
+        return None
+    cache = getattr(sm, '_v_zope_catalog_lookups', None)
+    if (cache is None or len(cache[0]) != len(registries)
+            or any(a is not b for a, b in zip(cache[0], registries))
+            or cache[1] != generations):
+        cache = (registries, generations, {})
+        try:
+            sm._v_zope_catalog_lookups = cache
+        except AttributeError:
+            return None
+    return cache[2]
+
+
+def _localIntIds(sm):
+    """Return the int-id utility registered in the site manager *sm*
+    itself, or ``None`` if there is none."""
+    cache = _lookupCache(sm)
+    if cache is not None and 'local-intids' in cache:
+        return cache['local-intids']
+    uidutil = sm.queryUtility(IIntIds)
+    if uidutil not in [c.component for c in sm.registeredUtilities()]:
+        uidutil = None
+    if cache is not None:
+        cache['local-intids'] = uidutil
+    return uidutil
+
+
+class _Inside:
+    """Tells whether objects are located inside a site, like
+    :func:`zope.location.location.inside`.
+
+    Whether the parents met on the way are inside is remembered, so
+    the chain of parents of an object is only followed up to the
+    first parent seen before.
+    """
+
+    def __init__(self, site):
+        self.site = site
+        # id(parent) -> (parent, inside); keeping the parent makes
+        # sure the id isn't reused
+        self._parents = {}
+
+    def __call__(self, obj):
+        parents = self._parents
+        chain = []
+        while True:
+            if obj is None:
+                inside = False
+                break
+            if obj is self.site:
+                inside = True
+                break
+            known = parents.get(id(obj))
+            if known is not None:
+                inside = known[1]
+                break
+            chain.append(obj)
+            obj = getattr(obj, '__parent__', None)
+        # the object itself isn't remembered, only its parents
+        for parent in chain[1:]:
+            parents[id(parent)] = (parent, inside)
+        return inside
+
+
+def _affects(attributes, index):
+    # Whether modifying *attributes*, a sequence of (interface, names)
+    # pairs, can change what *index* indexes for a document.
+    if not IAttributeIndex.providedBy(index) or index.field_callable:
+        return True
+    for interface, names in attributes:
+        if index.field_name not in names:
+            continue
+        if (interface is None or index.interface is None
+                or interface.isOrExtends(index.interface)
+                or index.interface.isOrExtends(interface)):
+            return True
+    return False
+
+
+def _batches(iterable, size):
+    # Lists of up to *size* items of *iterable*.
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _uidsAfter(uidutil, after, chunk_size):
+    # The ids of *uidutil* that are greater than *after*. The ids of
+    # int-id utilities keeping them in a BTree are read in chunks of
+    # *chunk_size*, each from a key range opened anew, so that no
+    # iterator is kept open across commits and ids up to *after*
+    # aren't visited. Other utilities are iterated over.
+    refs = getattr(uidutil, 'refs', None)
+    if refs is None or not hasattr(refs, 'minKey'):
+        if after is None:
+            return uidutil
+        return (uid for uid in uidutil if uid > after)
+    return _keysAfter(refs, after, chunk_size)
+
+
+def _keysAfter(tree, after, chunk_size):
+    while True:
+        if after is None:
+            keys = tree.keys()
+        else:
+            keys = tree.keys(min=after, excludemin=True)
+        chunk = list(itertools.islice(keys, chunk_size))
+        if not chunk:
+            return
+        yield from chunk
+        after = chunk[-1]
+
+
+@functools.lru_cache(maxsize=None)
+def _sharesAdaptations(cls):
+    # Whether indexes of class *cls* derive the values of documents
+    # the way AttributeIndex does, so that they can be passed
+    # _Adaptations instead of the objects to index.
+    return (issubclass(cls, AttributeIndex)
+            and all(getattr(cls, name) is getattr(AttributeIndex, name)
+                    for name in ('index_doc', 'index_docs', '_value')))
+
+
+def _counterStamp(counter):
+    # What identifies the state counted by the BTrees.Length *counter*
+    # for the result cache: the id of the transaction that committed
+    # it, or None while it has changes that aren't committed. Numbers
+    # of changes that were aborted can later count other changes.
+    # Counters that aren't stored in a database are identified by
+    # their value.
+    if counter is None:
+        return 0
+    if counter._p_jar is None:
+        return counter()
+    counter._p_activate()
+    if counter._p_changed:
+        return None
+    return counter._p_serial
+
+
+def _overridesIndexDoc(index):
+    # Whether *index* is an attribute index whose class changes how
+    # documents are indexed, which building it would bypass.
+    return (isinstance(index, AttributeIndex)
+            and type(index).index_doc is not AttributeIndex.index_doc)
+
+
+def _documentsFor(index, documents, adapted):
+    # *adapted* if *index* shares adaptations, else *documents*.
+    return adapted if _sharesAdaptations(type(index)) else documents
+
+
+def _indexDocs(index, documents, executor=None):
+    # Indexes (docid, object) pairs in one go if the index can.
+    if IBulkInjection.providedBy(index):
+        index.index_docs(documents, executor)
+    else:
+        for docid, ob in documents:
+            index.index_doc(docid, ob)
+
+
+def _intIds(context=None):
+    """Return the int-id utility for *context*."""
+    sm = component.getSiteManager(context)
+    cache = _lookupCache(sm)
+    if cache is None:
+        return sm.getUtility(IIntIds)
+    intids = cache.get('intids')
+    if intids is None:
+        intids = cache['intids'] = sm.getUtility(IIntIds)
+    return intids
+
+
+def _catalogs(context):
+    """Return ``(catalog, intids)`` pairs for the catalogs of *context*.
+
+    *intids* is the int-id utility of the catalog.
+    """
+    sm = component.getSiteManager(context)
+    cache = _lookupCache(sm)
+    catalogs = None if cache is None else cache.get('catalogs')
+    if catalogs is None:
+        catalogs = tuple(
+            (cat, _intIds(cat))
+            for cat in sm.getAllUtilitiesRegisteredFor(ICatalog))
+        if cache is not None:
+            cache['catalogs'] = catalogs
+    return catalogs
 
 
 class ResultSet:
-    """Lazily accessed set of objects."""
+    """Lazily accessed set of objects.
+
+    Objects are resolved in batches of `batch_size`. Before the first
+    object of a batch is returned, the state of the persistent objects
+    in it that aren't loaded yet is prefetched, so that storages that
+    support it can load them in one round trip.
+
+    Result sets can be indexed and sliced like sequences; only the
+    objects asked for are resolved. The last `cache_size` objects
+    resolved are kept, so that accessing them again doesn't resolve
+    them again.
+
+    If *explanation* is given, it is the mapping returned by
+    :meth:`Catalog.explain`; the number of objects resolved and the
+    time it took are added to it as ``resolved`` and
+    ``resolve_time``.
+    """
+
+    #: The number of objects resolved at once. This can be changed on
+    #: a result set before iterating it.
+    batch_size = 100
+
+    #: The number of resolved objects kept.
+    cache_size = 100
 
-    def __init__(self, uids, uidutil):
+    # The uids as a sequence supporting indexing, once needed.
+    _sequence = None
+
+    def __init__(self, uids, uidutil, explanation=None):
         self.uids = uids
         self.uidutil = uidutil
+        self.explanation = explanation
+        self._resolved = collections.OrderedDict()
 
     def __len__(self):
         return len(self.uids)
 
     def __iter__(self):
-        for uid in self.uids:
-            obj = self.uidutil.getObject(uid)
-            yield obj
+        uids = iter(self.uids)
+        while True:
+            batch = list(itertools.islice(uids, self.batch_size))
+            if not batch:
+                break
+            yield from self._resolve(batch)
+
+    def __getitem__(self, index):
+        uids = self._uidSequence()
+        if isinstance(index, slice):
+            return self._resolve(
+                [uids[i] for i in range(*index.indices(len(uids)))])
+        return self._resolve([uids[operator.index(index)]])[0]
+
+    def _uidSequence(self):
+        # Returns the uids as a sequence supporting indexing, copying
+        # them at most once.
+        sequence = self._sequence
+        if sequence is None:
+            sequence = self._sequence = self._asSequence()
+        return sequence
+
+    def _asSequence(self):
+        uids = self.uids
+        if isinstance(uids, (list, tuple)):
+            return uids
+        if isinstance(uids, (BTrees.family32.IF.Set,
+                             BTrees.family64.IF.Set)):
+            # sets can be indexed, but their keys() are a copy
+            return uids
+        keys = getattr(uids, 'keys', None)
+        if keys is not None:
+            # keys() of BTrees are lazy, those of buckets a copy
+            return keys()
+        self.uids = uids = list(uids)
+        return uids
+
+    def _resolve(self, uids):
+        # Returns the objects of uids, prefetching ghosts.
+        start = time.perf_counter()
+        resolved = self._resolved
+        getObject = self.uidutil.getObject
+        objects = []
+        for uid in uids:
+            obj = resolved.pop(uid, None)
+            if obj is None:
+                obj = getObject(uid)
+            # (re)insert as the most recently used object
+            resolved[uid] = obj
+            objects.append(obj)
+        while len(resolved) > self.cache_size:
+            resolved.popitem(last=False)
+        _prefetch(objects)
+        explanation = self.explanation
+        if explanation is not None:
+            explanation['resolve_time'] = (
+                explanation.get('resolve_time', 0.0) +
+                time.perf_counter() - start)
+            explanation['resolved'] = (
+                explanation.get('resolved', 0) + len(objects))
+        return objects
+
+
+def _searching(method):
+    # Makes a search method see the operations queued for the catalog
+    # unless stale searches are acceptable.
+    @functools.wraps(method)
+    def search(self, *args, **kw):
+        with pending.applied(self) as rolled_back:
+            results = method(self, *args, **kw)
+            if rolled_back:
+                results = _copied(results)
+            return results
+    return search
+
+
+def _copied(results):
+    # Copies the sets of docids in search results, which may be the
+    # persistent sets of the indexes or the catalog.
+    if isinstance(results, list):
+        return [_copied(result) for result in results]
+    if isinstance(results, ResultSet):
+        results.uids = _copied(results.uids)
+    elif isinstance(results, Persistent):
+        results = type(results)(results)
+    return results
 
 
 @implementer(ICatalog,
              IAttributeAnnotatable,
+             IBulkInjection,
              zope.index.interfaces.IIndexSearch,
              )
 class Catalog(BTreeContainer):
 
     family = BTrees.family32
 
+    #: If true, the event subscribers queue the indexing of documents
+    #: until the transaction commits, see :mod:`zope.catalog.deferred`.
+    defer_indexing = False
+
+    #: A :class:`zope.catalog.pending.Queue` the event subscribers
+    #: append the indexing of documents to, for a worker to do it
+    #: later, see :mod:`zope.catalog.pending`. ``None`` to index right
+    #: away.
+    indexing_queue = None
+
+    #: The number of search results ``searchResults`` caches. Results
+    #: are only cached if all indexes involved provide
+    #: :class:`zope.catalog.interfaces.IIndexGeneration`.
+    cache_size = 0
+
+    # The set of all documents in the catalog. Catalogs created before
+    # it was introduced get one from updateIndexes().
+    _extent = None
+
+    # A BTrees.Length.Length counting the changes to the extent.
+    _extent_generation = None
+
+    #: How many documents updateIndexes() and updateIndex() pass to
+    #: the indexes at once.
+    index_batch_size = 1000
+
+    #: The default number of documents updateIndexes() and
+    #: updateIndex() index between transaction savepoints; ``None``
+    #: indexes everything without savepoints.
+    update_chunk_size = None
+
+    # A persistent mapping of the last document ids indexed by
+    # interrupted updates, keyed by index name, or None for
+    # updateIndexes(). Kept apart from the catalog, like _rebuilds,
+    # which writers read as current.
+    _update_checkpoints = None
+
+    # A persistent mapping of the names of the indexes being rebuilt
+    # by rebuildIndex() to the new index and the set of the documents
+    # changed since the rebuild started.
+    _rebuilds = None
+
     def __init__(self, family=None):
         super().__init__()
         if family is not None:
             self.family = family
+        self._extent = self.family.IF.TreeSet()
+        self._extent_generation = Length()
+        self._update_checkpoints = PersistentMapping()
+        self._rebuilds = PersistentMapping()
 
     def clear(self):
         for index in self.values():
             index.clear()
+        if self._extent is not None:
+            self._extent.clear()
+            self._extentChanged()
 
     def index_doc(self, docid, texts):
         """Register the data in indexes of this catalog."""
+        if self._extent is not None and self._extent.insert(docid):
+            self._extentChanged()
+        self._logChanges((docid,))
+        self._indexDoc(self.values(), docid, texts)
+
+    def reindex_doc(self, docid, texts, descriptions=()):
+        """Update the data of an indexed document in the indexes
+        affected by its modifications.
+
+        *descriptions* are the descriptions of an
+        ``IObjectModifiedEvent``. Attribute indexes are only updated
+        when a description names their field, either without an
+        interface or with one related to the interface of the index.
+        Other indexes and attribute indexes of callable fields are
+        always updated. Without descriptions, or if any of them
+        doesn't describe attributes, all indexes are updated.
+        """
+        indexes = self._affectedIndexes(descriptions)
+        if indexes is None or (self._extent is not None
+                               and docid not in self._extent):
+            self.index_doc(docid, texts)
+            return
+        self._logChanges((docid,))
+        self._indexDoc(indexes, docid, texts)
+
+    def _indexDoc(self, indexes, docid, texts):
+        # Attribute indexes share the objects *texts* is adapted to.
+        adapted = _Adaptations(texts)
+        for index in indexes:
+            index.index_doc(docid, _documentsFor(index, texts, adapted))
+
+    def _affectedIndexes(self, descriptions):
+        # The indexes modifications described by *descriptions* can
+        # change, None if that isn't known.
+        if not descriptions:
+            return None
+        attributes = []
+        for description in descriptions:
+            if not IAttributes.providedBy(description):
+                return None
+            attributes.append((description.interface,
+                               description.attributes))
+        return [index for index in self.values()
+                if _affects(attributes, index)]
+
+    def index_docs(self, documents, executor=None):
+        """Register the data of several documents in the indexes of
+        this catalog.
+
+        *documents* is an iterable of ``(docid, object)`` pairs.
+        Indexes providing ``IBulkInjection`` get all of them at once,
+        along with the *executor*. Each object is adapted to the
+        interface of several attribute indexes only once.
+        """
+        documents = list(documents)
+        if (self._extent is not None
+                and self._extent.update(docid for docid, _ in documents)):
+            self._extentChanged()
+        self._logChanges(docid for docid, _ in documents)
+        adapted = [(docid, _Adaptations(ob)) for docid, ob in documents]
         for index in self.values():
-            index.index_doc(docid, texts)
+            _indexDocs(index, _documentsFor(index, documents, adapted),
+                       executor)
+
+    def unindex_docs(self, docids):
+        """Unregister the data of the documents with the ids in
+        *docids* from the indexes of this catalog."""
+        docids = list(docids)
+        extent = self._extent
+        if extent is not None:
+            removed = [docid for docid in docids if docid in extent]
+            for docid in removed:
+                extent.remove(docid)
+            if removed:
+                self._extentChanged()
+        self._logChanges(docids)
+        for index in self.values():
+            if IBulkInjection.providedBy(index):
+                index.unindex_docs(docids)
+            else:
+                for docid in docids:
+                    index.unindex_doc(docid)
 
     def unindex_doc(self, docid):
         """Unregister the data from indexes of this catalog."""
+        if self._extent is not None and docid in self._extent:
+            self._extent.remove(docid)
+            self._extentChanged()
+        self._logChanges((docid,))
         for index in self.values():
             index.unindex_doc(docid)
 
-    def _visitSublocations(self):
+    def _logChanges(self, docids):
+        # Records the documents changed while indexes are rebuilt.
+        # Transactions changing documents read the rebuilds as current,
+        # so that they conflict with the transactions that start and
+        # end rebuilds, which change them, and are retried. Catalogs
+        # created before the rebuilds were kept apart read the catalog
+        # itself.
+        rebuilds = self._rebuilds
+        state = rebuilds if isinstance(rebuilds, PersistentMapping) else self
+        if state._p_jar is not None:
+            # a ghost may still have the serial of an older state
+            state._p_activate()
+            state._p_jar.readCurrent(state)
+        if rebuilds:
+            docids = list(docids)
+            for index, log in rebuilds.values():
+                log.update(docids)
+
+    def _extentChanged(self):
+        if self._extent_generation is None:
+            self._extent_generation = Length()
+        self._extent_generation.change(1)
+
+    def _visitSublocations(self, after=None):
         """Restricts the access to the objects that live within
         the nearest site if the catalog itself is locatable.
+
+        If *after* is given, documents with ids up to it are skipped.
         """
         uidutil = None
         locatable = ILocationInfo(self, None)
         if locatable is not None:
             site = locatable.getNearestSite()
-            sm = site.getSiteManager()
-            uidutil = sm.queryUtility(IIntIds)
-            if uidutil not in [c.component for c in sm.registeredUtilities()]:
+            uidutil = _localIntIds(site.getSiteManager())
+            if uidutil is None:
                 # we do not have a local inits utility
                 uidutil = component.getUtility(IIntIds, context=self)
-                for uid in uidutil:
-                    obj = uidutil.getObject(uid)
-                    if location.inside(obj, site):
-                        yield uid, obj
+                inside = _Inside(site)
+                for uids in _batches(
+                        _uidsAfter(uidutil, after, self.index_batch_size),
+                        self.index_batch_size):
+                    objects = [uidutil.getObject(uid) for uid in uids]
+                    _prefetch(objects)
+                    for uid, obj in zip(uids, objects):
+                        if inside(obj):
+                            yield uid, obj
                 return
         if uidutil is None:
             uidutil = component.getUtility(IIntIds)
-        for uid in uidutil:
+        for uid in _uidsAfter(uidutil, after, self.index_batch_size):
             yield uid, uidutil.getObject(uid)
 
-    def updateIndex(self, index):
-        for uid, obj in self._visitSublocations():
-            index.index_doc(uid, obj)
+    def updateIndex(self, index, chunk_size=None, commit=False,
+                    progress=None, pause=0, resume=False, executor=None):
+        """Index all objects in *index*.
+
+        Takes the same arguments as `updateIndexes`; the checkpoint is
+        kept per index. Empty indexes providing ``IIndexBuild`` are
+        built in one go instead, unless indexing in chunks or resuming
+        is asked for, or the class of the index overrides
+        ``index_doc``. Building a field index with more than its
+        ``build_run_size`` documents needs their values to be
+        picklable.
+        """
+        if (IIndexBuild.providedBy(index) and not index.documentCount()
+                and not (chunk_size or self.update_chunk_size or resume)
+                and not _overridesIndexDoc(index)):
+            began = time.perf_counter()
+            index.build(self._visitSublocations())
+            if progress is not None:
+                elapsed = time.perf_counter() - began
+                count = index.documentCount()
+                progress(count, count / elapsed if elapsed else 0.0)
+            return
+        self._updateInChunks(
+            index.__name__,
+            functools.partial(_indexDocs, index, executor=executor),
+            chunk_size, commit, progress, pause, resume)
+
+    def updateIndexes(self, chunk_size=None, commit=False,
+                      progress=None, pause=0, resume=False, executor=None):
+        """Index all objects in all indexes.
+
+        The objects are indexed in chunks of *chunk_size* documents,
+        which defaults to ``update_chunk_size``. After each chunk, a
+        transaction savepoint is taken, or the transaction is
+        committed if *commit* is true, so that the changes don't have
+        to be kept in memory. The id of the last document of the chunk
+        is recorded as a checkpoint; with *resume* true, indexing
+        starts after the checkpoint a previous, interrupted call left.
+        This needs the int-id utility to iterate over the ids in
+        ascending order, as the one of ``zope.intid`` does.
+
+        After each chunk, *progress*, if given, is called with the
+        number of documents indexed so far and the number indexed per
+        second, and the update pauses for *pause* seconds to leave
+        room for other work.
+
+        Indexes can do part of their work in the *executor*, a
+        :class:`concurrent.futures.Executor`. A
+        :class:`~concurrent.futures.ProcessPoolExecutor` lets text
+        indexes split texts on several cores, for example.
+        """
+        if self._extent is None:
+            self._extent = self.family.IF.TreeSet()
+        self._updateInChunks(
+            None, functools.partial(self.index_docs, executor=executor),
+            chunk_size, commit, progress, pause, resume)
+
+    def _updateInChunks(self, key, index_docs, chunk_size, commit,
+                        progress, pause, resume):
+        if chunk_size is None:
+            chunk_size = self.update_chunk_size
+        checkpoints = self._update_checkpoints or {}
+        after = checkpoints.get(key) if resume else None
+        began = time.perf_counter()
+        indexed = 0
+        for documents in _batches(self._visitSublocations(after),
+                                  chunk_size or self.index_batch_size):
+            index_docs(documents)
+            indexed += len(documents)
+            if chunk_size:
+                self._setCheckpoint(key, documents[-1][0])
+                if commit:
+                    deferred._transactionManager(self).commit()
+                else:
+                    deferred._transactionManager(self).savepoint(
+                        optimistic=True)
+            if progress is not None:
+                elapsed = time.perf_counter() - began
+                progress(indexed, indexed / elapsed if elapsed else 0.0)
+            if pause:
+                time.sleep(pause)
+        self._setCheckpoint(key, None)
 
-    def updateIndexes(self):
-        for uid, obj in self._visitSublocations():
-            for index in self.values():
-                index.index_doc(uid, obj)
+    def rebuildIndex(self, name, index=None, chunk_size=None, commit=False,
+                     progress=None, pause=0):
+        """Rebuild the index *name* off to the side and swap it in.
 
+        A new index is filled like `updateIndex` does, which takes the
+        same arguments, while searches keep using the old index. The
+        new index is *index*, or by default a new, empty index of the
+        class of the old one, with the same field, interface and
+        settings. Text indexes get a new lexicon with the same
+        pipeline. Indexes that aren't attribute indexes, or whose
+        class takes other constructor arguments, have to be passed. The
+        documents indexed or unindexed in the meantime are recorded in
+        a change log and updated in the new index again. Then the new
+        index replaces the old one under the same name, without
+        firing events.
+
+        With *commit*, the new index is filled and the change log is
+        replayed in transactions of their own, and the new index is
+        swapped in by a short transaction at the end. Transactions
+        indexing documents conflict with the transactions starting
+        the rebuild and swapping the new index in, and have to be
+        retried, but not with those committing chunks of the update.
+        Calling this again for an index whose rebuild was interrupted
+        starts over.
+        """
+        old = self[name]
+        if index is None:
+            if not isinstance(old, AttributeIndex):
+                raise ValueError(
+                    "Pass the new index to rebuild an index that isn't"
+                    " an attribute index")
+            index = old._emptyCopy()
+        index.__parent__ = self
+        index.__name__ = name
+        log = self.family.IF.TreeSet()
+        self._mapping('_rebuilds')[name] = (index, log)
+        self._commit(commit)
+        self.updateIndex(index, chunk_size=chunk_size, commit=commit,
+                         progress=progress, pause=pause)
+        while self._replay(index, log):
+            self._commit(commit)
+        self._SampleContainer__data[name] = index
+        del self._rebuilds[name]
+        old.__parent__ = None
+        if commit:
+            self._commit(commit)
+            # documents changed by transactions that committed after
+            # the last replay, but before the index was swapped in
+            if self._replay(index, log):
+                self._commit(commit)
+
+    def _replay(self, index, log):
+        # Updates the documents in the change log in *index*. Returns
+        # whether there were any.
+        docids = list(log)
+        if not docids:
+            return False
+        for docid in docids:
+            log.remove(docid)
+        uidutil = component.getUtility(IIntIds, context=self)
+        for docid in docids:
+            ob = uidutil.queryObject(docid)
+            if ob is None or (self._extent is not None
+                              and docid not in self._extent):
+                index.unindex_doc(docid)
+            else:
+                index.index_doc(docid, ob)
+        return True
+
+    def _commit(self, commit):
+        if commit:
+            deferred._transactionManager(self).commit()
+
+    def _setCheckpoint(self, key, uid):
+        if uid is None:
+            if key in (self._update_checkpoints or {}):
+                del self._mapping('_update_checkpoints')[key]
+        else:
+            self._mapping('_update_checkpoints')[key] = uid
+
+    def _mapping(self, name):
+        # Returns the persistent mapping in the attribute *name*,
+        # converting what catalogs created before kept there.
+        mapping = getattr(self, name)
+        if not isinstance(mapping, PersistentMapping):
+            mapping = PersistentMapping(mapping or {})
+            setattr(self, name, mapping)
+        return mapping
+
+    @_searching
     def apply(self, query):
-        results = []
-        for index_name, index_query in query.items():
-            index = self[index_name]
-            r = index.apply(index_query)
-            if r is None:
-                continue
-            if not r:
-                # empty results
-                return r
-            results.append((len(r), r))
+        """Return the documents matching *query*.
 
-        if not results:
-            # no applicable indexes, so catalog was not applicable
-            return None
+        *query* is either a mapping of index names to the queries for
+        these indexes, all of which must match, or a
+        :class:`zope.catalog.query.Query`.
+        """
+        return self._apply(query, self._searchContext())
 
-        results.sort(key=lambda x: x[0])  # order from smallest to largest
+    def _searchContext(self, **kw):
+        return SearchContext(self, **kw)
 
-        _, result = results.pop(0)
-        for _, r in results:
-            _, result = self.family.IF.weightedIntersection(result, r)
+    def _apply(self, query, context):
+        return self._asQuery(query).apply(context)
 
-        return result
+    def _asQuery(self, query):
+        if not isinstance(query, Query):
+            query = And(*[Term(index_name, index_query)
+                          for index_name, index_query in query.items()])
+        return query
 
-    def searchResults(self, **searchterms):
+    @_searching
+    def count(self, **searchterms):
+        """Return the number of documents matching the search terms.
+
+        Takes the same search terms as ``searchResults``, but sorting,
+        limiting and explaining are ignored. Returns ``None`` if none of the
+        indexes apply. No objects are looked up, scores aren't
+        computed and the result of the last intersection is counted
+        without building it, if that's cheaper.
+        """
+        query = self._parseSearchTerms(searchterms)[0]
+        return self._asQuery(query).count(self._searchContext(scored=False))
+
+    @_searching
+    def exists(self, **searchterms):
+        """Return whether any document matches the search terms.
+
+        Like `count`, but stops at the first document the results of
+        the last two indexes applied have in common.
+        """
+        query = self._parseSearchTerms(searchterms)[0]
+        return self._asQuery(query).exists(self._searchContext(scored=False))
+
+    def _parseSearchTerms(self, searchterms):
+        searchterms = dict(searchterms)
         sort_index = searchterms.pop('_sort_index', None)
+        if sort_index is not None and not isinstance(sort_index, str):
+            sort_keys = []
+            for sort_key in sort_index:
+                if not (isinstance(sort_key, (tuple, list)) and
+                        len(sort_key) == 2):
+                    raise ValueError(
+                        '_sort_index must be an index name or a sequence'
+                        ' of (index_name, reverse) pairs, not %r'
+                        % (sort_index,))
+                index_name, key_reverse = sort_key
+                sort_keys.append((index_name, bool(key_reverse)))
+            sort_index = tuple(sort_keys)
+        start = searchterms.pop('_start', 0)
         limit = searchterms.pop('_limit', None)
         reverse = searchterms.pop('_reverse', False)
-        results = self.apply(searchterms)
+        query = searchterms.pop('_query', None)
+        # only searchResults explains searches
+        searchterms.pop('_explain', None)
+        if query is None:
+            query = searchterms
+        elif searchterms:
+            query = And(query, *[Term(index_name, index_query)
+                                 for index_name, index_query
+                                 in searchterms.items()])
+        return query, sort_index, start, limit, reverse
+
+    @_searching
+    def searchResults(self, **searchterms):
+        explain = searchterms.pop('_explain', False)
+        search = self._parseSearchTerms(searchterms)
+        if explain:
+            results, explanation = self._explainedSearch(*search)
+        else:
+            results = self._cachedSearch(self._searchContext(), *search)
+            explanation = None
+        if results is not None:
+            results = ResultSet(results, _intIds(), explanation)
+        return results
+
+    @_searching
+    def explain(self, **searchterms):
+        """Search like ``searchResults`` and describe how it was done.
+
+        Returns a mapping with the ``query`` that was evaluated and a
+        list of the ``steps`` taken to evaluate it, in order. Each step
+        is a mapping with a ``step`` key, and, depending on the step,
+        these keys:
+
+        ``estimate``
+            ``index``, ``query`` and the ``estimate`` of the number of
+            matching documents (``None`` if the index can't estimate).
+        ``apply``
+            ``index``, ``query``, the number of ``candidates`` the
+            index was restricted to (``None`` if it wasn't), whether
+            the result was ``shared`` with other queries of a batch,
+            the ``size`` of the result and the ``time`` it took.
+        ``intersection``, ``union``, ``difference``
+            The ``sizes`` of the operands, the ``size`` of the result
+            and the ``time`` it took.
+
+        The mapping also holds the time it took to apply the query
+        (``apply_time``) and to sort and limit the results
+        (``sort_time``), as well as the ``size`` of the result, which
+        is ``None`` if the query wasn't applicable. Search result
+        caching is bypassed.
+
+        Passing ``_explain=True`` to ``searchResults`` makes the result
+        set provide this mapping as its ``explanation`` attribute.
+        """
+        return self._explainedSearch(*self._parseSearchTerms(searchterms))[1]
+
+    def _explainedSearch(self, query, sort_index, start, limit, reverse):
+        explanation = {'query': query, 'steps': []}
+        context = self._searchContext(explanation=explanation['steps'])
+        began = time.perf_counter()
+        results = self._apply(query, context)
+        explanation['apply_time'] = time.perf_counter() - began
+        began = time.perf_counter()
+        results = self._sortAndLimit(
+            results, sort_index, start, limit, reverse)
+        explanation['sort_time'] = time.perf_counter() - began
+        explanation['size'] = None if results is None else len(results)
+        return results, explanation
+
+    @_searching
+    def searchMany(self, queries):
+        """Search for each of the mappings of search terms in *queries*.
+
+        Returns a list with the result of ``searchResults`` for each of
+        the mappings; ``_explain`` is ignored. Index queries that are
+        part of several of the searches are only applied once.
+        """
+        searches = [self._parseSearchTerms(searchterms)
+                    for searchterms in queries]
+        counts = collections.Counter()
+        for query, _, _, _, _ in searches:
+            if isinstance(query, Query):
+                index_queries = query.indexQueries()
+            else:
+                index_queries = query.items()
+            for index_query in index_queries:
+                try:
+                    counts[queryKey(index_query)] += 1
+                except TypeError:
+                    # unhashable index queries can't be shared
+                    pass
+        context = self._searchContext(
+            shared={key for key, count in counts.items() if count > 1})
+        uidutil = None
+        all_results = []
+        for search in searches:
+            results = self._cachedSearch(context, *search)
+            if results is not None:
+                if uidutil is None:
+                    uidutil = _intIds()
+                results = ResultSet(results, uidutil)
+            all_results.append(results)
+        return all_results
+
+    def facets(self, results, index_names, limit=None):
+        """Count the values of the documents in *results*.
+
+        *results* is a result set returned by ``searchResults`` or a
+        set of docids returned by ``apply``. Returns a mapping of each
+        of the *index_names* to a list of ``(value, count)`` pairs,
+        most common values first, with at most *limit* pairs. The
+        counts come from the indexes, which must provide
+        :class:`zope.catalog.interfaces.IIndexFacets`; no objects are
+        loaded.
+        """
+        docids = getattr(results, 'uids', results)
+        IF = self.family.IF
+        if not isinstance(docids, (IF.Set, IF.TreeSet, IF.Bucket, IF.BTree)):
+            docids = IF.Set(docids)
+        facets = {}
+        for index_name in index_names:
+            index = self[index_name]
+            if not IIndexFacets.providedBy(index):
+                raise ValueError(
+                    'Index %s does not support facets.' % index_name)
+            counts = sorted(index.facetCounts(docids).items())
+            if limit:
+                counts = heapq.nsmallest(
+                    limit, counts, key=lambda item: -item[1])
+            else:
+                counts.sort(key=lambda item: -item[1])
+            facets[index_name] = counts
+        return facets
+
+    def _search(self, context, query, sort_index, start, limit, reverse):
+        results = self._apply(query, context)
+        return self._sortAndLimit(results, sort_index, start, limit, reverse)
+
+    def _sortAndLimit(self, results, sort_index, start, limit, reverse):
         if results is not None:
+            stop = start + limit if limit else None
             if sort_index is not None:
-                index = self[sort_index]
-                if not zope.index.interfaces.IIndexSort.providedBy(index):
-                    raise ValueError(
-                        'Index %s does not support sorting.' %
-                        sort_index)
-                results = list(
+                results = self._sort(
+                    results, sort_index, start, stop, reverse)
+            elif start or limit or reverse:
+                results = self._slice(results, start, stop, reverse)
+        return results
+
+    def _sort(self, docids, sort_index, start, stop, reverse):
+        if isinstance(sort_index, str):
+            index = self[sort_index]
+            if zope.index.interfaces.IIndexSort.providedBy(index):
+                return list(itertools.islice(
                     index.sort(
-                        results,
-                        limit=limit,
-                        reverse=reverse))
+                        docids,
+                        limit=stop,
+                        reverse=reverse),
+                    start, None))
+            sort_index = ((sort_index, False),)
+        return self._sortByValues(docids, sort_index, stop, reverse)[start:]
+
+    def _sortByValues(self, docids, sort_keys, limit, reverse):
+        """Sort *docids* by the ``(index_name, reverse)`` *sort_keys*.
+
+        The values of documents are looked up in indexes providing
+        :class:`zope.catalog.interfaces.IIndexValue`. The last index
+        may instead provide :class:`zope.index.interfaces.IIndexSort`;
+        it then sorts all the documents once to rank them. Ranks can't
+        tell equal values apart, so they can't be followed by other
+        sort keys. If *limit* is given, only the first *limit*
+        documents are kept in a heap while sorting.
+        """
+        lookups = []
+        directions = []
+        last = len(sort_keys) - 1
+        for i, (index_name, key_reverse) in enumerate(sort_keys):
+            index = self[index_name]
+            if IIndexValue.providedBy(index):
+                lookups.append(index.documentValue)
+            elif (i == last and
+                  zope.index.interfaces.IIndexSort.providedBy(index)):
+                ranks = {docid: rank
+                         for rank, docid in enumerate(index.sort(docids))}
+                lookups.append(ranks.get)
             else:
-                if reverse or limit:
-                    results = list(results)
-                if reverse:
-                    results.reverse()
-                if limit:
-                    del results[limit:]
-            uidutil = component.getUtility(IIntIds)
-            results = ResultSet(results, uidutil)
+                raise ValueError(
+                    'Index %s does not support sorting.' % index_name)
+            directions.append(key_reverse != bool(reverse))
+
+        def sort_key(docid):
+            return _SortKey(
+                tuple(lookup(docid, _MISSING) for lookup in lookups),
+                directions)
+
+        if limit:
+            return heapq.nsmallest(limit, docids, key=sort_key)
+        return sorted(docids, key=sort_key)
+
+    def _slice(self, docids, start, stop, reverse):
+        """Return the list of *docids* from position *start* to *stop*.
+
+        The positions count from the end if *reverse* is true. Sets are
+        indexed and the keys of BTrees are sliced lazily, so the docids
+        before *start* aren't visited; buckets copy all their keys to
+        a list first.
+        """
+        size = len(docids)
+        if stop is None or stop > size:
+            stop = size
+        if reverse:
+            start, stop = size - stop, size - start
+        if start >= stop:
+            return []
+        IF = self.family.IF
+        if isinstance(docids, IF.Set):
+            results = [docids[i] for i in range(start, stop)]
+        elif isinstance(docids, (IF.TreeSet, IF.BTree, IF.Bucket)):
+            results = list(docids.keys()[start:stop])
+        else:
+            results = list(itertools.islice(docids, start, stop))
+        if reverse:
+            results.reverse()
         return results
 
+    def _cachedSearch(self, context, query, sort_index, start, limit,
+                      reverse):
+        search = (context, query, sort_index, start, limit, reverse)
+        cache = self._resultCache()
+        if cache is None:
+            return self._search(*search)
+        try:
+            key = queryKey((query, sort_index, start, limit, reverse))
+        except TypeError:
+            # unhashable query values
+            return self._search(*search)
+        if isinstance(query, Query):
+            index_names = query.indexNames()
+        else:
+            index_names = set(query)
+        if isinstance(sort_index, str):
+            index_names.add(sort_index)
+        elif sort_index is not None:
+            index_names.update(index_name for index_name, _ in sort_index)
+        stamp = self._stamp(index_names)
+        if stamp is None:
+            return self._search(*search)
+        results = cache.get(key, stamp)
+        if results is MISS:
+            results = self._search(*search)
+            cache.set(key, stamp, results)
+        return results
+
+    def _stamp(self, index_names):
+        """Return the state of the named indexes for the result cache.
+
+        Returns ``None`` if one of the indexes doesn't keep track of
+        its changes, or if the catalog or the indexes have changes
+        that aren't committed yet.
+        """
+        extent = _counterStamp(self._extent_generation)
+        if extent is None:
+            return None
+        stamp = [extent]
+        for index_name in sorted(index_names):
+            index = self[index_name]
+            if not IIndexGeneration.providedBy(index):
+                return None
+            counter = getattr(index, '_generation', None)
+            if isinstance(counter, Length):
+                generation = _counterStamp(counter)
+                if generation is None:
+                    return None
+            else:
+                generation = index.generation()
+            stamp.append((index, generation))
+        return tuple(stamp)
+
+    def _resultCache(self):
+        if not self.cache_size:
+            return None
+        cache = getattr(self, '_v_result_cache', None)
+        if cache is None or cache.maxsize != self.cache_size:
+            cache = self._v_result_cache = ResultCache(self.cache_size)
+        return cache
+
+    def cacheInfo(self):
+        """Return statistics about the search result cache.
+
+        Returns a mapping with the number of ``hits`` and ``misses``,
+        the number of cached results (``size``) and the maximum number
+        of cached results (``maxsize``).
+        """
+        cache = self._resultCache()
+        if cache is None:
+            return {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 0}
+        return {'hits': cache.hits,
+                'misses': cache.misses,
+                'size': len(cache),
+                'maxsize': cache.maxsize}
+
 
 @component.adapter(ICatalogIndex, IObjectAddedEvent)
 def indexAdded(index, event):
@@ -186,15 +1214,26 @@ def indexAdded(index, event):
     index.__parent__.updateIndex(index)
 
 
+def _update(cat, id, op, ob=None, descriptions=()):
+    # Applies or queues an operation of the event subscribers.
+    queue = getattr(cat, 'indexing_queue', None)
+    if queue is not None:
+        queue.append(id, op)
+    elif getattr(cat, 'defer_indexing', False):
+        deferred.queueFor(cat).record(cat, id, op, ob, descriptions)
+    else:
+        deferred.perform(cat, id, op, ob, descriptions)
+
+
 @component.adapter(IIntIdAddedEvent)
 def indexDocSubscriber(event):
     """A subscriber to IntIdAddedEvent"""
     ob = event.object
     if INoAutoIndex.providedBy(ob):
         return
-    for cat in component.getAllUtilitiesRegisteredFor(ICatalog, context=ob):
-        id = component.getUtility(IIntIds, context=cat).getId(ob)
-        cat.index_doc(id, ob)
+    for cat, intids in _catalogs(ob):
+        id = intids.getId(ob)
+        _update(cat, id, deferred.ADD, ob)
 
 
 @component.adapter(IObjectModifiedEvent)
@@ -203,17 +1242,17 @@ def reindexDocSubscriber(event):
     ob = event.object
     if INoAutoReindex.providedBy(ob):
         return
-    for cat in component.getAllUtilitiesRegisteredFor(ICatalog, context=ob):
-        id = component.getUtility(IIntIds, context=cat).queryId(ob)
+    for cat, intids in _catalogs(ob):
+        id = intids.queryId(ob)
         if id is not None:
-            cat.index_doc(id, ob)
+            _update(cat, id, deferred.REINDEX, ob, event.descriptions)
 
 
 @component.adapter(IIntIdRemovedEvent)
 def unindexDocSubscriber(event):
     """A subscriber to IntIdRemovedEvent"""
     ob = event.object
-    for cat in component.getAllUtilitiesRegisteredFor(ICatalog, context=ob):
-        id = component.getUtility(IIntIds, context=cat).queryId(ob)
+    for cat, intids in _catalogs(ob):
+        id = intids.queryId(ob)
         if id is not None:
-            cat.unindex_doc(id)
+            _update(cat, id, deferred.UNINDEX)
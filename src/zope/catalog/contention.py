@@ -0,0 +1,187 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Measuring write conflicts between concurrent indexing transactions
+
+:func:`writeContention` indexes documents in a catalog from several
+threads at once and counts the conflicts that the storage couldn't
+resolve. Run this module to measure them for a catalog with field,
+keyword and text indexes in a temporary ``FileStorage``::
+
+    python -m zope.catalog.contention --writers 8 --transactions 20
+
+``--classic`` gives the text index the lexicon and Okapi index of
+:mod:`zope.index` instead of the ones of :mod:`zope.catalog.text`,
+and ``--word-trees`` sets ``word_trees`` on the Okapi index of the
+latter. This needs ZODB.
+"""
+__docformat__ = 'restructuredtext'
+
+import argparse
+import random
+import tempfile
+import threading
+import time
+
+import transaction
+
+from zope.catalog.pending import ConflictError
+
+
+def writeContention(db, documents, timeout=60):
+    """Index *documents* in the catalog at the ``catalog`` key of the
+    root of *db* with concurrent writers.
+
+    *documents* holds a list for each writer of the lists of
+    ``(docid, object)`` pairs it indexes in a transaction of its own.
+    The writers index their first batches concurrently before any of
+    them commits, and retry transactions that conflict. Returns the
+    number of conflicts and the number of documents indexed per
+    second. Storages that resolve conflicts, like a FileStorage,
+    show how often conflicts can't be resolved.
+
+    The writers give up waiting for each other after *timeout*
+    seconds; the first error of a writer is raised again.
+    """
+    started = threading.Barrier(len(documents), timeout=timeout)
+    conflicts = []
+    errors = []
+
+    def write(batches):
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        waited = False
+        try:
+            for batch in batches:
+                while True:
+                    tm.begin()
+                    catalog = conn.root()['catalog']
+                    for docid, ob in batch:
+                        catalog.index_doc(docid, ob)
+                    if not waited:
+                        waited = True
+                        started.wait()
+                    try:
+                        tm.commit()
+                        break
+                    except ConflictError:
+                        tm.abort()
+                        conflicts.append(docid)
+        except BaseException as e:
+            errors.append(e)
+            started.abort()
+            tm.abort()
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=write, args=(batches,))
+               for batches in documents]
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    indexed = sum(len(batch) for batches in documents for batch in batches)
+    return len(conflicts), indexed / (time.perf_counter() - began)
+
+
+class Document:
+    """A document with a ``title``, ``tags`` and a ``body``, which
+    share values with other documents, and a word of its own."""
+
+    def __init__(self, docid):
+        self.title = 'title%d' % (docid % 3)
+        self.tags = ['tag%d' % (docid % 4)]
+        self.body = 'common text word%d' % docid
+
+
+def createCatalog(db, documents=20, classic=False, word_trees=False):
+    """Store a catalog with field, keyword and text indexes at the
+    ``catalog`` key of the root of *db*, with *documents* documents
+    indexed. *word_trees* is set on the Okapi index unless it is
+    *classic*."""
+    from zope.catalog.catalog import Catalog
+    from zope.catalog.field import FieldIndex
+    from zope.catalog.keyword import KeywordIndex
+    from zope.catalog.text import TextIndex
+    with db.transaction() as conn:
+        catalog = conn.root()['catalog'] = Catalog()
+        catalog['title'] = FieldIndex('title')
+        catalog['tags'] = KeywordIndex('tags')
+        if classic:
+            import zope.index.text.lexicon
+            import zope.index.text.okapiindex
+            from zope.index.text.lexicon import CaseNormalizer
+            from zope.index.text.lexicon import Splitter
+            from zope.index.text.lexicon import StopWordRemover
+            lexicon = zope.index.text.lexicon.Lexicon(
+                Splitter(), CaseNormalizer(), StopWordRemover())
+            catalog['body'] = TextIndex(
+                'body', field_callable=False, lexicon=lexicon,
+                index=zope.index.text.okapiindex.OkapiIndex(lexicon))
+        else:
+            catalog['body'] = TextIndex('body', field_callable=False)
+            catalog['body'].index.word_trees = word_trees
+        for docid in range(1, documents + 1):
+            catalog.index_doc(docid, Document(docid))
+
+
+def randomDocuments(writers, transactions, size, rng=random):
+    """Return the documents for `writeContention`: *transactions*
+    batches of *size* documents with random ids for each of the
+    *writers*."""
+    docids = rng.sample(range(2 ** 20, 2 ** 30),
+                        writers * transactions * size)
+    return [[[(docid, Document(docid))
+              for docid in docids[start:start + size]]
+             for start in range(first, first + transactions * size, size)]
+            for first in range(0, len(docids), transactions * size)]
+
+
+def main(argv=None):
+    import os
+
+    import ZODB
+    import ZODB.FileStorage
+    parser = argparse.ArgumentParser(
+        prog='python -m zope.catalog.contention',
+        description='Measure write conflicts between concurrent'
+                    ' indexing transactions.')
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--transactions', type=int, default=10,
+                        help='transactions per writer')
+    parser.add_argument('--size', type=int, default=5,
+                        help='documents per transaction')
+    parser.add_argument('--classic', action='store_true',
+                        help='use the text index classes of zope.index')
+    parser.add_argument('--word-trees', action='store_true',
+                        help='keep the documents of every word in a BTree')
+    options = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ZODB.DB(ZODB.FileStorage.FileStorage(
+            os.path.join(tmp, 'Data.fs')))
+        try:
+            createCatalog(db, classic=options.classic,
+                          word_trees=options.word_trees)
+            conflicts, rate = writeContention(db, randomDocuments(
+                options.writers, options.transactions, options.size))
+        finally:
+            db.close()
+    print('%d conflicts in %d transactions, %.0f documents/s' % (
+        conflicts, options.writers * options.transactions, rate))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,224 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Indexing deferred to the end of a transaction
+
+Catalogs whose ``defer_indexing`` attribute is true aren't updated by
+the event subscribers right away. The subscribers record what has to
+be done in a queue of the current transaction instead, and the queue
+is processed just before the transaction commits. Operations on the
+same document are collapsed: a document that is added and modified
+several times is only indexed once, and one that is added and removed
+again isn't indexed at all.
+
+Until the transaction commits, searches don't see the queued changes;
+call :func:`flush` to process the queue earlier. Rolling back a
+savepoint of the transaction also rolls back the queue to the
+operations queued when the savepoint was taken.
+"""
+__docformat__ = 'restructuredtext'
+
+import transaction
+from transaction.interfaces import IDataManagerSavepoint
+from transaction.interfaces import ISavepointDataManager
+from zope.interface import implementer
+
+from zope.catalog.interfaces import IBulkInjection
+
+
+ADD = 'add'
+REINDEX = 'reindex'
+UNINDEX = 'unindex'
+
+
+# What recording an operation on a document for which an operation is
+# already queued results in; None drops the queued operation.
+_COLLAPSED = {
+    (ADD, ADD): ADD,
+    (ADD, REINDEX): ADD,
+    (ADD, UNINDEX): None,
+    (REINDEX, ADD): REINDEX,
+    (REINDEX, REINDEX): REINDEX,
+    (REINDEX, UNINDEX): UNINDEX,
+    (UNINDEX, ADD): REINDEX,
+    (UNINDEX, REINDEX): REINDEX,
+    (UNINDEX, UNINDEX): UNINDEX,
+}
+
+
+class IndexingQueue:
+    """The indexing operations queued in a transaction.
+
+    Operations are processed in the order the documents were first
+    queued.
+    """
+
+    def __init__(self):
+        self._operations = {}
+
+    def __len__(self):
+        return len(self._operations)
+
+    def record(self, catalog, docid, op, ob=None, descriptions=()):
+        """Queue the *op* (`ADD`, `REINDEX` or `UNINDEX`) of the
+        document *ob* with id *docid* in *catalog*.
+
+        The *descriptions* of the modifications of a `REINDEX` are
+        merged with those of a queued `REINDEX`; without descriptions
+        the document is reindexed completely.
+        """
+        key = (id(catalog), docid)
+        queued = self._operations.get(key)
+        descriptions = tuple(descriptions)
+        if queued is not None:
+            if queued[2] == op == REINDEX and queued[4] and descriptions:
+                descriptions = queued[4] + descriptions
+            else:
+                descriptions = ()
+            op = _COLLAPSED[queued[2], op]
+            if op is None:
+                del self._operations[key]
+                return
+            if ob is None:
+                ob = queued[3]
+        self._operations[key] = (catalog, docid, op, ob, descriptions)
+
+    def process(self):
+        """Apply the queued operations to the catalogs.
+
+        Documents to index or unindex in the same catalog are passed
+        to its ``index_docs`` or ``unindex_docs`` all at once if it
+        provides ``IBulkInjection``.
+        """
+        while self._operations:
+            operations = list(self._operations.values())
+            self._operations.clear()
+            # Indexing can fire events that queue more operations.
+            indexing = {}
+            unindexing = {}
+            for operation in operations:
+                catalog, docid, op, ob, descriptions = operation
+                if op == UNINDEX:
+                    _documentsOf(unindexing, catalog).append(docid)
+                elif op == ADD or not descriptions:
+                    _documentsOf(indexing, catalog).append((docid, ob))
+                else:
+                    perform(*operation)
+            for catalog, docids in unindexing.values():
+                if len(docids) > 1 and IBulkInjection.providedBy(catalog):
+                    catalog.unindex_docs(docids)
+                else:
+                    for docid in docids:
+                        catalog.unindex_doc(docid)
+            for catalog, documents in indexing.values():
+                if len(documents) > 1 and IBulkInjection.providedBy(catalog):
+                    catalog.index_docs(documents)
+                else:
+                    for docid, ob in documents:
+                        catalog.index_doc(docid, ob)
+
+
+def _documentsOf(batches, catalog):
+    # The list of documents of *catalog* in *batches*, a dictionary
+    # of (catalog, documents) pairs keyed by catalog identity.
+    key = id(catalog)
+    if key not in batches:
+        batches[key] = (catalog, [])
+    return batches[key][1]
+
+
+def perform(catalog, docid, op, ob=None, descriptions=()):
+    """Apply the *op* of the document *ob* with id *docid* to
+    *catalog* right away.
+
+    A `REINDEX` with *descriptions* only updates the affected indexes
+    of catalogs that support it.
+    """
+    if op == UNINDEX:
+        catalog.unindex_doc(docid)
+        return
+    reindex_doc = getattr(catalog, 'reindex_doc', None)
+    if op == REINDEX and descriptions and reindex_doc is not None:
+        reindex_doc(docid, ob, descriptions)
+    else:
+        catalog.index_doc(docid, ob)
+
+
+def _transactionManager(catalog):
+    jar = getattr(catalog, '_p_jar', None)
+    return getattr(jar, 'transaction_manager', None) or transaction.manager
+
+
+@implementer(ISavepointDataManager)
+class _QueueDataManager:
+    # Joins the transaction of a queue, so that rolling back a
+    # savepoint rolls back the queue too.
+
+    def __init__(self, queue, transaction_manager):
+        self.queue = queue
+        self.transaction_manager = transaction_manager
+
+    def savepoint(self):
+        return _QueueSavepoint(self.queue)
+
+    def abort(self, txn):
+        # Also rolls back to the savepoints taken before the queue
+        # was created.
+        self.queue._operations.clear()
+
+    def tpc_begin(self, txn):
+        pass
+
+    commit = tpc_vote = tpc_finish = tpc_abort = tpc_begin
+
+    def sortKey(self):
+        return 'zope.catalog.deferred:%d' % id(self)
+
+
+@implementer(IDataManagerSavepoint)
+class _QueueSavepoint:
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.operations = dict(queue._operations)
+
+    def rollback(self):
+        self.queue._operations = dict(self.operations)
+
+
+def queueFor(catalog):
+    """Return the indexing queue of the current transaction of
+    *catalog*, creating it if needed."""
+    tm = _transactionManager(catalog)
+    txn = tm.get()
+    try:
+        return txn.data(IndexingQueue)
+    except KeyError:
+        queue = IndexingQueue()
+        txn.set_data(IndexingQueue, queue)
+        txn.join(_QueueDataManager(queue, tm))
+        txn.addBeforeCommitHook(queue.process)
+        return queue
+
+
+def flush(txn=None, catalog=None):
+    """Process the indexing queue of *txn*, which defaults to the
+    current transaction of *catalog*, or of the thread if no catalog
+    is given."""
+    if txn is None:
+        txn = _transactionManager(catalog).get()
+    try:
+        queue = txn.data(IndexingQueue)
+    except KeyError:
+        return
+    queue.process()
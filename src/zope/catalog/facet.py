@@ -0,0 +1,74 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Facet counting for indexes with forward and reverse mappings
+"""
+__docformat__ = 'restructuredtext'
+
+import zope.interface
+
+from zope.catalog.interfaces import IIndexFacets
+
+
+@zope.interface.implementer(IIndexFacets)
+class FacetIndexMixin:
+    """Count facet values of an index.
+
+    Meant to be mixed with an index that has a ``_fwd_index`` mapping
+    values to sets of docids, and a ``_rev_index`` mapping docids to
+    what `_documentValues` turns into the values of a document.
+
+    Counting either intersects the documents of each value with the
+    documents to count, or looks up the values of each document to
+    count, whichever is estimated to be cheaper.
+    """
+
+    #: How many times more expensive looking up the values of a
+    #: document is assumed to be than merging a docid while
+    #: intersecting sets.
+    facet_scan_cost = 10
+
+    def _documentValues(self, values):
+        """Return the values of a ``_rev_index`` entry."""
+        raise NotImplementedError()
+
+    def facetCounts(self, docids):
+        """See :class:`zope.catalog.interfaces.IIndexFacets`"""
+        size = len(docids)
+        scan_cost = self.facet_scan_cost * size
+        # only count as many values as can make intersecting cheaper
+        # than scanning
+        values = len(self._fwd_index.keys()[:self.facet_scan_cost])
+        if self.documentCount() + values * size < scan_cost:
+            return self._countByValue(docids)
+        return self._countByDocument(docids)
+
+    def _countByValue(self, docids):
+        intersection = self.family.IF.intersection
+        counts = {}
+        for value, postings in self._fwd_index.items():
+            count = len(intersection(postings, docids))
+            if count:
+                counts[value] = count
+        return counts
+
+    def _countByDocument(self, docids):
+        rev_index = self._rev_index
+        counts = {}
+        for docid in docids:
+            values = rev_index.get(docid)
+            if values is None:
+                continue
+            for value in self._documentValues(values):
+                counts[value] = counts.get(value, 0) + 1
+        return counts
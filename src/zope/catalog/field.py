@@ -13,24 +13,164 @@
 ##############################################################################
 """Field catalog indexes
 """
+import itertools
+import operator
+
 import zope.container.contained
 import zope.index.field
 import zope.interface
+from BTrees.Length import Length
 
 import zope.catalog.attribute
+import zope.catalog.bulk
+import zope.catalog.facet
 import zope.catalog.interfaces
 
 
+_MISSING = object()
+
+
 class IFieldIndex(zope.catalog.interfaces.IAttributeIndex,
-                  zope.catalog.interfaces.ICatalogIndex):
+                  zope.catalog.interfaces.ICatalogIndex,
+                  zope.catalog.interfaces.IIndexBuild,
+                  zope.catalog.interfaces.IIndexEstimate,
+                  zope.catalog.interfaces.IIndexFacets,
+                  zope.catalog.interfaces.IIndexValue,
+                  zope.catalog.interfaces.IRestrictedIndexSearch):
     """Interface-based catalog field index
     """
 
 
 @zope.interface.implementer(IFieldIndex)
 class FieldIndex(zope.catalog.attribute.AttributeIndex,
+                 zope.catalog.facet.FacetIndexMixin,
                  zope.index.field.FieldIndex,
                  zope.container.contained.Contained):
     """
     Default implementation of a :class:`IFieldIndex`.
     """
+
+    #: When restricted to candidate documents that are at most this
+    #: fraction of all indexed documents, a range query checks the
+    #: value of each candidate instead of collecting the whole range.
+    restrict_scan_ratio = 0.1
+
+    #: Estimates count the documents of a value up to this many, so
+    #: that the postings of frequent values aren't loaded completely.
+    estimate_limit = 1000
+
+    #: How many values `build` sorts in memory; more are sorted in
+    #: temporary files, which needs the values to be picklable.
+    build_run_size = 100000
+
+    def build(self, documents):
+        """
+        Index the ``(docid, object)`` pairs *documents* into this empty
+        index.
+
+        The values of the documents are collected and sorted first.
+        Then the forward and reverse indexes are built bottom-up in
+        key order, with full buckets.
+
+        The values are derived by `_value`, not by ``index_doc``, so
+        subclasses overriding ``index_doc`` shouldn't be built this
+        way. With more than `build_run_size` documents, the values are
+        pickled into temporary files to sort them; values that can't
+        be pickled make the build fail before the index is changed.
+        """
+        if self.documentCount():
+            raise ValueError("Only empty indexes can be built")
+        family = self.family
+        by_value = zope.catalog.bulk.ExternalSorter(self.build_run_size)
+        for docid, object in documents:
+            value = self._value(object)
+            if (value is not None
+                    and value is not zope.catalog.attribute._NOT_ADAPTED):
+                by_value.add((value, docid))
+        by_docid = zope.catalog.bulk.ExternalSorter(self.build_run_size)
+
+        def postings():
+            for value, pairs in itertools.groupby(by_value.sorted(),
+                                                  operator.itemgetter(0)):
+                docids = []
+                for value, docid in pairs:
+                    docids.append(docid)
+                    by_docid.add((docid, value))
+                yield value, zope.catalog.bulk.buildTree(
+                    family.IF.TreeSet, docids)
+
+        self._changed()
+        self._fwd_index = zope.catalog.bulk.buildTree(
+            family.OO.BTree, postings())
+        self._rev_index = zope.catalog.bulk.buildTree(
+            family.IO.BTree, by_docid.sorted())
+        self._num_docs = Length(len(by_docid))
+        # unknown fingerprints are recorded when documents are indexed
+        self._fingerprints = None
+
+    def estimate(self, query):
+        """
+        Estimate the number of documents matching the ``(min, max)``
+        *query*.
+
+        Exact matches are counted from the forward index, up to
+        `estimate_limit` documents; ranges are assumed to match every
+        indexed document.
+        """
+        if not isinstance(query, tuple) or len(query) != 2:
+            return None
+        min, max = query
+        if min is not None and min == max:
+            docids = self._fwd_index.get(min)
+            if docids is None:
+                return 0
+            return len(docids.keys()[:self.estimate_limit])
+        return self.documentCount()
+
+    def _indexingOrder(self, values):
+        # Sorting by value updates the forward index in key order;
+        # None values, which unindex documents, come first.
+        return sorted(values,
+                      key=lambda item: (item[1] is not None, item[1],
+                                        item[0]))
+
+    def _documentValues(self, value):
+        return (value,)
+
+    def documentValue(self, docid, default=None):
+        """
+        Return the value indexed for *docid* or *default*.
+        """
+        return self._rev_index.get(docid, default)
+
+    def apply(self, query, restrict_to=None):
+        """
+        Apply the ``(min, max)`` *query*, optionally restricted to the
+        candidate documents in *restrict_to*.
+        """
+        if restrict_to is None:
+            return super().apply(query)
+        if not isinstance(query, tuple) or len(query) != 2:
+            raise TypeError("two-length tuple expected", query)
+        IF = self.family.IF
+        min, max = query
+        if min is not None and min == max:
+            docids = self._fwd_index.get(min)
+            if docids is None:
+                return IF.Set()
+            return IF.intersection(docids, restrict_to)
+        limit = self.restrict_scan_ratio * self.documentCount()
+        if len(restrict_to) > limit:
+            return IF.intersection(super().apply(query), restrict_to)
+        rev_index = self._rev_index
+        result = []
+        for docid in restrict_to:
+            value = rev_index.get(docid, _MISSING)
+            if value is _MISSING:
+                continue
+            if min is not None and value < min:
+                continue
+            if max is not None and value > max:
+                continue
+            result.append(docid)
+        return IF.Set(result)
@@ -37,14 +37,66 @@ class ICatalogQuery(zope.interface.Interface):
 
          * _sort_index - The name of index to sort
            results with. This index must implement
-           zope.index.interfaces.IIndexSort.
+           zope.index.interfaces.IIndexSort or
+           zope.catalog.interfaces.IIndexValue. To
+           sort by several indexes, a sequence of
+           (index_name, reverse) pairs; all but the
+           last of these indexes must implement
+           IIndexValue.
+         * _start - Skip this number of results,
+           useful for paging through results.
          * _limit - Limit result set by this number,
            useful when used with sorting.
          * _reverse - Reverse result set, also
-           useful with sorting.
+           useful with sorting. With several sort
+           indexes, this reverses every one of them.
+         * _query - A zope.catalog.query.Query that
+           must match in addition to the other
+           keyword arguments.
+         * _explain - If true, the result set
+           provides the mapping returned by
+           `explain` as its ``explanation``
+           attribute.
 
         """
 
+    def count(**kw):
+        """Return the number of documents matching the search terms.
+
+        Takes the same arguments as `searchResults`; sorting, limiting
+        and explaining are ignored. Returns ``None`` if none of the
+        indexes apply.
+        """
+
+    def exists(**kw):
+        """Return whether any document matches the search terms.
+
+        Takes the same arguments as `count`.
+        """
+
+    def searchMany(queries):
+        """Search for each of the mappings of search terms in *queries*.
+
+        Returns a list with the result of `searchResults` for each of
+        the mappings; ``_explain`` is ignored. Index queries that are
+        part of several of the searches are only applied once.
+        """
+
+    def explain(**kw):
+        """Search like `searchResults` and return a mapping describing
+        how it was done."""
+
+    def facets(results, index_names, limit=None):
+        """Count the values of the documents in *results* in each of
+        the indexes named *index_names*.
+
+        Returns a mapping of index names to lists of ``(value, count)``
+        pairs, most common values first, with at most *limit* pairs.
+        """
+
+    def cacheInfo():
+        """Return statistics about the search result cache."""
+
 
 class ICatalogEdit(zope.index.interfaces.IInjection):
     """Allows one to manipulate the Catalog information."""
@@ -52,6 +104,23 @@ class ICatalogEdit(zope.index.interfaces.IInjection):
     def updateIndexes():
         """Reindex all objects."""
 
+    def reindex_doc(docid, value, descriptions=()):
+        """Update the document in the indexes affected by the
+        modifications *descriptions* describes.
+
+        Without descriptions, this is the same as ``index_doc``.
+        """
+
+    def index_docs(documents, executor=None):
+        """Index *documents*, an iterable of ``(docid, value)`` pairs."""
+
+    def rebuildIndex(name, index=None):
+        """Rebuild the index *name* off to the side and swap it in.
+
+        Searches keep using the old index until the new one, *index* or
+        an empty copy of the old one, is filled.
+        """
+
 
 class ICatalogIndex(zope.index.interfaces.IInjection,
                     zope.index.interfaces.IIndexSearch,
@@ -64,6 +133,127 @@ class ICatalogIndex(zope.index.interfaces.IInjection,
     zope.container.constraints.containers('.ICatalog')
 
 
+class IIndexEstimate(zope.interface.Interface):
+    """An index that can cheaply estimate the size of a query result.
+
+    The catalog uses these estimates to plan a search: the most
+    selective indexes are applied first, so that the expensive ones
+    may not need to be applied at all.
+    """
+
+    def estimate(query):
+        """Return the estimated number of documents matching *query*.
+
+        The estimate must be cheaper to compute than applying the
+        query; it is typically derived from the cardinality
+        statistics the index keeps anyway. Return ``None`` if no
+        estimate can be given.
+
+        Estimates are rough: the field and keyword indexes count
+        documents only up to a limit, and estimate that range
+        queries, as well as text queries, match every document, which
+        makes them be applied last.
+        """
+
+
+class IRestrictedIndexSearch(zope.index.interfaces.IIndexSearch):
+    """An index that can evaluate a query against candidate documents.
+
+    Once the catalog has narrowed a search down to a set of candidate
+    documents, it passes them to the indexes applied later on, which
+    can then avoid building results that would be thrown away by the
+    intersection.
+    """
+
+    def apply(query, *, restrict_to=None):
+        """Apply an index to the given query.
+
+        If *restrict_to* is not ``None``, it is an ``IFSet`` or
+        ``IFBucket`` of candidate document ids, and the result must
+        only contain documents from it. Scores of the documents that
+        are returned are the same as without *restrict_to*. The catalog
+        always passes *restrict_to* as a keyword argument, so indexes
+        may take other optional arguments before it.
+        """
+
+
+class IIndexGeneration(zope.interface.Interface):
+    """An index that counts the changes made to it.
+
+    The catalog uses the generations of indexes to find out whether
+    cached search results are still valid.
+    """
+
+    def generation():
+        """Return a number that increases whenever the index changes.
+        """
+
+
+class IIndexValue(zope.interface.Interface):
+    """An index that can look up the value indexed for a document.
+
+    The catalog uses this to sort search results by indexes that don't
+    provide :class:`zope.index.interfaces.IIndexSort`, and to sort by
+    several indexes at once.
+    """
+
+    def documentValue(docid, default=None):
+        """Return the value indexed for *docid*.
+
+        Returns *default* if the document isn't indexed.
+        """
+
+
+class IIndexFacets(zope.interface.Interface):
+    """An index that can count the values of documents."""
+
+    def facetCounts(docids):
+        """Count the documents in *docids* per indexed value.
+
+        Returns a mapping of the values indexed for the documents to
+        the number of documents having them. Values none of the
+        documents have are left out.
+        """
+
+
+class IBulkInjection(zope.interface.Interface):
+    """An index that can index or unindex many documents at once.
+
+    Doing so is cheaper than one document at a time, for example
+    because the index can update its data structures in key order.
+    """
+
+    def index_docs(documents, executor=None):
+        """Index *documents*, an iterable of ``(docid, value)`` pairs.
+
+        The result is the same as calling ``index_doc`` for each pair
+        in turn. If *executor*, a
+        :class:`concurrent.futures.Executor`, is given, the index may
+        do work that doesn't touch its data structures in it.
+        """
+
+    def unindex_docs(docids):
+        """Unindex the documents with the ids in *docids*.
+
+        Ids of documents that aren't indexed are ignored.
+        """
+
+
+class IIndexBuild(zope.interface.Interface):
+    """An index that can be filled faster than by indexing documents
+    one at a time.
+
+    The catalog builds indexes this way when they are added.
+    """
+
+    def build(documents):
+        """Index *documents*, ``(docid, object)`` pairs with distinct
+        docids, into the empty index.
+
+        Raises :exc:`ValueError` if the index isn't empty.
+        """
+
+
 class ICatalog(ICatalogQuery, ICatalogEdit,
                zope.container.interfaces.IContainer):
     """Marker to describe a catalog in content space."""
@@ -18,16 +18,94 @@ import zope.index.keyword
 import zope.interface
 
 import zope.catalog.attribute
+import zope.catalog.facet
 import zope.catalog.interfaces
 
 
 class IKeywordIndex(zope.catalog.interfaces.IAttributeIndex,
-                    zope.catalog.interfaces.ICatalogIndex):
+                    zope.catalog.interfaces.ICatalogIndex,
+                    zope.catalog.interfaces.IIndexEstimate,
+                    zope.catalog.interfaces.IIndexFacets,
+                    zope.catalog.interfaces.IRestrictedIndexSearch):
     """Interface-based catalog keyword index"""
 
 
+class KeywordIndexMixin(zope.catalog.facet.FacetIndexMixin):
+    """
+    Catalog support shared by the keyword index implementations.
+
+    Meant to be mixed with a :class:`zope.index.keyword.KeywordIndex`.
+    """
+
+    #: Estimates count the documents of a keyword up to this many.
+    estimate_limit = 1000
+
+    def _documentValues(self, keywords):
+        return keywords
+
+    def _parseQuery(self, query):
+        operator = 'and'
+        if isinstance(query, dict):
+            operator = query.get('operator', operator)
+            query = query['query']
+        if isinstance(query, str):
+            query = [query]
+        return self.normalize(query), operator
+
+    def estimate(self, query):
+        """
+        Estimate the number of documents matching *query* from the
+        sizes of the keyword postings, counted up to `estimate_limit`.
+        """
+        try:
+            words, operator = self._parseQuery(query)
+        except (KeyError, TypeError):
+            return None
+        sizes = []
+        for word in words:
+            docids = self._fwd_index.get(word)
+            sizes.append(0 if docids is None
+                         else len(docids.keys()[:self.estimate_limit]))
+        if not sizes:
+            return 0
+        if operator == 'or':
+            return min(sum(sizes), self.documentCount())
+        return min(sizes)
+
+    def apply(self, query, restrict_to=None):
+        """
+        Apply *query*, optionally restricted to the candidate documents
+        in *restrict_to*.
+        """
+        if restrict_to is None:
+            return super().apply(query)
+        words, operator = self._parseQuery(query)
+        IF = self.family.IF
+        sets = [self._fwd_index.get(word, IF.Set()) for word in words]
+        if operator == 'or':
+            rs = IF.multiunion(
+                [IF.intersection(docids, restrict_to) for docids in sets])
+        elif operator == 'and':
+            rs = None
+            if sets:
+                # start from the candidates, which are usually the
+                # smallest set
+                rs = restrict_to
+                for docids in sorted(sets, key=len):
+                    rs = IF.intersection(rs, docids)
+                    if not rs:
+                        break
+        else:
+            raise TypeError('Keyword index only supports `and` and `or` '
+                            'operators, not `%s`.' % operator)
+        if rs:
+            return rs
+        return IF.Set()
+
+
 @zope.interface.implementer(IKeywordIndex)
 class KeywordIndex(zope.catalog.attribute.AttributeIndex,
+                   KeywordIndexMixin,
                    zope.index.keyword.KeywordIndex,
                    zope.container.contained.Contained):
     """
@@ -38,6 +116,7 @@ class KeywordIndex(zope.catalog.attribute.AttributeIndex,
 @zope.interface.implementer(IKeywordIndex)
 class CaseInsensitiveKeywordIndex(
         zope.catalog.attribute.AttributeIndex,
+        KeywordIndexMixin,
         zope.index.keyword.CaseInsensitiveKeywordIndex,
         zope.container.contained.Contained):
     """
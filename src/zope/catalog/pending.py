@@ -0,0 +1,258 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Indexing queued in the database and done by a worker
+
+Catalogs whose ``indexing_queue`` attribute is a `Queue` aren't updated
+by the event subscribers at all. The subscribers append the ids of the
+documents and what to do with them to the queue, which is stored in
+the database along with the catalog, so that the transactions changing
+documents stay short. A worker calls :func:`process` regularly, in
+transactions of its own, to apply the queued operations to the
+catalog.
+
+The queue is kept in buckets of `Queue.bucket_size` operations, so
+appending an operation only changes the last bucket and a counter.
+Transactions appending to the queue concurrently, and the worker
+taking operations from it at the same time, don't conflict. Only two
+transactions both taking operations do, as well as appending to a
+bucket while the worker drops it.
+
+Searches use the indexes as they are and don't see the queued changes
+until they are processed, unless the ``stale_search`` attribute of the
+queue is false. Then each search applies the queued operations first,
+in a transaction savepoint that is rolled back afterwards, so that
+the queue and the indexes are left alone. This takes as long as
+processing the queue, so it's only meant for short queues. The queue
+of a catalog that isn't stored in a database is processed instead.
+"""
+__docformat__ = 'restructuredtext'
+
+import contextlib
+
+import BTrees
+from BTrees.Length import Length
+from persistent import Persistent
+from zope.intid.interfaces import IIntIds
+
+from zope import component
+from zope.catalog import deferred
+
+
+try:
+    from ZODB.POSException import ConflictError
+except ModuleNotFoundError:  # pragma: no cover
+    # without ZODB, there are no conflicts to resolve
+    ConflictError = ValueError
+
+
+class _Bucket(Persistent):
+    """A part of a `Queue`: operations in the order they were
+    appended."""
+
+    # Dropped from the queue; set so that appending to it conflicts
+    # with dropping it.
+    _dropped = False
+
+    def __init__(self):
+        # (docid, op) pairs
+        self._entries = ()
+        # how many entries were taken so far
+        self._taken = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def appended(self):
+        """Return how many operations were appended to the bucket."""
+        return self._taken + len(self._entries)
+
+    def append(self, entry):
+        if self._entries[-1:] != (entry,):
+            self._entries += (entry,)
+
+    def take(self, count=None):
+        entries = self._entries[:count]
+        self._entries = self._entries[len(entries):]
+        self._taken += len(entries)
+        return entries
+
+    def _p_resolveConflict(self, old, committed, new):
+        # Both transactions took operations the old state had from its
+        # start, and appended operations to its end. The operations
+        # appended by the committed transaction come first.
+        taken = []
+        appended = []
+        for state in (committed, new):
+            count = state['_taken'] - old['_taken']
+            kept = len(old['_entries']) - count
+            if state['_entries'][:kept] != old['_entries'][count:]:
+                raise ConflictError('Inconsistent indexing queue states')
+            taken.append(count)
+            appended.append(state['_entries'][kept:])
+        if all(taken):
+            raise ConflictError('Operations taken from the indexing queue '
+                                'by concurrent transactions')
+        others = ({key: value for key, value in state.items()
+                   if key not in ('_entries', '_taken')}
+                  for state in (committed, new))
+        if next(others) != next(others):
+            raise ConflictError('Indexing queue bucket dropped')
+        resolved = dict(new)
+        count = max(taken)
+        resolved['_entries'] = (
+            old['_entries'][count:] + appended[0] + appended[1])
+        resolved['_taken'] = old['_taken'] + count
+        return resolved
+
+
+class Queue(Persistent):
+    """The indexing operations queued for a catalog.
+
+    The operations are kept in the order they were appended. The
+    length of the queue is the number of operations waiting.
+    """
+
+    #: If true, searches don't wait for the queued operations to be
+    #: processed, and may miss the latest changes.
+    stale_search = True
+
+    #: How many operations are appended to a bucket before a new one
+    #: is started.
+    bucket_size = 500
+
+    def __init__(self):
+        # buckets by consecutive numbers; the last one is never dropped
+        self._buckets = BTrees.family32.IO.BTree({0: _Bucket()})
+        self._length = Length()
+
+    def __len__(self):
+        return self._length()
+
+    def __iter__(self):
+        """Iterate over the queued operations, as ``(docid, op)``
+        pairs, without taking them."""
+        for bucket in self._buckets.values():
+            yield from bucket._entries
+
+    def append(self, docid, op):
+        """Queue the *op* (``ADD``, ``REINDEX`` or ``UNINDEX`` of
+        :mod:`zope.catalog.deferred`) of the document with id
+        *docid*."""
+        buckets = self._buckets
+        last = buckets.maxKey()
+        bucket = buckets[last]
+        if bucket.appended() >= self.bucket_size:
+            bucket = buckets[last + 1] = _Bucket()
+        before = len(bucket)
+        bucket.append((docid, op))
+        self._length.change(len(bucket) - before)
+
+    def take(self, count=None):
+        """Remove the *count* oldest operations, or all of them, from
+        the queue and return them as ``(docid, op)`` pairs."""
+        buckets = self._buckets
+        taken = ()
+        while count is None or len(taken) < count:
+            first = buckets.minKey()
+            bucket = buckets[first]
+            taken += bucket.take(None if count is None
+                                 else count - len(taken))
+            if len(bucket) or first == buckets.maxKey():
+                break
+            bucket._dropped = True
+            del buckets[first]
+        self._length.change(-len(taken))
+        return taken
+
+
+def process(catalog, batch_size=1000, commit=False):
+    """Apply the operations queued for *catalog* and return how many
+    there were.
+
+    The operations are taken from the queue in batches of
+    *batch_size*. Operations on the same document in a batch are
+    collapsed like :mod:`zope.catalog.deferred` does, and the
+    documents are passed to the bulk indexing methods of the catalog.
+    Documents whose object is gone by then are unindexed. If
+    *commit* is true, the transaction is committed after each batch.
+    """
+    queue = catalog.indexing_queue
+    processed = 0
+    while True:
+        entries = queue.take(batch_size)
+        if not entries:
+            return processed
+        _apply(catalog, entries)
+        processed += len(entries)
+        if commit:
+            deferred._transactionManager(catalog).commit()
+
+
+def _apply(catalog, entries):
+    # Applies the (docid, op) pairs *entries* to *catalog*.
+    intids = component.getUtility(IIntIds, context=catalog)
+    batch = deferred.IndexingQueue()
+    for docid, op in entries:
+        ob = None
+        if op != deferred.UNINDEX:
+            ob = intids.queryObject(docid)
+            if ob is None:
+                op = deferred.UNINDEX
+        batch.record(catalog, docid, op, ob)
+    batch.process()
+
+
+def applied(catalog):
+    """Return a context manager within which *catalog* shows the
+    operations queued for it, unless stale searches are acceptable.
+
+    The operations are applied in a savepoint of the transaction that
+    is rolled back on exit, so that neither the queue nor the indexes
+    are changed. The context manager then returns true: results
+    that are still needed after the exit must be copied within it.
+    Catalogs that aren't stored in a database can't be rolled back;
+    their queue is processed right away instead.
+    """
+    queue = catalog.indexing_queue
+    if queue is None or queue.stale_search or not len(queue):
+        return contextlib.nullcontext()
+    if getattr(catalog, '_p_jar', None) is None:
+        process(catalog)
+        return contextlib.nullcontext()
+    return _Applied(catalog, queue)
+
+
+class _Applied:
+
+    def __init__(self, catalog, queue):
+        self.catalog = catalog
+        self.queue = queue
+
+    def __enter__(self):
+        self.savepoint = deferred._transactionManager(
+            self.catalog).savepoint(optimistic=True)
+        # Rolling back doesn't forget the objects read as current while
+        # changing others, which would make the transaction conflict
+        # with concurrent changes of them.
+        self.read_current = getattr(self.catalog._p_jar, '_readCurrent', None)
+        if self.read_current is not None:
+            self.read_current_before = dict(self.read_current)
+        _apply(self.catalog, list(self.queue))
+        return True
+
+    def __exit__(self, *exc_info):
+        self.savepoint.rollback()
+        if self.read_current is not None:
+            self.read_current.clear()
+            self.read_current.update(self.read_current_before)
@@ -0,0 +1,571 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Composable catalog queries
+
+Queries are built from :class:`Term` objects, which apply a query to a
+single index, and combined with :class:`And`, :class:`Or` and
+:class:`Not`. They can be passed to
+:meth:`zope.catalog.catalog.Catalog.apply` or to ``searchResults`` as
+the ``_query`` argument. The ``&``, ``|`` and ``~`` operators combine
+queries as well.
+
+Queries are evaluated against a :class:`SearchContext`. Every query can
+estimate the number of documents it matches, which :class:`And` uses to
+evaluate the most selective queries first and to hand their results to
+the other queries as candidates. Queries can also just count the
+documents they match or tell whether there are any, which can be done
+without building all the intermediate results.
+"""
+__docformat__ = 'restructuredtext'
+
+import time
+
+from zope.catalog.interfaces import IIndexEstimate
+from zope.catalog.interfaces import IRestrictedIndexSearch
+
+
+# Sorts queries that cannot estimate their results after all others.
+_UNKNOWN_ESTIMATE = float('inf')
+
+
+# Marks shared index queries that have not been applied yet.
+_NOT_APPLIED = object()
+
+
+# Counting the common documents of two sets by looking up each
+# document of the smaller set in the larger one is cheaper than merging
+# them if the larger set is at least this many times as large.
+_PROBE_RATIO = 32
+
+
+def queryKey(query):
+    """Return a hashable key for *query*.
+
+    Equal queries have equal keys. Containers are converted
+    recursively; values of different types never have the same key, so
+    that, e.g., a list is not mistaken for a tuple. Raises a
+    ``TypeError`` if the query contains unhashable values.
+
+      >>> from zope.catalog.query import queryKey
+      >>> queryKey({'a': [1, 2]}) == queryKey({'a': [1, 2]})
+      True
+      >>> queryKey([1, 2]) == queryKey((1, 2))
+      False
+      >>> queryKey({1, 2}) == queryKey(frozenset([2, 1]))
+      True
+      >>> queryKey({'a': bytearray()})
+      Traceback (most recent call last):
+      ...
+      TypeError: unhashable type: 'bytearray'
+    """
+    if isinstance(query, Query):
+        return type(query), queryKey(vars(query))
+    if isinstance(query, dict):
+        return dict, frozenset(
+            (key, queryKey(value)) for key, value in query.items())
+    if isinstance(query, (list, tuple)):
+        return type(query), tuple(queryKey(value) for value in query)
+    if isinstance(query, (set, frozenset)):
+        return frozenset, frozenset(queryKey(value) for value in query)
+    hash(query)
+    return type(query), query
+
+
+class SearchContext:
+    """The catalog a query is evaluated against.
+
+    *shared* is a collection of the `queryKey` of ``(index_name,
+    query)`` pairs that are expected to be applied several times. Their
+    results are computed once, without candidate documents, and then
+    reused.
+
+    If *explanation* is a list, the steps taken are appended to it as
+    described in :meth:`zope.catalog.catalog.Catalog.explain`.
+
+    If *scored* is false, the scores of documents are of no interest,
+    which saves adding them up.
+    """
+
+    def __init__(self, catalog, shared=(), explanation=None, scored=True):
+        self.catalog = catalog
+        self.family = catalog.family
+        self._shared = dict.fromkeys(shared, _NOT_APPLIED)
+        self.explanation = explanation
+        self.scored = scored
+
+    def extent(self):
+        """Return the set of all documents in the catalog."""
+        extent = self.catalog._extent
+        if extent is None:
+            raise ValueError(
+                "The catalog does not keep track of its documents yet; "
+                "call updateIndexes() first.")
+        return extent
+
+    def estimate(self, index_name, query):
+        """Estimate the number of documents an index query matches.
+
+        Returns ``None`` if the index can't tell.
+        """
+        index = self.catalog[index_name]
+        estimate = None
+        if IIndexEstimate.providedBy(index):
+            estimate = index.estimate(query)
+        if self.explanation is not None:
+            self.explanation.append({
+                'step': 'estimate',
+                'index': index_name,
+                'query': query,
+                'estimate': estimate,
+            })
+        return estimate
+
+    def apply(self, index_name, query, restrict_to=None):
+        """Apply a query to an index.
+
+        The index is only passed the candidate documents if it
+        supports it, so the result may contain other documents.
+        """
+        if self.explanation is None:
+            return self._apply(index_name, query, restrict_to)[0]
+        start = time.perf_counter()
+        result, candidates, shared = self._apply(
+            index_name, query, restrict_to)
+        elapsed = time.perf_counter() - start
+        self.explanation.append({
+            'step': 'apply',
+            'index': index_name,
+            'query': query,
+            'candidates': None if candidates is None else len(candidates),
+            'shared': shared,
+            'size': None if result is None else len(result),
+            'time': elapsed,
+        })
+        return result
+
+    def restricts(self, index_name, query):
+        """Return whether applying a query to an index only returns
+        candidate documents.
+        """
+        return (not self._isShared(index_name, query) and
+                IRestrictedIndexSearch.providedBy(self.catalog[index_name]))
+
+    def _sharedKey(self, index_name, query):
+        try:
+            return queryKey((index_name, query))
+        except TypeError:
+            return None
+
+    def _isShared(self, index_name, query):
+        return bool(self._shared and
+                    self._sharedKey(index_name, query) in self._shared)
+
+    def _apply(self, index_name, query, restrict_to):
+        # Returns the result, the candidates passed to the index and
+        # whether the result is shared.
+        index = self.catalog[index_name]
+        if self._isShared(index_name, query):
+            key = self._sharedKey(index_name, query)
+            result = self._shared[key]
+            if result is _NOT_APPLIED:
+                result = self._shared[key] = index.apply(query)
+            return result, None, True
+        if (restrict_to is not None and
+                IRestrictedIndexSearch.providedBy(index)):
+            result = index.apply(query, restrict_to=restrict_to)
+            return result, restrict_to, False
+        return index.apply(query), None, False
+
+    def intersection(self, a, b):
+        """Return the weighted intersection of *a* and *b*."""
+        return self._combine('intersection', a, b)
+
+    def union(self, a, b):
+        """Return the weighted union of *a* and *b*."""
+        return self._combine('union', a, b)
+
+    def difference(self, a, b):
+        """Return the documents in *a* that are not in *b*."""
+        return self._combine('difference', a, b)
+
+    def intersects(self, a, b):
+        """Return whether *a* and *b* have a document in common.
+
+        Instead of merging the sets, this leaps to the next document
+        of each set that may be in the other one, and stops at the
+        first common document.
+        """
+        if not a or not b:
+            return False
+        x = a.minKey()
+        while True:
+            try:
+                y = b.minKey(x)
+                if y == x:
+                    return True
+                x = a.minKey(y)
+            except ValueError:
+                # no documents left
+                return False
+
+    def intersectionSize(self, a, b):
+        """Return the number of documents *a* and *b* have in common."""
+        if len(a) > len(b):
+            a, b = b, a
+        if len(a) * _PROBE_RATIO < len(b):
+            return sum(1 for docid in a if docid in b)
+        return len(self.family.IF.intersection(a, b))
+
+    def _combine(self, step, a, b):
+        IF = self.family.IF
+        start = time.perf_counter()
+        if step == 'intersection':
+            if self.scored:
+                _, result = IF.weightedIntersection(a, b)
+            else:
+                result = IF.intersection(a, b)
+        elif step == 'union':
+            if self.scored:
+                _, result = IF.weightedUnion(a, b)
+            else:
+                result = IF.union(a, b)
+        else:
+            result = IF.difference(a, b)
+        elapsed = time.perf_counter() - start
+        if self.explanation is not None:
+            self.explanation.append({
+                'step': step,
+                'sizes': (len(a), len(b)),
+                'size': len(result),
+                'time': elapsed,
+            })
+        return result
+
+
+class Query:
+    """Base class for catalog queries.
+
+    Subclasses implement `apply` and `estimate`.
+    """
+
+    def apply(self, context, restrict_to=None):
+        """Return the documents matching this query.
+
+        Like :meth:`zope.index.interfaces.IIndexSearch.apply`, this
+        returns ``None`` if the query doesn't apply. If *restrict_to*
+        is given, only those candidate documents need to be
+        considered, but the result can contain others too.
+        """
+        raise NotImplementedError()
+
+    def estimate(self, context):
+        """Estimate the number of matching documents or return
+        ``None``."""
+        raise NotImplementedError()
+
+    def count(self, context):
+        """Return the number of matching documents.
+
+        Returns ``None`` if the query doesn't apply.
+        """
+        result = self.apply(context)
+        return None if result is None else len(result)
+
+    def exists(self, context):
+        """Return whether any document matches.
+
+        Returns ``None`` if the query doesn't apply.
+        """
+        result = self.apply(context)
+        return None if result is None else bool(result)
+
+    def restricts(self, context):
+        """Return whether `apply` only returns documents from
+        *restrict_to*."""
+        return False
+
+    def indexNames(self):
+        """Return the set of the names of the indexes queried."""
+        raise NotImplementedError()
+
+    def indexQueries(self):
+        """Return a list of the ``(index_name, query)`` pairs
+        applied."""
+        raise NotImplementedError()
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self.__dict__ == other.__dict__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(
+            self.__class__.__name__,
+            ', '.join(repr(arg) for arg in self._args()))
+
+
+class Term(Query):
+    """Apply *query* to the index named *index_name*."""
+
+    def __init__(self, index_name, query):
+        self.index_name = index_name
+        self.query = query
+
+    def _args(self):
+        return self.index_name, self.query
+
+    def apply(self, context, restrict_to=None):
+        return context.apply(self.index_name, self.query, restrict_to)
+
+    def estimate(self, context):
+        return context.estimate(self.index_name, self.query)
+
+    def restricts(self, context):
+        return context.restricts(self.index_name, self.query)
+
+    def indexNames(self):
+        return {self.index_name}
+
+    def indexQueries(self):
+        return [(self.index_name, self.query)]
+
+
+class AnyOf(Query):
+    """Match documents matching any of *queries* in the index named
+    *index_name*.
+
+    Unlike an :class:`Or` of :class:`Term` objects, the results are
+    merged without adding up their scores, which is cheaper.
+    """
+
+    def __init__(self, index_name, queries):
+        self.index_name = index_name
+        self.queries = tuple(queries)
+
+    def _args(self):
+        return self.index_name, self.queries
+
+    def apply(self, context, restrict_to=None):
+        results = []
+        for query in self.queries:
+            r = context.apply(self.index_name, query, restrict_to)
+            if r is not None:
+                results.append(r)
+        if not results and self.queries:
+            return None
+        return context.family.IF.multiunion(results)
+
+    def estimate(self, context):
+        total = 0
+        for query in self.queries:
+            estimate = context.estimate(self.index_name, query)
+            if estimate is None:
+                return None
+            total += estimate
+        return total
+
+    def restricts(self, context):
+        return all(context.restricts(self.index_name, query)
+                   for query in self.queries)
+
+    def indexNames(self):
+        return {self.index_name}
+
+    def indexQueries(self):
+        return [(self.index_name, query) for query in self.queries]
+
+
+class _Combination(Query):
+
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def _args(self):
+        return self.queries
+
+    def indexNames(self):
+        names = set()
+        for query in self.queries:
+            names.update(query.indexNames())
+        return names
+
+    def indexQueries(self):
+        return [index_query
+                for query in self.queries
+                for index_query in query.indexQueries()]
+
+
+class And(_Combination):
+    """Match documents matching all of *queries*.
+
+    The queries are evaluated from the most to the least selective;
+    evaluation stops as soon as no document can match any more.
+    Negated queries are subtracted from the result of the others.
+    """
+
+    def apply(self, context, restrict_to=None):
+        negated = [query.query for query in self.queries
+                   if isinstance(query, Not)]
+        result, last = self._intersect(context, restrict_to)
+        if last is not None:
+            result = context.intersection(result, last)
+        if negated:
+            if result is None:
+                result = (context.extent() if restrict_to is None
+                          else restrict_to)
+            for query in negated:
+                r = query.apply(context, result)
+                # a new set even if nothing is subtracted, rather than
+                # the extent or the candidates themselves
+                result = context.difference(
+                    result, context.family.IF.Set() if r is None else r)
+                if not result:
+                    break
+        # None if no applicable queries
+        return result
+
+    def count(self, context):
+        if self._negated():
+            return super().count(context)
+        result, last = self._intersect(context)
+        if last is not None:
+            return context.intersectionSize(result, last)
+        return None if result is None else len(result)
+
+    def exists(self, context):
+        if self._negated():
+            return super().exists(context)
+        result, last = self._intersect(context)
+        if last is not None:
+            return context.intersects(result, last)
+        return None if result is None else bool(result)
+
+    def _negated(self):
+        return any(isinstance(query, Not) for query in self.queries)
+
+    def _intersect(self, context, restrict_to=None):
+        # Apply the queries that aren't negated, from the most to the
+        # least selective. Returns two results whose intersection is
+        # the result; the last intersection is left to the caller, who
+        # may not need all of it. The second result is None if there's
+        # nothing left to intersect.
+        plan = []
+        for query in self.queries:
+            if isinstance(query, Not):
+                continue
+            estimate = query.estimate(context)
+            if estimate is None:
+                estimate = _UNKNOWN_ESTIMATE
+            plan.append((estimate, query))
+        plan.sort(key=lambda x: x[0])
+
+        result = last = None
+        for _, query in plan:
+            if last is not None:
+                result = context.intersection(result, last)
+                last = None
+                if not result:
+                    # no need to apply the remaining queries
+                    return result, None
+            r = query.apply(
+                context, restrict_to if result is None else result)
+            if r is None:
+                continue
+            if not r:
+                # empty results
+                return r, None
+            if result is None:
+                result = r
+            elif not context.scored and query.restricts(context):
+                # r only has documents from result already
+                result = r
+            else:
+                last = r
+        return result, last
+
+    def estimate(self, context):
+        estimates = [query.estimate(context) for query in self.queries
+                     if not isinstance(query, Not)]
+        estimates = [e for e in estimates if e is not None]
+        if not estimates:
+            return None
+        return min(estimates)
+
+
+class Or(_Combination):
+    """Match documents matching any of *queries*.
+
+    Scores of documents matching several queries are added up.
+    """
+
+    def apply(self, context, restrict_to=None):
+        result = None
+        for query in self.queries:
+            r = query.apply(context, restrict_to)
+            if r is None:
+                continue
+            if result is None:
+                result = r
+            else:
+                result = context.union(result, r)
+        return result
+
+    def estimate(self, context):
+        total = 0
+        for query in self.queries:
+            estimate = query.estimate(context)
+            if estimate is None:
+                return None
+            total += estimate
+        return total
+
+
+class Not(Query):
+    """Match documents not matching *query*.
+
+    On its own, this is evaluated against all documents in the
+    catalog; inside an :class:`And` it is subtracted from the result of
+    the other queries instead.
+    """
+
+    def __init__(self, query):
+        self.query = query
+
+    def _args(self):
+        return self.query,
+
+    def apply(self, context, restrict_to=None):
+        return And(self).apply(context, restrict_to)
+
+    def estimate(self, context):
+        return None
+
+    def indexNames(self):
+        return self.query.indexNames()
+
+    def indexQueries(self):
+        return self.query.indexQueries()
@@ -19,7 +19,11 @@ a catalog passes on events that it receives.
 import doctest
 import unittest
 
+import BTrees
+import transaction
 from BTrees.IFBTree import IFSet
+from persistent import Persistent
+from persistent.mapping import PersistentMapping
 from zope.component import eventtesting
 from zope.component import provideAdapter
 from zope.component import provideUtility
@@ -33,6 +37,7 @@ from zope.container.traversal import ContainerTraversable
 from zope.index.interfaces import IIndexSearch
 from zope.index.interfaces import IIndexSort
 from zope.index.interfaces import IInjection
+from zope.interface import Attribute
 from zope.interface import Interface
 from zope.interface import alsoProvides
 from zope.interface import implementer
@@ -52,6 +57,9 @@ from zope.traversing.testing import setUp as traversingSetUp
 from zope.catalog.catalog import Catalog
 from zope.catalog.field import FieldIndex
 from zope.catalog.interfaces import ICatalog
+from zope.catalog.interfaces import IIndexEstimate
+from zope.catalog.interfaces import IIndexGeneration
+from zope.catalog.interfaces import IIndexValue
 from zope.catalog.interfaces import INoAutoIndex
 from zope.catalog.interfaces import INoAutoReindex
 
@@ -83,6 +91,9 @@ class IntIdsStub:
     def getObject(self, uid):
         return self.objs[uid]
 
+    def queryObject(self, uid, default=None):
+        return self.objs.get(uid, default)
+
     def getId(self, ob):
         return self.ids[ob]
 
@@ -139,8 +150,9 @@ class Test(PlacelessSetup, unittest.TestCase):
     def test_family(self):
         catalog = Catalog()
         self.assertEqual(catalog.family, Catalog.family)
-        catalog = Catalog(family=self)
-        self.assertEqual(catalog.family, self)
+        catalog = Catalog(family=BTrees.family64)
+        self.assertEqual(catalog.family, BTrees.family64)
+        self.assertIsInstance(catalog._extent, BTrees.family64.IF.TreeSet)
 
     def test_catalog_add_del_indexes(self):
         catalog = Catalog()
@@ -266,6 +278,1247 @@ class Test(PlacelessSetup, unittest.TestCase):
         self.assertIsNone(res)
 
 
+@implementer(IIndexEstimate)
+class EstimatingStubIndex(StubIndex):
+    """A stub index that records when it is applied."""
+
+    def __init__(self, field_name, estimate=None):
+        super().__init__(field_name)
+        self._estimate = estimate
+        self.applied = []
+
+    def estimate(self, term):
+        return self._estimate
+
+    def apply(self, term):
+        self.applied.append(term)
+        return super().apply(term)
+
+
+class TestQueryPlanning(PlacelessSetup, unittest.TestCase):
+
+    def _makeCatalog(self):
+        catalog = Catalog()
+        catalog['simiantype'] = FieldIndex('simiantype')
+        catalog['name'] = EstimatingStubIndex('name', 1000)
+        for docid, (simiantype, name) in enumerate([
+                ('monkey', 'bobo'), ('monkey', 'bubbles'),
+                ('bonobo', 'bobo'), ('punyhuman', 'kev')]):
+            catalog.index_doc(docid, stoopid(simiantype=simiantype,
+                                             name=name))
+        return catalog
+
+    def test_field_estimate(self):
+        index = self._makeCatalog()['simiantype']
+        self.assertEqual(index.estimate(('monkey', 'monkey')), 2)
+        self.assertEqual(index.estimate(('ape', 'ape')), 0)
+        self.assertEqual(index.estimate(('a', 'z')), 4)
+        self.assertEqual(index.estimate((None, None)), 4)
+        self.assertIsNone(index.estimate('monkey'))
+
+        # the documents of frequent values are only counted up to a
+        # limit, without loading all of them
+        for docid in range(10, 1000):
+            index.index_doc(docid, stoopid(simiantype='monkey'))
+        self.assertIsInstance(index._fwd_index['monkey'],
+                              index.family.IF.TreeSet)
+        index.estimate_limit = 100
+        self.assertEqual(index.estimate(('monkey', 'monkey')), 100)
+
+    def test_keyword_estimate(self):
+        from zope.catalog.keyword import CaseInsensitiveKeywordIndex
+        index = CaseInsensitiveKeywordIndex('tags')
+        index.index_doc(1, stoopid(tags=['a', 'b']))
+        index.index_doc(2, stoopid(tags=['A']))
+        self.assertEqual(index.estimate(['a']), 2)
+        self.assertEqual(index.estimate('B'), 1)
+        self.assertEqual(index.estimate(['a', 'b']), 1)
+        self.assertEqual(
+            index.estimate({'query': ['a', 'b'], 'operator': 'or'}), 2)
+        self.assertEqual(index.estimate([]), 0)
+        self.assertIsNone(index.estimate({'operator': 'or'}))
+        index.estimate_limit = 1
+        self.assertEqual(
+            index.estimate({'query': ['a', 'b'], 'operator': 'or'}), 2)
+        self.assertEqual(index.estimate(['a', 'c']), 0)
+
+    def test_text_estimate(self):
+        from zope.catalog.text import TextIndex
+        index = TextIndex('text', field_callable=False, interface=None)
+        index.index_doc(1, stoopid(text='hello world'))
+        self.assertEqual(index.estimate('hello'), 1)
+
+    def test_apply_most_selective_first(self):
+        catalog = self._makeCatalog()
+        res = catalog.apply({'name': 'bobo',
+                             'simiantype': ('bonobo', 'bonobo')})
+        self.assertEqual(list(res), [2])
+        self.assertEqual(catalog['name'].applied, ['bobo'])
+
+    def test_apply_stops_when_empty(self):
+        catalog = self._makeCatalog()
+        res = catalog.apply({'name': 'bobo',
+                             'simiantype': ('ape', 'ape')})
+        self.assertEqual(len(res), 0)
+        self.assertEqual(catalog['name'].applied, [])
+
+        catalog['other'] = EstimatingStubIndex('name', 2000)
+        catalog['other'].doc.update(catalog['name'].doc)
+        res = catalog.apply({'name': 'bobo', 'other': 'kev'})
+        self.assertEqual(len(res), 0)
+        self.assertEqual(catalog['name'].applied, ['bobo'])
+
+    def test_apply_unknown_estimate_last(self):
+        catalog = self._makeCatalog()
+        catalog['name']._estimate = None
+        catalog['other'] = EstimatingStubIndex('simiantype', 2000)
+        res = catalog.apply({'name': 'bobo', 'other': 'ape'})
+        self.assertEqual(len(res), 0)
+        self.assertEqual(catalog['name'].applied, [])
+
+
+class TestRestrictedSearch(PlacelessSetup, unittest.TestCase):
+
+    def test_field_index(self):
+        index = FieldIndex('age')
+        for docid in range(100):
+            index.index_doc(docid, stoopid(age=docid % 10))
+        restrict_to = IFSet([3, 13, 14, 50])
+        self.assertEqual(len(index.apply((3, 3))), 10)
+        self.assertEqual(list(index.apply((3, 3), restrict_to=restrict_to)),
+                         [3, 13])
+        self.assertEqual(list(index.apply((11, 11), restrict_to)), [])
+        # a small candidate set is scanned
+        self.assertEqual(list(index.apply((None, 3), restrict_to)),
+                         [3, 13, 50])
+        self.assertEqual(list(index.apply((4, None), restrict_to)),
+                         [14])
+        restrict_to.insert(1000)
+        self.assertEqual(list(index.apply((0, 4), restrict_to)),
+                         [3, 13, 14, 50])
+        # a large one is intersected with the whole range
+        restrict_to = IFSet(range(0, 100, 2))
+        self.assertEqual(list(index.apply((2, 3), restrict_to)),
+                         list(range(2, 100, 10)))
+        with self.assertRaises(TypeError):
+            index.apply(3, restrict_to)
+
+    def test_keyword_index(self):
+        from zope.catalog.keyword import KeywordIndex
+        index = KeywordIndex('tags')
+        index.index_doc(1, stoopid(tags=['a', 'b']))
+        index.index_doc(2, stoopid(tags=['a']))
+        index.index_doc(3, stoopid(tags=['b', 'c']))
+        restrict_to = IFSet([1, 3])
+        self.assertEqual(list(index.apply('a')), [1, 2])
+        self.assertEqual(list(index.apply('a', restrict_to=restrict_to)),
+                         [1])
+        self.assertEqual(list(index.apply(['a', 'c'], restrict_to)), [])
+        self.assertEqual(list(index.apply([], restrict_to)), [])
+        self.assertEqual(
+            list(index.apply({'query': ['a', 'c'], 'operator': 'or'},
+                             restrict_to)),
+            [1, 3])
+        with self.assertRaises(TypeError):
+            index.apply({'query': 'a', 'operator': 'xor'}, restrict_to)
+
+    def test_text_index(self):
+        from zope.catalog.text import TextIndex
+        index = TextIndex('text', field_callable=False, interface=None)
+        index.index_doc(1, stoopid(text='the quick brown fox'))
+        index.index_doc(2, stoopid(text='the lazy dog'))
+        index.index_doc(3, stoopid(text='quick quick dog'))
+        unrestricted = index.apply('quick or dog')
+        restricted = index.apply('quick or dog', restrict_to=IFSet([2, 3]))
+        self.assertEqual(list(restricted.items()),
+                         [(2, unrestricted[2]), (3, unrestricted[3])])
+        self.assertEqual(
+            list(index.apply('"quick brown" and not dog',
+                             restrict_to=IFSet([1, 3]))),
+            [1])
+        self.assertEqual(list(index.apply('fox*', restrict_to=IFSet([2]))),
+                         [])
+        from zope.catalog.text import _RestrictedSearch
+        self.assertIsNone(
+            _RestrictedSearch(index.index, IFSet([1])).search('the'))
+
+        # other indexes are searched completely and restricted
+        from zope.index.text.cosineindex import CosineIndex
+        from zope.index.text.lexicon import Lexicon
+        from zope.index.text.lexicon import Splitter
+        from zope.index.text.lexicon import StopWordRemover
+        lexicon = Lexicon(Splitter(), StopWordRemover())
+        index = TextIndex('text', field_callable=False, interface=None,
+                          lexicon=lexicon, index=CosineIndex(lexicon))
+        index.index_doc(1, stoopid(text='the quick brown fox'))
+        index.index_doc(2, stoopid(text='quick quick dog'))
+        unrestricted = index.apply('qu* or dog')
+        self.assertEqual(
+            list(index.apply('qu* or dog', restrict_to=IFSet([2])).items()),
+            [(2, unrestricted[2])])
+        self.assertIsNone(
+            _RestrictedSearch(index.index, IFSet([1])).search('the'))
+
+    def test_text_index_scores_candidates(self):
+        from unittest import mock
+
+        import zope.index.text.okapiindex
+
+        from zope.catalog.text import TextIndex
+        index = TextIndex('text', field_callable=False, interface=None)
+        for docid in range(1, 41):
+            index.index_doc(docid, stoopid(
+                text='fox ' * (docid % 3 + 1) + 'dog ' * (docid % 5)))
+        for query in ('fox', 'dog and fox', 'do* or cat', 'cat', '"fox dog"'):
+            unrestricted = index.apply(query)
+            for ratio in (0, 0.1, 1):
+                index.restrict_scan_ratio = ratio
+                restricted = index.apply(query, restrict_to=IFSet([2, 3, 4]))
+                self.assertEqual(
+                    list(restricted.items()),
+                    [(docid, unrestricted[docid])
+                     for docid in (2, 3, 4) if docid in unrestricted])
+
+        # the same scores without the C scoring function
+        OkapiIndex = zope.index.text.okapiindex.OkapiIndex
+        with mock.patch.object(zope.index.text.okapiindex, 'score', None), \
+                mock.patch.object(OkapiIndex, '_search_wids',
+                                  OkapiIndex._python_search_wids):
+            unrestricted = index.apply('dog or fox')
+            restricted = index.apply('dog or fox', restrict_to=IFSet([5]))
+        self.assertEqual(list(restricted.items()), [(5, unrestricted[5])])
+
+    def test_catalog_passes_candidates(self):
+        catalog = Catalog()
+        catalog['age'] = FieldIndex('age')
+        catalog['color'] = FieldIndex('color')
+        for docid in range(10):
+            catalog.index_doc(docid, stoopid(age=docid, color='red'))
+        calls = []
+        apply = catalog['color'].apply
+
+        def recording_apply(query, restrict_to=None):
+            calls.append(restrict_to)
+            return apply(query, restrict_to=restrict_to)
+        catalog['color'].apply = recording_apply
+
+        res = catalog.apply({'age': (4, 4), 'color': ('red', 'red')})
+        self.assertEqual(list(res), [4])
+        self.assertEqual([list(r) for r in calls], [[4]])
+
+
+class TestQueries(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        from zope.catalog.keyword import KeywordIndex
+        catalog = self.catalog = Catalog()
+        catalog['simiantype'] = FieldIndex('simiantype')
+        catalog['name'] = FieldIndex('name')
+        catalog['tags'] = KeywordIndex('tags')
+        for docid, (simiantype, name, tags) in enumerate([
+                ('monkey', 'bobo', ['a']),
+                ('monkey', 'bubbles', ['a', 'b']),
+                ('bonobo', 'bobo', ['b']),
+                ('punyhuman', 'kev', ['c'])]):
+            catalog.index_doc(docid, stoopid(
+                simiantype=simiantype, name=name, tags=tags))
+
+    def _apply(self, query):
+        return sorted(self.catalog.apply(query))
+
+    def test_term(self):
+        from zope.catalog.query import Term
+        self.assertEqual(self._apply(Term('name', ('bobo', 'bobo'))), [0, 2])
+        with self.assertRaises(KeyError):
+            self._apply(Term('hat', 'beret'))
+
+    def test_and(self):
+        from zope.catalog.query import And
+        from zope.catalog.query import Term
+        self.assertEqual(
+            self._apply(And(Term('name', ('bobo', 'bobo')),
+                            Term('simiantype', ('monkey', 'monkey')))),
+            [0])
+        self.assertEqual(
+            self._apply(And(Term('name', ('bobo', 'bobo')),
+                            Term('simiantype', ('ape', 'ape')))),
+            [])
+        self.assertEqual(
+            self._apply(And(Term('name', ('bobo', 'bobo')),
+                            Term('tags', 'c'))),
+            [])
+        self.assertIsNone(self.catalog.apply(And()))
+
+    def test_or(self):
+        from zope.catalog.query import Or
+        from zope.catalog.query import Term
+        query = (Term('name', ('kev', 'kev')) |
+                 Term('tags', {'query': ['b'], 'operator': 'or'}))
+        self.assertIsInstance(query, Or)
+        self.assertEqual(self._apply(query), [1, 2, 3])
+        self.assertEqual(
+            self._apply(Term('name', ('bobo', 'bobo')) | Term('tags', 'a')),
+            [0, 1, 2])
+        self.assertIsNone(self.catalog.apply(Or()))
+
+    def test_not(self):
+        from zope.catalog.query import Not
+        from zope.catalog.query import SearchContext
+        from zope.catalog.query import Term
+        query = ~Term('name', ('bobo', 'bobo'))
+        self.assertIsInstance(query, Not)
+        self.assertEqual(self._apply(query), [1, 3])
+        self.assertEqual(
+            self._apply(Term('tags', 'b') & ~Term('name', ('bobo', 'bobo'))),
+            [1])
+        self.assertEqual(
+            self._apply(Term('tags', 'a') & ~Term('tags', 'a')), [])
+        self.assertEqual(
+            self._apply(Term('tags', 'a') & ~Term('tags', 'z')), [0, 1])
+        # the results are new sets even if nothing is subtracted
+        result = self.catalog.apply(~Term('tags', 'z'))
+        self.assertEqual(list(result), [0, 1, 2, 3])
+        self.assertIsNot(result, self.catalog._extent)
+        candidates = self.catalog.family.IF.Set([0, 1])
+        result = Not(Term('tags', 'z')).apply(
+            SearchContext(self.catalog), candidates)
+        self.assertEqual(list(result), [0, 1])
+        self.assertIsNot(result, candidates)
+
+    def test_not_restricted(self):
+        from zope.catalog.query import Not
+        from zope.catalog.query import Or
+        from zope.catalog.query import Term
+
+        # Not inside an Or is evaluated against the Or's candidates
+        query = Term('tags', 'b') & Or(Not(Term('name', ('bobo', 'bobo'))))
+        self.assertEqual(self._apply(query), [1])
+
+    def test_any_of(self):
+        from zope.catalog.query import AnyOf
+        from zope.catalog.query import Term
+        query = AnyOf('name', [('bobo', 'bobo'), ('kev', 'kev')])
+        self.assertEqual(self._apply(query), [0, 2, 3])
+        self.assertEqual(self._apply(AnyOf('name', [])), [])
+
+        class BadIndex:
+            def apply(self, _q):
+                return None
+        self.catalog['stub'] = BadIndex()
+        self.assertIsNone(self.catalog.apply(AnyOf('stub', ['foo'])))
+        self.assertEqual(repr(AnyOf('stub', ['foo'])),
+                         "AnyOf('stub', ('foo',))")
+        self.assertEqual(
+            self._apply(Term('stub', 'foo') | Term('name', ('kev', 'kev'))),
+            [3])
+
+    def test_estimate(self):
+        from zope.catalog.query import AnyOf
+        from zope.catalog.query import SearchContext
+        from zope.catalog.query import Term
+        context = SearchContext(self.catalog)
+        bobo = Term('name', ('bobo', 'bobo'))
+        self.assertEqual(bobo.estimate(context), 2)
+        self.assertEqual(
+            AnyOf('name', [('bobo', 'bobo'), ('kev', 'kev')]).estimate(
+                context),
+            3)
+        self.assertEqual((bobo | Term('tags', 'a')).estimate(context), 4)
+        self.assertEqual((bobo & Term('tags', 'c')).estimate(context), 1)
+        self.assertIsNone((~bobo).estimate(context))
+        self.assertIsNone((bobo | ~bobo).estimate(context))
+        self.assertEqual((bobo & ~bobo).estimate(context), 2)
+        self.assertIsNone((~bobo & ~bobo).estimate(context))
+
+        self.catalog['stub'] = StubIndex('name')
+        self.assertIsNone(Term('stub', 'bobo').estimate(context))
+        self.assertIsNone(AnyOf('stub', ['bobo']).estimate(context))
+
+    def test_base(self):
+        from zope.catalog.query import Query
+        query = Query()
+        with self.assertRaises(NotImplementedError):
+            query.apply(None)
+        with self.assertRaises(NotImplementedError):
+            query.estimate(None)
+        with self.assertRaises(NotImplementedError):
+            query.indexNames()
+        with self.assertRaises(NotImplementedError):
+            query.indexQueries()
+
+    def test_index_names(self):
+        from zope.catalog.query import AnyOf
+        from zope.catalog.query import Term
+        query = (AnyOf('name', []) | Term('tags', 'a')) & ~Term('other', 1)
+        self.assertEqual(query.indexNames(), {'name', 'tags', 'other'})
+        query = AnyOf('name', [1, 2]) | ~Term('tags', 'a')
+        self.assertEqual(query.indexQueries(),
+                         [('name', 1), ('name', 2), ('tags', 'a')])
+
+    def test_repr_and_equality(self):
+        from zope.catalog.query import Term
+        query = Term('name', ('a', 'a')) & ~Term('tags', 'b')
+        self.assertEqual(
+            repr(query),
+            "And(Term('name', ('a', 'a')), Not(Term('tags', 'b')))")
+        self.assertEqual(query,
+                         Term('name', ('a', 'a')) & ~Term('tags', 'b'))
+        self.assertNotEqual(query, Term('name', ('a', 'a')))
+
+    def test_extent(self):
+        catalog = self.catalog
+        self.assertEqual(list(catalog._extent), [0, 1, 2, 3])
+        catalog.unindex_doc(1)
+        catalog.unindex_doc(1)
+        self.assertEqual(list(catalog._extent), [0, 2, 3])
+        catalog.clear()
+        self.assertEqual(list(catalog._extent), [])
+
+    def test_legacy_catalog_without_extent(self):
+        from zope.catalog.query import Term
+        uidutil = IntIdsStub()
+        provideUtility(uidutil, IIntIds)
+        uidutil.register(stoopid(name='bobo'))
+        uidutil.register(stoopid(name='kev'))
+        catalog = self.catalog
+        del catalog._extent
+        catalog.clear()
+        catalog.index_doc(1, stoopid(name='bobo'))
+        catalog.unindex_doc(1)
+        with self.assertRaises(ValueError):
+            catalog.apply(~Term('name', ('bobo', 'bobo')))
+        catalog.updateIndexes()
+        self.assertEqual(list(catalog._extent), [1, 2])
+        self.assertEqual(
+            list(catalog.apply(~Term('name', ('bobo', 'bobo')))), [2])
+
+    def test_searchResults(self):
+        from zope.catalog.query import Term
+        uidutil = IntIdsStub()
+        provideUtility(uidutil, IIntIds)
+        for _ in range(4):
+            uidutil.register(object())
+        res = self.catalog.searchResults(_query=~Term('tags', 'a'))
+        self.assertEqual(len(res), 2)
+        res = self.catalog.searchResults(_query=~Term('tags', 'a'),
+                                         name=('kev', 'kev'))
+        self.assertEqual([uidutil.getId(ob) for ob in res], [3])
+
+
+class SimianCatalogSetup(PlacelessSetup):
+    """Sets up a catalog of simians with estimating stub indexes and
+    an int-id utility."""
+
+    def setUp(self):
+        super().setUp()
+        self.uidutil = IntIdsStub()
+        provideUtility(self.uidutil, IIntIds)
+        catalog = self.catalog = Catalog()
+        catalog['simiantype'] = EstimatingStubIndex('simiantype', 10)
+        catalog['name'] = EstimatingStubIndex('name', 5)
+        for simiantype, name in [('monkey', 'bobo'), ('monkey', 'bubbles'),
+                                 ('bonobo', 'bobo'), ('punyhuman', 'kev')]:
+            ob = stoopid(simiantype=simiantype, name=name)
+            catalog.index_doc(self.uidutil.register(ob), ob)
+
+
+class TestSearchMany(SimianCatalogSetup, unittest.TestCase):
+
+    def _ids(self, results):
+        return [self.uidutil.getId(ob) for ob in results]
+
+    def test_shared_index_queries(self):
+        from zope.catalog.query import Term
+        results = self.catalog.searchMany([
+            {'name': 'bobo', 'simiantype': 'monkey'},
+            {'name': 'bobo', 'simiantype': 'bonobo'},
+            {'_query': Term('name', 'bobo') | Term('name', 'kev'),
+             '_limit': 2},
+            {'name': 'kev'},
+        ])
+        self.assertEqual([self._ids(r) for r in results],
+                         [[1], [3], [1, 3], [4]])
+        self.assertEqual(self.catalog['name'].applied, ['bobo', 'kev'])
+        self.assertEqual(self.catalog['simiantype'].applied,
+                         ['monkey', 'bonobo'])
+
+    def test_unhashable_index_queries(self):
+        results = self.catalog.searchMany([
+            {'name': ['bobo']},
+            {'name': ['bobo']},
+            {'name': {'bobo': bytearray()}},
+            {'name': {'bobo': bytearray()}},
+        ])
+        self.assertEqual([len(r) for r in results], [0, 0, 0, 0])
+        self.assertEqual(len(self.catalog['name'].applied), 3)
+
+    def test_not_applicable(self):
+        class BadIndex:
+            def apply(self, _q):
+                return None
+        self.catalog['stub'] = BadIndex()
+        self.assertEqual(self.catalog.searchMany([{'stub': 'foo'}]), [None])
+        self.assertEqual(self.catalog.searchMany([]), [])
+
+
+class TestExplain(SimianCatalogSetup, unittest.TestCase):
+
+    def _steps(self, explanation, *keys):
+        return [tuple(step.get(key) for key in ('step',) + keys)
+                for step in explanation['steps']]
+
+    def test_explain(self):
+        explanation = self.catalog.explain(name='bobo', simiantype='monkey')
+        self.assertEqual(explanation['query'], {
+            'name': 'bobo', 'simiantype': 'monkey'})
+        self.assertEqual(
+            self._steps(explanation, 'index', 'size'),
+            [('estimate', 'name', None),
+             ('estimate', 'simiantype', None),
+             ('apply', 'name', 2),
+             ('apply', 'simiantype', 2),
+             ('intersection', None, 1)])
+        self.assertEqual(explanation['steps'][1]['estimate'], 10)
+        self.assertEqual(explanation['steps'][3]['candidates'], None)
+        self.assertEqual(explanation['steps'][4]['sizes'], (2, 2))
+        self.assertEqual(explanation['size'], 1)
+        self.assertGreaterEqual(explanation['apply_time'], 0)
+        self.assertGreaterEqual(explanation['sort_time'], 0)
+
+    def test_explain_combinations(self):
+        from zope.catalog.query import Term
+        query = ((Term('name', 'bobo') | Term('name', 'kev')) &
+                 ~Term('simiantype', 'bonobo'))
+        explanation = self.catalog.explain(_query=query)
+        self.assertEqual(
+            self._steps(explanation, 'size'),
+            [('estimate', None),
+             ('estimate', None),
+             ('apply', 2),
+             ('apply', 1),
+             ('union', 3),
+             ('apply', 1),
+             ('difference', 2)])
+        self.assertEqual(explanation['size'], 2)
+
+    def test_explain_not_applicable(self):
+        class BadIndex:
+            def apply(self, _q):
+                return None
+        self.catalog['stub'] = BadIndex()
+        explanation = self.catalog.explain(stub='foo')
+        self.assertEqual(self._steps(explanation, 'estimate', 'size'),
+                         [('estimate', None, None), ('apply', None, None)])
+        self.assertIsNone(explanation['size'])
+
+    def test_explain_shared(self):
+        from zope.catalog.query import SearchContext
+        from zope.catalog.query import queryKey
+        steps = []
+        context = SearchContext(self.catalog,
+                                shared=[queryKey(('name', 'bobo'))],
+                                explanation=steps)
+        context.apply('name', 'bobo')
+        context.apply('name', 'bobo')
+        self.assertEqual([step['shared'] for step in steps], [True, True])
+        self.assertEqual(self.catalog['name'].applied, ['bobo'])
+
+    def test_searchResults(self):
+        results = self.catalog.searchResults(name='bobo', _explain=True)
+        self.assertEqual(results.explanation['size'], 2)
+        self.assertNotIn('resolved', results.explanation)
+        self.assertEqual(len(list(results)), 2)
+        self.assertEqual(results.explanation['resolved'], 2)
+        self.assertGreaterEqual(results.explanation['resolve_time'], 0)
+
+    def test_searchResults_bypasses_cache(self):
+        self.catalog.cache_size = 10
+        self.catalog.searchResults(name='bobo', _explain=True)
+        self.assertEqual(self.catalog.cacheInfo()['misses'], 0)
+        results = self.catalog.searchResults(name='bobo')
+        self.assertIsNone(results.explanation)
+
+    def test_ignored(self):
+        catalog = self.catalog
+        self.assertEqual(catalog.count(name='bobo', _explain=True), 2)
+        self.assertTrue(catalog.exists(name='bobo', _explain=True))
+        [results] = catalog.searchMany([{'name': 'bobo', '_explain': True}])
+        self.assertEqual(len(results), 2)
+        self.assertIsNone(results.explanation)
+        self.assertEqual(catalog.explain(name='bobo', _explain=True)['size'],
+                         2)
+
+
+class TestPagination(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.catalog = Catalog()
+
+    def test_slice(self):
+        IF = self.catalog.family.IF
+        docids = list(range(1, 11))
+        scored = {docid: 1.0 for docid in docids}
+        _slice = self.catalog._slice
+        for container in (IF.Set(docids), IF.TreeSet(docids),
+                          IF.Bucket(scored), IF.BTree(scored),
+                          tuple(docids)):
+            self.assertEqual(_slice(container, 0, 3, False), [1, 2, 3])
+            self.assertEqual(_slice(container, 8, None, False), [9, 10])
+            self.assertEqual(_slice(container, 2, 4, True), [8, 7])
+            self.assertEqual(_slice(container, 8, 20, True), [2, 1])
+            self.assertEqual(_slice(container, 0, None, True),
+                             docids[::-1])
+            self.assertEqual(_slice(container, 10, None, False), [])
+            self.assertEqual(_slice(container, 12, 14, True), [])
+
+    def test_searchResults(self):
+        uidutil = IntIdsStub()
+        provideUtility(uidutil, IIntIds)
+        self.catalog['simiantype'] = StubIndex('simiantype', None)
+        for n in range(6):
+            ob = stoopid(simiantype='monkey')
+            self.catalog.index_doc(uidutil.register(ob), ob)
+
+        def search(**kw):
+            results = self.catalog.searchResults(simiantype='monkey', **kw)
+            return [uidutil.getId(ob) for ob in results]
+
+        self.assertEqual(search(_start=2, _limit=2), [3, 4])
+        self.assertEqual(search(_start=4), [5, 6])
+        self.assertEqual(search(_start=1, _limit=2, _reverse=True), [5, 4])
+        self.assertEqual(search(_start=6, _limit=2), [])
+
+        self.catalog.cache_size = 10
+        self.assertEqual(search(_start=0, _limit=2), [1, 2])
+        self.assertEqual(search(_start=2, _limit=2), [3, 4])
+
+
+class TestSorting(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.uidutil = IntIdsStub()
+        provideUtility(self.uidutil, IIntIds)
+        catalog = self.catalog = Catalog()
+        catalog['kind'] = StubIndex('kind')
+        catalog['date'] = FieldIndex('date')
+        catalog['title'] = FieldIndex('title')
+        for date, title in [(3, 'c'), (1, 'b'), (3, 'a'), (2, 'd'),
+                            (1, None), (None, 'e')]:
+            ob = stoopid(kind='doc', date=date, title=title)
+            catalog.index_doc(self.uidutil.register(ob), ob)
+
+    def _search(self, **kw):
+        results = self.catalog.searchResults(kind='doc', **kw)
+        return [self.uidutil.getId(ob) for ob in results]
+
+    def test_several_indexes(self):
+        sort_index = [('date', True), ('title', False)]
+        self.assertEqual(self._search(_sort_index=sort_index),
+                         [3, 1, 4, 2, 5, 6])
+        self.assertEqual(self._search(_sort_index=sort_index, _limit=3),
+                         [3, 1, 4])
+        self.assertEqual(
+            self._search(_sort_index=sort_index, _start=2, _limit=2),
+            [4, 2])
+        self.assertEqual(
+            self._search(_sort_index=sort_index, _reverse=True),
+            [2, 5, 4, 1, 3, 6])
+        self.assertEqual(
+            self._search(_sort_index=[('title', False)], _limit=2),
+            [3, 2])
+        self.assertEqual(self._search(_sort_index=[('title', True)]),
+                         [6, 4, 1, 2, 3, 5])
+        # ties keep the order of the docids
+        self.assertEqual(self._search(_sort_index=[('date', True)]),
+                         [1, 3, 4, 2, 5, 6])
+
+    def test_missing_values_last(self):
+        from zope.catalog.catalog import _MISSING
+        from zope.catalog.catalog import _SortKey
+        for reverse in ([False], [True]):
+            present = _SortKey((1,), reverse)
+            missing = _SortKey((_MISSING,), reverse)
+            self.assertTrue(present < missing)
+            self.assertFalse(missing < present)
+            self.assertFalse(missing < missing)
+
+    def test_value_lookup(self):
+        # FieldIndex provides IIndexSort, so hide it
+        index = self.catalog['date']
+        index.sort = None
+        index.__provides__ = IIndexValue
+        self.assertEqual(self._search(_sort_index='date'),
+                         [2, 5, 4, 1, 3, 6])
+
+    def test_ranked_by_sort(self):
+        @implementer(IIndexSort)
+        class SortingIndex(StubIndex):
+            def sort(self, docids, limit=None, reverse=False):
+                return sorted(docids, key=lambda docid: -docid)
+
+        self.catalog['rank'] = SortingIndex('rank')
+        self.assertEqual(
+            self._search(_sort_index=[('date', False), ('rank', False)]),
+            [5, 2, 4, 3, 1, 6])
+        # ranks can't tell equal values apart
+        with self.assertRaises(ValueError):
+            self._search(_sort_index=[('rank', False), ('date', False)])
+
+    def test_not_sortable(self):
+        with self.assertRaises(ValueError):
+            self._search(_sort_index=[('date', False), ('kind', False)])
+
+    def test_bad_sort_keys(self):
+        for sort_index in (['date', 'rank'], ['ab'], [('date',)],
+                           [('date', False, 'rank')]):
+            with self.assertRaisesRegex(ValueError, 'pairs'):
+                self._search(_sort_index=sort_index)
+
+    def test_cached(self):
+        self.catalog.cache_size = 10
+        del self.catalog['kind']
+        self.catalog['kind'] = FieldIndex('kind')
+        self.catalog.updateIndexes()
+        sort_index = [('date', False), ('title', True)]
+        self.catalog.searchResults(kind=('doc', 'doc'), _sort_index=sort_index)
+        self.catalog['title'].unindex_doc(3)
+        results = self.catalog.searchResults(
+            kind=('doc', 'doc'), _sort_index=sort_index)
+        self.assertEqual([self.uidutil.getId(ob) for ob in results],
+                         [2, 5, 4, 1, 3, 6])
+        self.assertEqual(self.catalog.cacheInfo()['hits'], 0)
+
+
+class TestFacets(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        from zope.catalog.keyword import KeywordIndex
+        super().setUp()
+        self.uidutil = IntIdsStub()
+        provideUtility(self.uidutil, IIntIds)
+        catalog = self.catalog = Catalog()
+        catalog['kind'] = StubIndex('kind')
+        catalog['color'] = FieldIndex('color')
+        catalog['tags'] = KeywordIndex('tags')
+        for kind, color, tags in [('doc', 'red', ['a', 'b']),
+                                  ('doc', 'blue', ['b']),
+                                  ('doc', 'red', ['c', 'b']),
+                                  ('doc', None, None),
+                                  ('img', 'red', ['a'])]:
+            ob = stoopid(kind=kind, color=color, tags=tags)
+            catalog.index_doc(self.uidutil.register(ob), ob)
+
+    def _facets(self, scan_cost, **kw):
+        for name in ('color', 'tags'):
+            self.catalog[name].facet_scan_cost = scan_cost
+        results = self.catalog.searchResults(kind='doc')
+        return self.catalog.facets(results, ['color', 'tags'], **kw)
+
+    def test_facets(self):
+        expected = {'color': [('red', 2), ('blue', 1)],
+                    'tags': [('b', 3), ('a', 1), ('c', 1)]}
+        # counted by intersecting the documents of each value
+        self.assertEqual(self._facets(1000), expected)
+        # counted by looking up the values of each document
+        self.assertEqual(self._facets(0), expected)
+        self.assertEqual(self._facets(10, limit=1),
+                         {'color': [('red', 2)], 'tags': [('b', 3)]})
+
+    def test_docids(self):
+        IF = self.catalog.family.IF
+        self.assertEqual(
+            self.catalog.facets(IF.TreeSet([1, 5]), ['color']),
+            {'color': [('red', 2)]})
+        self.assertEqual(
+            self.catalog.facets(self.catalog.apply({'kind': 'img'}),
+                                ['tags']),
+            {'tags': [('a', 1)]})
+        results = self.catalog.searchResults(kind='doc', _limit=2)
+        self.assertEqual(self.catalog.facets(results, ['color']),
+                         {'color': [('blue', 1), ('red', 1)]})
+
+    def test_not_supported(self):
+        with self.assertRaises(ValueError):
+            self.catalog.facets(IFSet([1]), ['kind'])
+
+    def test_documentValues(self):
+        from zope.catalog.facet import FacetIndexMixin
+        with self.assertRaises(NotImplementedError):
+            FacetIndexMixin()._documentValues(())
+
+
+class TestCountAndExists(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        catalog = self.catalog = Catalog()
+        catalog['name'] = EstimatingStubIndex('name', 5)
+        catalog['simiantype'] = EstimatingStubIndex('simiantype', 10)
+        catalog['kind'] = FieldIndex('simiantype')
+        for docid, (simiantype, name) in enumerate(
+                [('monkey', 'bobo'), ('monkey', 'bubbles'),
+                 ('bonobo', 'bobo'), ('punyhuman', 'kev')], 1):
+            catalog.index_doc(
+                docid, stoopid(simiantype=simiantype, name=name))
+
+    def test_count(self):
+        from zope.catalog.query import Term
+        count = self.catalog.count
+        self.assertEqual(count(name='bobo'), 2)
+        self.assertEqual(count(name='bobo', simiantype='monkey'), 1)
+        self.assertEqual(count(name='bobo', simiantype='punyhuman'), 0)
+        self.assertEqual(count(name='kev', simiantype='monkey'), 0)
+        self.assertEqual(count(name='bobo', kind=('monkey', 'monkey')), 1)
+        self.assertEqual(
+            count(_query=Term('name', 'bobo') | Term('name', 'kev'),
+                  _limit=1),
+            3)
+        self.assertEqual(
+            count(_query=Term('name', 'bobo') & ~Term('kind', ('b', 'c'))),
+            1)
+
+    def test_exists(self):
+        from zope.catalog.query import AnyOf
+        from zope.catalog.query import Term
+        exists = self.catalog.exists
+        self.assertTrue(exists(name='bobo'))
+        self.assertFalse(exists(name='doc'))
+        self.assertTrue(exists(name='bobo', simiantype='bonobo'))
+        self.assertFalse(exists(name='kev', simiantype='monkey'))
+        self.assertTrue(exists(
+            _query=AnyOf('kind', [('bonobo', 'bonobo'),
+                                  ('punyhuman', 'punyhuman')]),
+            name='kev'))
+        self.assertFalse(
+            exists(_query=Term('name', 'kev') & ~Term('name', 'kev')))
+
+    def test_not_applicable(self):
+        class BadIndex:
+            def apply(self, _q):
+                return None
+        self.catalog['stub'] = BadIndex()
+        self.assertIsNone(self.catalog.count(stub='foo'))
+        self.assertIsNone(self.catalog.exists(stub='foo'))
+        self.assertEqual(self.catalog.count(stub='foo', name='bobo'), 2)
+
+    def test_restricted_results_are_not_intersected(self):
+        from zope.catalog.query import AnyOf
+        from zope.catalog.query import SearchContext
+        from zope.catalog.query import Term
+
+        # apply the index that can't be restricted first
+        self.catalog['name']._estimate = 1
+        for query in [
+                Term('name', 'bobo') & Term('kind', ('monkey', 'monkey')),
+                Term('name', 'bobo') & AnyOf('kind', [('monkey', 'monkey')]),
+        ]:
+            steps = []
+            context = SearchContext(
+                self.catalog, explanation=steps, scored=False)
+            self.assertEqual(query.count(context), 1)
+            self.assertNotIn('intersection',
+                             [step['step'] for step in steps])
+            self.assertFalse(query.restricts(context))
+
+    def test_several_intersections(self):
+        from zope.catalog.query import Term
+        query = (Term('name', 'bobo') & Term('simiantype', 'monkey') &
+                 Term('kind', ('a', 'z')))
+        self.assertEqual(self.catalog.count(_query=query), 1)
+        self.assertEqual(self.catalog.count(
+            name='bobo', simiantype='monkey', kind=('p', 'q')), 0)
+
+    def test_intersects(self):
+        from zope.catalog.query import SearchContext
+        intersects = SearchContext(self.catalog).intersects
+        self.assertFalse(intersects(IFSet(), IFSet([1])))
+        self.assertFalse(intersects(IFSet([1, 3, 5]), IFSet([2, 4, 6])))
+        self.assertFalse(intersects(IFSet([1, 2]), IFSet([3, 4])))
+        self.assertTrue(intersects(IFSet([1, 3, 5]), IFSet([2, 5])))
+
+    def test_intersectionSize(self):
+        from zope.catalog.query import SearchContext
+        size = SearchContext(self.catalog).intersectionSize
+        IF = self.catalog.family.IF
+        many = IF.TreeSet(range(100))
+        self.assertEqual(size(many, IFSet([5, 200])), 1)
+        self.assertEqual(size(IFSet(range(50, 150)), many), 50)
+
+
+class PrefetchingJar:
+    """A stub for a ZODB connection that can prefetch."""
+
+    def __init__(self):
+        self.prefetched = []
+
+    def prefetch(self, *args):
+        self.prefetched.append([ob._p_oid for arg in args for ob in arg])
+
+
+class TestResultSet(unittest.TestCase):
+
+    def _ghost(self, oid, jar):
+        ob = Persistent()
+        ob._p_oid = oid
+        ob._p_jar = jar
+        ob._p_deactivate()
+        return ob
+
+    def test_batches(self):
+        from zope.catalog.catalog import ResultSet
+        jar = PrefetchingJar()
+        other_jar = PrefetchingJar()
+        loaded = Persistent()
+        loaded._p_oid = b'f'
+        loaded._p_jar = jar
+        obs = [self._ghost(oid, jar) for oid in [b'a', b'b', b'c', b'd']]
+        obs += [loaded, self._ghost(b'e', jar), Persistent(),
+                self._ghost(b'g', other_jar), stoopid(),
+                self._ghost(b'h', object())]
+        uidutil = IntIdsStub()
+        for ob in obs:
+            uidutil.register(ob)
+
+        results = ResultSet(IFSet(range(1, len(obs) + 1)), uidutil)
+        results.batch_size = 4
+        iterator = iter(results)
+        self.assertIs(next(iterator), obs[0])
+        self.assertEqual(jar.prefetched, [[b'a', b'b', b'c', b'd']])
+        self.assertEqual(list(iterator), obs[1:])
+        self.assertEqual(jar.prefetched,
+                         [[b'a', b'b', b'c', b'd'], [b'e']])
+        self.assertEqual(other_jar.prefetched, [[b'g']])
+
+    def _countingUidutil(self, count):
+        uidutil = IntIdsStub()
+        for n in range(count):
+            uidutil.register(stoopid(n=n))
+        uidutil.looked_up = []
+
+        def getObject(uid):
+            uidutil.looked_up.append(uid)
+            return uidutil.objs[uid]
+        uidutil.getObject = getObject
+        return uidutil
+
+    def test_getitem(self):
+        from zope.catalog.catalog import ResultSet
+        IF = BTrees.family32.IF
+        uidutil = self._countingUidutil(10)
+        docids = list(range(1, 11))
+        for uids in (IF.Set(docids), IF.TreeSet(docids),
+                     IF.Bucket(dict.fromkeys(docids, 1.0)),
+                     IF.BTree(dict.fromkeys(docids, 1.0)),
+                     docids, iter(docids)):
+            uidutil.looked_up = []
+            results = ResultSet(uids, uidutil)
+            self.assertEqual(results[0].n, 0)
+            self.assertEqual(results[-1].n, 9)
+            self.assertEqual([ob.n for ob in results[2:5]], [2, 3, 4])
+            self.assertEqual([ob.n for ob in results[8:2:-3]], [8, 5])
+            self.assertEqual(results[20:], [])
+            self.assertEqual(uidutil.looked_up, [1, 10, 3, 4, 5, 9, 6])
+            with self.assertRaises(IndexError):
+                results[10]
+            # the uids are made a sequence only once
+            self.assertIs(results._uidSequence(), results._uidSequence())
+
+    def test_resolved_objects_are_kept(self):
+        from zope.catalog.catalog import ResultSet
+        uidutil = self._countingUidutil(5)
+        explanation = {}
+        results = ResultSet(IFSet(range(1, 6)), uidutil, explanation)
+        results.cache_size = 2
+        results[0]
+        results[1]
+        results[0]
+        self.assertEqual(uidutil.looked_up, [1, 2])
+        results[2]
+        results[0]
+        self.assertEqual(uidutil.looked_up, [1, 2, 3])
+        results[1]
+        self.assertEqual(uidutil.looked_up, [1, 2, 3, 2])
+        self.assertEqual([ob.n for ob in results], [0, 1, 2, 3, 4])
+        self.assertEqual(uidutil.looked_up, [1, 2, 3, 2, 3, 4, 5])
+        self.assertEqual(explanation['resolved'], 11)
+
+
+class TestResultCache(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.uidutil = IntIdsStub()
+        provideUtility(self.uidutil, IIntIds)
+        catalog = self.catalog = Catalog()
+        catalog['simiantype'] = FieldIndex('simiantype')
+        catalog['name'] = FieldIndex('name')
+        for simiantype, name in [('monkey', 'bobo'), ('monkey', 'bubbles'),
+                                 ('bonobo', 'bobo')]:
+            self._add(stoopid(simiantype=simiantype, name=name))
+
+    def _add(self, ob):
+        self.catalog.index_doc(self.uidutil.register(ob), ob)
+        return ob
+
+    def _search(self, **terms):
+        return [self.uidutil.getId(ob)
+                for ob in self.catalog.searchResults(**terms)]
+
+    def test_disabled(self):
+        self.assertEqual(self._search(name=('bobo', 'bobo')), [1, 3])
+        self.assertEqual(self._search(name=('bobo', 'bobo')), [1, 3])
+        self.assertEqual(self.catalog.cacheInfo(),
+                         {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 0})
+
+    def test_hits_and_invalidation(self):
+        self.catalog.cache_size = 10
+        self.assertEqual(self._search(name=('bobo', 'bobo')), [1, 3])
+        self.assertEqual(self._search(name=('bobo', 'bobo')), [1, 3])
+        self.assertEqual(self.catalog.cacheInfo(),
+                         {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 10})
+        # sorting, limiting and reversing are part of the key
+        self.assertEqual(
+            self._search(name=('bobo', 'bobo'), _sort_index='simiantype'),
+            [3, 1])
+        self.assertEqual(
+            self._search(name=('bobo', 'bobo'), _limit=1), [1])
+        self.assertEqual(
+            self._search(name=('bobo', 'bobo'), _reverse=True), [3, 1])
+        self.assertEqual(self.catalog.cacheInfo()['size'], 4)
+
+        self._add(stoopid(simiantype='punyhuman', name='bobo'))
+        self.assertEqual(self._search(name=('bobo', 'bobo')), [1, 3, 4])
+        self.assertEqual(self.catalog.cacheInfo()['misses'], 5)
+
+    def test_unrelated_index_change(self):
+        from zope.catalog.query import Term
+        self.catalog.cache_size = 10
+        self.catalog['other'] = FieldIndex('other')
+        self._search(_query=Term('name', ('bobo', 'bobo')))
+        self.catalog['other'].index_doc(1, stoopid(other=1))
+        self._search(_query=Term('name', ('bobo', 'bobo')))
+        self.assertEqual(self.catalog.cacheInfo()['hits'], 1)
+        self.catalog['name'].index_doc(1, stoopid(name='kev'))
+        self.assertEqual(self._search(_query=Term('name', ('bobo', 'bobo'))),
+                         [3])
+        self.assertEqual(self.catalog.cacheInfo()['hits'], 1)
+
+    def test_extent_change(self):
+        from zope.catalog.query import Term
+        self.catalog.cache_size = 10
+        query = ~Term('name', ('bobo', 'bobo'))
+        self.assertEqual(self._search(_query=query), [2])
+        # an object none of the indexes know about
+        self._add(stoopid())
+        self.assertEqual(self._search(_query=query), [2, 4])
+        self.catalog.unindex_doc(4)
+        self.assertEqual(self._search(_query=query), [2])
+        self.catalog.clear()
+        self.assertEqual(self._search(_query=query), [])
+        self.assertEqual(self.catalog.cacheInfo()['hits'], 0)
+
+    def test_empty_catalog(self):
+        catalog = Catalog()
+        catalog.cache_size = 10
+        catalog['name'] = FieldIndex('name')
+        self.assertEqual(len(catalog.searchResults(name=('a', 'a'))), 0)
+        self.assertEqual(len(catalog.searchResults(name=('a', 'a'))), 0)
+        self.assertEqual(catalog.cacheInfo()['hits'], 1)
+
+    def test_eviction(self):
+        self.catalog.cache_size = 2
+        self._search(name=('bobo', 'bobo'))
+        self._search(name=('bubbles', 'bubbles'))
+        self._search(name=('bobo', 'bobo'))
+        self._search(name=('kev', 'kev'))
+        self._search(name=('bobo', 'bobo'))
+        self._search(name=('bubbles', 'bubbles'))
+        self.assertEqual(self.catalog.cacheInfo(),
+                         {'hits': 2, 'misses': 4, 'size': 2, 'maxsize': 2})
+        self.catalog.cache_size = 3
+        self.assertEqual(self.catalog.cacheInfo(),
+                         {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 3})
+
+    def test_not_cacheable(self):
+        self.catalog.cache_size = 10
+        self.catalog['stub'] = StubIndex('name')
+        self.catalog['stub'].doc.update({1: stoopid(name=bytearray(b'x'))})
+        self._search(stub='bobo')
+        self._search(stub='bobo')
+        self._search(stub=bytearray(b'x'))
+        self.assertEqual(self.catalog.cacheInfo()['size'], 0)
+
+    def test_not_applicable(self):
+        @implementer(IIndexGeneration)
+        class BadIndex:
+            def apply(self, _q):
+                return None
+
+            def generation(self):
+                return 0
+        self.catalog.cache_size = 10
+        self.catalog['stub'] = BadIndex()
+        self.assertIsNone(self.catalog.searchResults(stub='foo'))
+        self.assertIsNone(self.catalog.searchResults(stub='foo'))
+        self.assertEqual(self.catalog.cacheInfo()['hits'], 1)
+
+    def test_aborted_changes(self):
+        import ZODB
+
+        db = ZODB.DB(None)
+        self.addCleanup(db.close)
+        tm_a = transaction.TransactionManager()
+        tm_b = transaction.TransactionManager()
+        catalog = db.open(tm_a).root()['catalog'] = Catalog()
+        catalog.cache_size = 10
+        catalog['name'] = FieldIndex('name')
+        catalog.index_doc(1, stoopid(name='a'))
+        tm_a.commit()
+
+        def search(catalog):
+            return sorted(catalog.searchResults(name=('a', 'a')).uids)
+
+        # uncommitted changes aren't cached
+        catalog.index_doc(2, stoopid(name='a'))
+        self.assertEqual(search(catalog), [1, 2])
+        self.assertEqual(catalog.cacheInfo()['size'], 0)
+        tm_a.abort()
+        other = db.open(tm_b).root()['catalog']
+        other.index_doc(3, stoopid(name='a'))
+        tm_b.commit()
+        tm_a.begin()
+        self.assertEqual(search(catalog), [1, 3])
+        self.assertEqual(search(catalog), [1, 3])
+        self.assertEqual(catalog.cacheInfo()['hits'], 1)
+
+    def test_extent_generation_of_old_catalogs(self):
+        catalog = Catalog()
+        del catalog._extent_generation
+        catalog.cache_size = 10
+        catalog['name'] = FieldIndex('name')
+        catalog.searchResults(name=('a', 'a'))
+        catalog.index_doc(1, stoopid(name='a'))
+        self.assertEqual(catalog._extent_generation(), 1)
+        catalog.searchResults(name=('a', 'a'))
+        self.assertEqual(catalog.cacheInfo()['misses'], 2)
+
+
+class ISized(Interface):
+    size = Attribute("The size")
+
+
+class ISizedTitled(ISized):
+    title = Attribute("The title")
+
+
+class IUnrelated(Interface):
+    size = Attribute("Another size")
+
+
+class TestSelectiveReindexing(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        catalog = self.catalog = Catalog()
+        catalog['kind'] = StubIndex('kind')
+        catalog['title'] = FieldIndex('title')
+        catalog['size'] = FieldIndex('size', ISized)
+        catalog['upper'] = FieldIndex('upper', field_callable=True)
+        self.catalog.index_doc(1, self._doc('a', 1))
+
+    def _doc(self, title, size):
+        ob = stoopid(kind='doc', title=title, size=size)
+        ob.upper = title.upper
+        alsoProvides(ob, ISizedTitled)
+        return ob
+
+    def _reindex(self, *descriptions):
+        ob = self._doc('b', 2)
+        self.catalog.reindex_doc(1, ob, descriptions)
+        return sorted(name for name, index in self.catalog.items()
+                      if (index.doc[1] is ob if name == 'kind'
+                          else index.documentValue(1) in ('b', 'B', 2)))
+
+    def test_described_attributes(self):
+        from zope.lifecycleevent import Attributes
+        self.assertEqual(self._reindex(Attributes(ISizedTitled, 'title')),
+                         ['kind', 'title', 'upper'])
+
+    def test_related_interfaces(self):
+        from zope.lifecycleevent import Attributes
+        self.assertEqual(self._reindex(Attributes(ISizedTitled, 'size')),
+                         ['kind', 'size', 'upper'])
+        self.setUp()
+        self.assertEqual(self._reindex(Attributes(ISized, 'size')),
+                         ['kind', 'size', 'upper'])
+        self.setUp()
+        self.assertEqual(self._reindex(Attributes(IUnrelated, 'size')),
+                         ['kind', 'upper'])
+        self.setUp()
+        self.assertEqual(self._reindex(Attributes(None, 'size')),
+                         ['kind', 'size', 'upper'])
+
+    def test_everything(self):
+        from zope.lifecycleevent import Sequence
+        everything = ['kind', 'size', 'title', 'upper']
+        self.assertEqual(self._reindex(), everything)
+        self.setUp()
+        self.assertEqual(self._reindex(Sequence(ISized, 'size')),
+                         everything)
+        self.setUp()
+        self.assertEqual(self._reindex('unknown'), everything)
+
+    def test_not_yet_indexed(self):
+        from zope.lifecycleevent import Attributes
+        ob = self._doc('b', 2)
+        self.catalog.reindex_doc(2, ob, [Attributes(ISized, 'size')])
+        self.assertIn(2, self.catalog._extent)
+        self.assertEqual(self.catalog['title'].documentValue(2), 'b')
+
+
+class TestSharedAdaptation(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.adapted = []
+
+        def adapt(ob, default):
+            self.adapted.append(ob)
+            return ob
+
+        class CheckedIndex(FieldIndex):
+            # overriding index_doc, it gets the objects themselves
+            def index_doc(test, docid, ob):
+                self.assertIsInstance(ob, stoopid)
+                super().index_doc(docid, ob)
+
+        catalog = self.catalog = Catalog()
+        catalog['kind'] = StubIndex('kind')
+        catalog['title'] = FieldIndex('title', adapt)
+        catalog['size'] = FieldIndex('size', adapt)
+        catalog['checked'] = CheckedIndex('size', adapt)
+        catalog['plain'] = FieldIndex('title')
+
+    def test_index_doc(self):
+        ob = stoopid(title='a', size=1)
+        self.catalog.index_doc(1, ob)
+        self.assertEqual(self.adapted, [ob, ob])
+        self.assertIs(self.catalog['kind'].doc[1], ob)
+        self.assertEqual(self.catalog['size'].documentValue(1), 1)
+        self.assertEqual(self.catalog['checked'].documentValue(1), 1)
+        self.assertEqual(self.catalog['plain'].documentValue(1), 'a')
+
+    def test_index_docs(self):
+        obs = [stoopid(title='a', size=1), stoopid(title='b', size=2)]
+        self.catalog.index_docs(enumerate(obs))
+        self.assertEqual(len(self.adapted), 4)
+        self.assertEqual(self.catalog['title'].documentValue(1), 'b')
+        self.assertEqual(self.catalog['checked'].documentValue(0), 1)
+
+
 @implementer(ICatalog)
 class CatalogStub:
 
@@ -347,6 +1600,23 @@ class TestEventSubscribers(unittest.TestCase):
         self.assertEqual(self.cat.regs, [(1, ob)])
         self.assertEqual(self.cat.unregs, [])
 
+    def test_reindexDocSubscriber_descriptions(self):
+        from zope.lifecycleevent import Attributes
+        from zope.lifecycleevent import ObjectModifiedEvent
+
+        from zope.catalog.catalog import reindexDocSubscriber
+
+        ob = Stub()
+        self.root['ob'] = ob
+        id = self.utility.register(ob)
+        reindexed = []
+        self.cat.reindex_doc = lambda *args: reindexed.append(args)
+        description = Attributes(Interface, 'title')
+        reindexDocSubscriber(ObjectModifiedEvent(ob, description))
+        self.assertEqual(reindexed, [(id, ob, (description,))])
+        reindexDocSubscriber(ObjectModifiedEvent(ob))
+        self.assertEqual(self.cat.regs, [(id, ob)])
+
     def test_unindexDocSubscriber(self):
         from zope.container.contained import ObjectRemovedEvent
         from zope.intid.interfaces import IntIdRemovedEvent
@@ -372,6 +1642,552 @@ class TestEventSubscribers(unittest.TestCase):
         self.assertEqual(self.cat.unregs, [id])
         self.assertEqual(self.cat.regs, [])
 
+    def test_lookups_are_cached(self):
+        from zope.lifecycleevent import ObjectModifiedEvent
+
+        from zope.catalog.catalog import reindexDocSubscriber
+
+        ob = Stub()
+        self.root['ob'] = ob
+        id = self.utility.register(ob)
+        sm = self.root.getSiteManager()
+        lookups = []
+        getAllUtilitiesRegisteredFor = sm.getAllUtilitiesRegisteredFor
+
+        def countingLookup(interface):
+            lookups.append(interface)
+            return getAllUtilitiesRegisteredFor(interface)
+        sm.getAllUtilitiesRegisteredFor = countingLookup
+
+        reindexDocSubscriber(ObjectModifiedEvent(ob))
+        reindexDocSubscriber(ObjectModifiedEvent(ob))
+        self.assertEqual(lookups, [ICatalog])
+        self.assertEqual(self.cat.regs, [(id, ob), (id, ob)])
+
+        # registering a catalog invalidates the cached catalogs
+        cat2 = addUtility(sm, 'cat2', ICatalog, CatalogStub())
+        reindexDocSubscriber(ObjectModifiedEvent(ob))
+        self.assertEqual(lookups, [ICatalog, ICatalog])
+        self.assertEqual(cat2.regs, [(id, ob)])
+
+        sm.unregisterUtility(cat2, ICatalog, 'cat2')
+        reindexDocSubscriber(ObjectModifiedEvent(ob))
+        self.assertEqual(len(lookups), 3)
+        self.assertEqual(cat2.regs, [(id, ob)])
+        self.assertEqual(len(self.cat.regs), 4)
+
+    def test_lookups_follow_base_generations(self):
+        from zope.lifecycleevent import ObjectModifiedEvent
+
+        from zope.catalog.catalog import reindexDocSubscriber
+
+        ob = Stub()
+        self.root['ob'] = ob
+        self.utility.register(ob)
+        sm = self.root.getSiteManager()
+        lookups = []
+        getAllUtilitiesRegisteredFor = sm.getAllUtilitiesRegisteredFor
+
+        def countingLookup(interface):
+            lookups.append(interface)
+            return getAllUtilitiesRegisteredFor(interface)
+        sm.getAllUtilitiesRegisteredFor = countingLookup
+
+        reindexDocSubscriber(ObjectModifiedEvent(ob))
+        self.assertEqual(len(lookups), 1)
+        # a base changed elsewhere doesn't tell its subregistries
+        base = sm.utilities.ro[-1]
+        self.assertIsNot(base, sm.utilities)
+        base._generation += 1
+        reindexDocSubscriber(ObjectModifiedEvent(ob))
+        self.assertEqual(len(lookups), 2)
+        reindexDocSubscriber(ObjectModifiedEvent(ob))
+        self.assertEqual(len(lookups), 2)
+
+    def test_lookups_not_cacheable(self):
+        from zope.catalog.catalog import _catalogs
+        from zope.catalog.catalog import _intIds
+
+        class SiteManager:
+            __slots__ = ()
+
+            def getUtility(self, interface):
+                return 'intids'
+
+            def getAllUtilitiesRegisteredFor(self, interface):
+                return [context]
+
+        class Unsettable(SiteManager):
+            # can't cache anything on instances
+            __slots__ = ()
+            utilities = self.root.getSiteManager().utilities
+
+        class Context:
+            def __conform__(self, interface):
+                if interface is IComponentLookup:
+                    return sm
+
+        context = Context()
+        for sm in (SiteManager(), Unsettable()):
+            self.assertEqual(_catalogs(context), ((context, 'intids'),))
+            self.assertEqual(_intIds(context), 'intids')
+
+
+class TestDeferredIndexing(unittest.TestCase):
+
+    def setUp(self):
+        self.root = placefulSetUp(True)
+        sm = self.root.getSiteManager()
+        self.utility = addUtility(sm, '', IIntIds, IntIdsStub())
+        self.cat = addUtility(sm, '', ICatalog, CatalogStub())
+        self.cat.defer_indexing = True
+        self.immediate = addUtility(sm, 'immediate', ICatalog, CatalogStub())
+        setSite(self.root)
+        transaction.begin()
+
+    def tearDown(self):
+        transaction.abort()
+        placefulTearDown()
+
+    def _events(self, ob, *names):
+        from zope.container.contained import ObjectAddedEvent
+        from zope.container.contained import ObjectRemovedEvent
+        from zope.intid.interfaces import IntIdAddedEvent
+        from zope.intid.interfaces import IntIdRemovedEvent
+        from zope.lifecycleevent import ObjectModifiedEvent
+
+        from zope.catalog.catalog import indexDocSubscriber
+        from zope.catalog.catalog import reindexDocSubscriber
+        from zope.catalog.catalog import unindexDocSubscriber
+        for name in names:
+            if name == 'add':
+                indexDocSubscriber(
+                    IntIdAddedEvent(ob, ObjectAddedEvent(ob)))
+            elif name == 'modify':
+                reindexDocSubscriber(ObjectModifiedEvent(ob))
+            else:
+                unindexDocSubscriber(
+                    IntIdRemovedEvent(ob, ObjectRemovedEvent(ob)))
+
+    def test_collapsed_until_commit(self):
+        ob = self.root['ob'] = Stub()
+        id = self.utility.register(ob)
+        self._events(ob, 'add', 'modify', 'modify', 'modify')
+        self.assertEqual(self.cat.regs, [])
+        self.assertEqual(len(self.immediate.regs), 4)
+        transaction.commit()
+        self.assertEqual(self.cat.regs, [(id, ob)])
+
+    def test_added_and_removed(self):
+        ob = self.root['ob'] = Stub()
+        self.utility.register(ob)
+        self._events(ob, 'add', 'modify', 'remove')
+        transaction.commit()
+        self.assertEqual(self.cat.regs, [])
+        self.assertEqual(self.cat.unregs, [])
+
+    def test_modified_and_removed(self):
+        ob = self.root['ob'] = Stub()
+        id = self.utility.register(ob)
+        self._events(ob, 'modify', 'remove', 'modify')
+        self.assertEqual(self.cat.regs, [])
+        transaction.commit()
+        self.assertEqual(self.cat.unregs, [])
+        self.assertEqual(self.cat.regs, [(id, ob)])
+
+    def test_flush(self):
+        from zope.catalog.deferred import flush
+        flush()
+        ob = self.root['ob'] = Stub()
+        id = self.utility.register(ob)
+        self._events(ob, 'modify', 'remove')
+        flush()
+        self.assertEqual(self.cat.unregs, [id])
+        transaction.commit()
+        self.assertEqual(self.cat.unregs, [id])
+
+    def test_savepoints(self):
+        ob = self.root['ob'] = Stub()
+        id = self.utility.register(ob)
+        self._events(ob, 'add')
+        savepoint = transaction.savepoint()
+        other = self.root['other'] = Stub()
+        self.utility.register(other)
+        self._events(other, 'add')
+        self._events(ob, 'remove')
+        savepoint.rollback()
+        savepoint.rollback()
+        transaction.commit()
+        self.assertEqual(self.cat.regs, [(id, ob)])
+        self.assertEqual(self.cat.unregs, [])
+
+        # savepoints taken before the first operation was queued
+        savepoint = transaction.savepoint()
+        self._events(ob, 'modify')
+        savepoint.rollback()
+        transaction.commit()
+        self.assertEqual(self.cat.regs, [(id, ob)])
+
+    def test_abort(self):
+        ob = self.root['ob'] = Stub()
+        self.utility.register(ob)
+        self._events(ob, 'add')
+        transaction.abort()
+        transaction.commit()
+        self.assertEqual(self.cat.regs, [])
+
+    def test_collapsing(self):
+        from zope.catalog.deferred import ADD
+        from zope.catalog.deferred import REINDEX
+        from zope.catalog.deferred import UNINDEX
+        from zope.catalog.deferred import IndexingQueue
+        for ops, expected in [
+                ((ADD, ADD), ADD),
+                ((ADD, REINDEX, REINDEX), ADD),
+                ((ADD, UNINDEX), None),
+                ((ADD, UNINDEX, ADD), ADD),
+                ((REINDEX, ADD), REINDEX),
+                ((REINDEX, UNINDEX), UNINDEX),
+                ((UNINDEX, ADD), REINDEX),
+                ((UNINDEX, REINDEX), REINDEX),
+                ((UNINDEX, UNINDEX), UNINDEX)]:
+            queue = IndexingQueue()
+            ob = object()
+            for op in ops:
+                queue.record(self.cat, 1, op, None if op == UNINDEX else ob)
+            if expected is None:
+                self.assertEqual(len(queue), 0)
+            else:
+                self.assertEqual(len(queue), 1)
+                self.assertEqual(
+                    list(queue._operations.values()),
+                    [(self.cat, 1, expected,
+                      None if ops == (UNINDEX, UNINDEX) else ob, ())])
+
+    def test_descriptions(self):
+        from zope.lifecycleevent import Attributes
+
+        from zope.catalog.deferred import ADD
+        from zope.catalog.deferred import REINDEX
+        from zope.catalog.deferred import IndexingQueue
+        from zope.catalog.deferred import perform
+        title = Attributes(Interface, 'title')
+        size = Attributes(Interface, 'size')
+        for ops, expected in [
+                ([(REINDEX, [title])], (title,)),
+                ([(REINDEX, [title]), (REINDEX, [size])], (title, size)),
+                ([(REINDEX, [title]), (REINDEX, [])], ()),
+                ([(REINDEX, []), (REINDEX, [title])], ()),
+                ([(ADD, []), (REINDEX, [title])], ())]:
+            queue = IndexingQueue()
+            for op, descriptions in ops:
+                queue.record(self.cat, 1, op, 'ob', descriptions)
+            self.assertEqual(
+                [operation[4] for operation in queue._operations.values()],
+                [expected])
+
+        cat = Catalog()
+        reindexed = []
+        cat.reindex_doc = lambda *args: reindexed.append(args)
+        perform(cat, 1, REINDEX, 'ob', (title,))
+        self.assertEqual(reindexed, [(1, 'ob', (title,))])
+        # catalogs that can't reindex selectively index everything
+        perform(self.cat, 1, REINDEX, 'ob', (title,))
+        self.assertEqual(self.cat.regs, [(1, 'ob')])
+
+    def test_bulk(self):
+        from zope.lifecycleevent import Attributes
+
+        from zope.catalog.deferred import ADD
+        from zope.catalog.deferred import REINDEX
+        from zope.catalog.deferred import UNINDEX
+        from zope.catalog.deferred import IndexingQueue
+        cat = Catalog()
+        cat['x'] = FieldIndex('x')
+        cat['stub'] = StubIndex('x')
+        cat.index_docs((docid, stoopid(x=docid)) for docid in (1, 2, 3))
+        calls = []
+        index_docs = cat.index_docs
+        unindex_docs = cat.unindex_docs
+        cat.index_docs = lambda docs: calls.append(docs) or index_docs(docs)
+        cat.unindex_docs = (
+            lambda docids: calls.append(docids) or unindex_docs(docids))
+
+        queue = IndexingQueue()
+        queue.record(cat, 4, ADD, stoopid(x=4))
+        queue.record(cat, 1, REINDEX, stoopid(x=5))
+        queue.record(cat, 2, UNINDEX)
+        queue.record(cat, 3, UNINDEX)
+        queue.process()
+        self.assertEqual(calls[0], [2, 3])
+        self.assertEqual([docid for docid, ob in calls[1]], [4, 1])
+        self.assertEqual(dict(cat['x']._rev_index), {1: 5, 4: 4})
+        self.assertEqual(sorted(cat['stub'].doc), [1, 4])
+        self.assertEqual(list(cat._extent), [1, 4])
+
+        queue.record(cat, 1, REINDEX, stoopid(x=6),
+                     [Attributes(Interface, 'x')])
+        queue.process()
+        self.assertEqual(cat['x'].documentValue(1), 6)
+
+        cat.unindex_docs([])
+        cat._extent = None
+        cat.unindex_docs([1])
+        self.assertEqual(dict(cat['x']._rev_index), {4: 4})
+
+    def test_transaction_manager_of_catalog(self):
+        from zope.catalog.deferred import REINDEX
+        from zope.catalog.deferred import flush
+        from zope.catalog.deferred import queueFor
+
+        class Jar:
+            transaction_manager = transaction.TransactionManager()
+
+        cat = CatalogStub()
+        cat._p_jar = Jar()
+        queueFor(cat).record(cat, 1, REINDEX, 'ob')
+        self.assertIs(queueFor(cat), queueFor(cat))
+        transaction.commit()
+        self.assertEqual(cat.regs, [])
+        Jar.transaction_manager.commit()
+        self.assertEqual(cat.regs, [(1, 'ob')])
+
+        queueFor(cat).record(cat, 2, REINDEX, 'ob')
+        flush()
+        self.assertEqual(cat.regs, [(1, 'ob')])
+        flush(catalog=cat)
+        self.assertEqual(cat.regs, [(1, 'ob'), (2, 'ob')])
+        Jar.transaction_manager.abort()
+
+
+class TestPendingIndexing(unittest.TestCase):
+
+    def setUp(self):
+        from zope.catalog.pending import Queue
+        self.root = placefulSetUp(True)
+        sm = self.root.getSiteManager()
+        self.utility = addUtility(sm, '', IIntIds, IntIdsStub())
+        self.cat = addUtility(sm, '', ICatalog, Catalog())
+        self.cat['title'] = FieldIndex('title')
+        self.cat.indexing_queue = Queue()
+        setSite(self.root)
+        transaction.begin()
+
+    def tearDown(self):
+        transaction.abort()
+        placefulTearDown()
+
+    _events = TestDeferredIndexing._events
+
+    def _add(self, title):
+        ob = self.root[title] = Stub()
+        ob.title = title
+        return self.utility.register(ob), ob
+
+    def test_process(self):
+        from zope.catalog.pending import process
+        a, ob_a = self._add('a')
+        b, ob_b = self._add('b')
+        c, ob_c = self._add('c')
+        self._events(ob_a, 'add', 'modify', 'modify')
+        self._events(ob_b, 'add', 'remove')
+        self._events(ob_c, 'add')
+        self.assertEqual(len(self.cat.indexing_queue), 5)
+        self.assertEqual(len(self.cat._extent), 0)
+        self.assertEqual(len(self.cat.searchResults(title=('a', 'c'))), 0)
+
+        # objects gone by the time the queue is processed are unindexed
+        del self.utility.objs[c]
+        self.assertEqual(process(self.cat, batch_size=2), 5)
+        self.assertEqual(len(self.cat.indexing_queue), 0)
+        self.assertEqual(list(self.cat._extent), [a])
+        self.assertEqual(self.cat['title'].documentValue(a), 'a')
+        self.assertEqual(process(self.cat), 0)
+
+    def test_stale_search(self):
+        a, ob_a = self._add('a')
+        self._events(ob_a, 'add')
+        self.assertEqual(len(self.cat.apply({'title': ('a', 'a')})), 0)
+        self.cat.indexing_queue.stale_search = False
+        self.assertEqual(len(self.cat.apply({'title': ('a', 'a')})), 1)
+        # not stored in a database, so the queue was processed
+        self.assertEqual(len(self.cat.indexing_queue), 0)
+        self.assertEqual(self.cat.count(title=('a', 'a')), 1)
+
+    def test_search_leaves_queue(self):
+        import ZODB
+        a, ob_a = self._add('a')
+        b, ob_b = self._add('b')
+        self._events(ob_a, 'add')
+        db = ZODB.DB(None)
+        self.addCleanup(db.close)
+        conn = db.open()
+        self.addCleanup(conn.close)
+        conn.root()['catalog'] = self.cat
+        transaction.commit()
+        self._events(ob_b, 'add')
+        queue = self.cat.indexing_queue
+        queue.stale_search = False
+        cat = self.cat
+        self.assertEqual(len(cat.apply({'title': ('a', 'b')})), 2)
+        self.assertEqual(cat.count(title=('a', 'b')), 2)
+        self.assertTrue(cat.exists(title=('b', 'b')))
+        self.assertEqual(
+            [len(results) for results in cat.searchMany(
+                [{'title': ('a', 'a')}, {'title': ('b', 'b')}])],
+            [1, 1])
+        self.assertEqual(cat.explain(title=('a', 'b'))['size'], 2)
+        results = cat.searchResults(title=('a', 'b'), _sort_index='title')
+        self.assertEqual(list(results), [ob_a, ob_b])
+        # the queued operations were applied and rolled back
+        self.assertEqual(list(queue), [(a, 'add'), (b, 'add')])
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(len(cat._extent), 0)
+
+    def test_search_results_outlive_rollback(self):
+        import ZODB
+
+        from zope.catalog.query import Not
+        from zope.catalog.query import Term
+        a, ob_a = self._add('a')
+        b, ob_b = self._add('b')
+        db = ZODB.DB(None)
+        self.addCleanup(db.close)
+        conn = db.open()
+        self.addCleanup(conn.close)
+        conn.root()['catalog'] = self.cat
+        transaction.commit()
+        self._events(ob_a, 'add')
+        self._events(ob_b, 'add')
+        cat = self.cat
+        cat.indexing_queue.stale_search = False
+        # the results are read after the queue was rolled back
+        results = cat.apply({'title': ('a', 'a')})
+        self.assertEqual(len(results), 1)
+        self.assertEqual(list(results), [a])
+        self.assertEqual(cat.count(title=('a', 'a')), 1)
+        results = cat.apply(Not(Term('title', ('c', 'c'))))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sorted(results), sorted([a, b]))
+        results = cat.searchResults(title=('b', 'b'))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(list(results), [ob_b])
+        [results] = cat.searchMany([{'title': ('a', 'b')}])
+        self.assertEqual(sorted(results.uids), sorted([a, b]))
+        self.assertEqual(len(cat._extent), 0)
+        # nor do the rolled back changes read objects as current
+        self.assertEqual(conn._readCurrent, {})
+
+    def test_commit(self):
+        from zope.catalog.pending import process
+        a, ob_a = self._add('a')
+        self._events(ob_a, 'add')
+        transaction.commit()
+        self.assertEqual(len(self.cat.indexing_queue), 1)
+        self.assertEqual(process(self.cat, commit=True), 1)
+        transaction.abort()
+        self.assertEqual(list(self.cat._extent), [a])
+
+    def test_concurrent_transactions(self):
+        import os
+        import tempfile
+        from unittest import mock
+
+        import ZODB
+        import ZODB.FileStorage
+
+        from zope.catalog.deferred import ADD
+        from zope.catalog.deferred import REINDEX
+        from zope.catalog.pending import ConflictError
+        from zope.catalog.pending import Queue
+        with tempfile.TemporaryDirectory() as tmp:
+            db = ZODB.DB(ZODB.FileStorage.FileStorage(
+                os.path.join(tmp, 'Data.fs')))
+            self.addCleanup(db.close)
+            tm1 = transaction.TransactionManager()
+            tm2 = transaction.TransactionManager()
+            conn1 = db.open(tm1)
+            conn1.root()['queue'] = queue1 = Queue()
+            queue1.append(1, ADD)
+            tm1.commit()
+            queue2 = db.open(tm2).root()['queue']
+
+            # appending doesn't conflict with appending and taking
+            queue1.append(2, ADD)
+            self.assertEqual(queue2.take(), ((1, ADD),))
+            queue2.append(3, REINDEX)
+            queue2.append(3, REINDEX)
+            tm1.commit()
+            tm2.commit()
+            tm1.begin()
+            self.assertEqual(list(queue1), [(2, ADD), (3, REINDEX)])
+            self.assertEqual(len(queue1), 2)
+
+            # taking does
+            queue1.take(1)
+            queue2.take(1)
+            tm1.commit()
+            self.assertRaises(ConflictError, tm2.commit)
+            tm2.abort()
+            tm1.abort()
+            tm1.begin()
+            self.assertEqual(list(queue1), [(3, REINDEX)])
+
+            # appending to a new bucket doesn't conflict with taking
+            # either, and emptied buckets are dropped
+            tm2.begin()
+            self.assertEqual(queue2.take(), ((3, REINDEX),))
+            with mock.patch.object(Queue, 'bucket_size', 2):
+                queue1.append(4, ADD)
+            tm2.commit()
+            tm1.commit()
+            tm1.begin()
+            self.assertEqual(len(queue1._buckets), 2)
+            self.assertEqual(queue1.take(), ((4, ADD),))
+            tm1.commit()
+            tm2.begin()
+            self.assertEqual(list(queue2._buckets), [1])
+            self.assertEqual(len(queue2), 0)
+
+    def test_resolve_conflict(self):
+        from zope.catalog.pending import ConflictError
+        from zope.catalog.pending import Queue
+        old = {'_entries': ((1, 'add'), (2, 'add')), '_taken': 3}
+        resolve = Queue()._buckets[0]._p_resolveConflict
+        self.assertEqual(
+            resolve(old, {'_entries': ((2, 'add'),), '_taken': 4},
+                    {'_entries': old['_entries'] + ((3, 'add'),),
+                     '_taken': 3}),
+            {'_entries': ((2, 'add'), (3, 'add')), '_taken': 4})
+        self.assertRaises(
+            ConflictError, resolve, old,
+            {'_entries': ((2, 'unindex'),), '_taken': 4}, old)
+        self.assertRaises(
+            ConflictError, resolve, old,
+            dict(old, _dropped=True), old)
+
+    def test_buckets(self):
+        from zope.catalog.pending import Queue
+        queue = Queue()
+        queue.bucket_size = 2
+        for docid in (1, 1, 2, 3, 4, 5):
+            queue.append(docid, 'add')
+        self.assertEqual(len(queue), 5)
+        self.assertEqual([len(bucket) for bucket in queue._buckets.values()],
+                         [2, 2, 1])
+        self.assertEqual(queue.take(2), ((1, 'add'), (2, 'add')))
+        self.assertEqual(list(queue._buckets), [1, 2])
+        self.assertEqual(queue.take(1), ((3, 'add'),))
+        self.assertEqual(list(queue), [(4, 'add'), (5, 'add')])
+        # the last bucket is kept when it's emptied
+        self.assertEqual(queue.take(), ((4, 'add'), (5, 'add')))
+        self.assertEqual(list(queue._buckets), [2])
+        self.assertEqual(queue.take(), ())
+        queue.append(6, 'add')
+        queue.append(7, 'add')
+        self.assertEqual(list(queue._buckets), [2, 3])
+        self.assertEqual(len(queue), 2)
+
 
 class TestIndexUpdating(unittest.TestCase):
     """Issue #466: When reindexing a catalog it takes all objects from
@@ -400,6 +2216,7 @@ class TestIndexUpdating(unittest.TestCase):
             self.utility.register(obj)
 
     def tearDown(self):
+        transaction.abort()
         placefulTearDown()
 
     def iterAll(self, container):
@@ -418,6 +2235,55 @@ class TestIndexUpdating(unittest.TestCase):
                         ob in self.cat._visitSublocations()])
         self.assertEqual(names, ['folder1_1', 'folder1_1_1', 'folder1_1_2'])
 
+    def test_inside(self):
+        from zope.catalog.catalog import _Inside
+
+        class Located:
+            lookups = 0
+
+            def __init__(self, parent=None):
+                self._parent = parent
+
+            @property
+            def __parent__(self):
+                Located.lookups += 1
+                return self._parent
+
+        root = Located()
+        site = Located(root)
+        folder = Located(Located(site))
+        other = Located(root)
+        inside = _Inside(site)
+        self.assertTrue(inside(site))
+        self.assertTrue(inside(Located(folder)))
+        self.assertEqual(Located.lookups, 3)
+        self.assertTrue(inside(Located(folder)))
+        self.assertTrue(inside(folder))
+        self.assertEqual(Located.lookups, 4)
+        self.assertFalse(inside(Located(other)))
+        self.assertFalse(inside(Located(other)))
+        self.assertFalse(inside(root))
+        self.assertFalse(inside(object()))
+        self.assertEqual(Located.lookups, 8)
+
+    def test_local_intids_cached(self):
+        calls = []
+        registeredUtilities = self.local_sm.registeredUtilities
+
+        def countingRegisteredUtilities():
+            calls.append(1)
+            return registeredUtilities()
+        self.local_sm.registeredUtilities = countingRegisteredUtilities
+        for i in range(2):
+            self.assertEqual(len(list(self.cat._visitSublocations())), 3)
+        self.assertEqual(len(calls), 1)
+
+        utility = addUtility(self.local_sm, '', IIntIds, IntIdsStub())
+        utility.register(self.root['folder1']['folder1_1'])
+        self.assertEqual(list(self.cat._visitSublocations()),
+                         [(1, self.root['folder1']['folder1_1'])])
+        self.assertEqual(len(calls), 2)
+
     def test_updateIndex(self):
         """ Setup a catalog deeper within the containment hierarchy
         and call the updateIndexes method. The indexed objects should should
@@ -444,6 +2310,235 @@ class TestIndexUpdating(unittest.TestCase):
         names = sorted([ob.__name__ for i, ob in index.doc.items()])
         self.assertEqual(names, ['folder1_1_1', 'folder1_1_2'])
 
+    def test_batches(self):
+        self.cat.index_batch_size = 2
+        self.cat['field'] = FieldIndex('__name__')
+        self.cat.updateIndexes()
+        self.assertEqual(len(self.cat._extent), 3)
+        self.assertEqual(sorted(self.cat['field']._fwd_index),
+                         ['folder1_1', 'folder1_1_1', 'folder1_1_2'])
+        self.cat['field'].clear()
+        self.cat.updateIndex(self.cat['field'])
+        self.assertEqual(self.cat['field'].documentCount(), 3)
+
+    def test_chunks(self):
+        reports = []
+
+        def progress(indexed, rate):
+            reports.append(indexed)
+            self.assertGreaterEqual(rate, 0)
+        self.cat.updateIndexes(chunk_size=2, progress=progress, pause=1e-6)
+        self.assertEqual(reports, [2, 3])
+        self.assertEqual(len(self.cat['name'].doc), 3)
+        self.assertEqual(dict(self.cat._update_checkpoints), {})
+
+        self.cat.update_chunk_size = 2
+        self.cat['name'].clear()
+        self.cat.updateIndex(self.cat['name'], commit=True)
+        self.assertEqual(len(self.cat['name'].doc), 3)
+        self.assertEqual(dict(self.cat._update_checkpoints), {})
+
+    def test_uids_after(self):
+        from BTrees.IOBTree import IOBTree
+
+        from zope.catalog.catalog import _uidsAfter
+
+        class Refs(IOBTree):
+            ranges = 0
+
+            def keys(self, *args, **kw):
+                Refs.ranges += 1
+                return super().keys(*args, **kw)
+
+        uidutil = IntIdsStub()
+        uidutil.refs = Refs({uid: None for uid in range(10, 20)})
+        self.assertEqual(list(_uidsAfter(uidutil, None, 4)),
+                         list(range(10, 20)))
+        self.assertEqual(Refs.ranges, 4)
+        self.assertEqual(list(_uidsAfter(uidutil, 13, 4)),
+                         list(range(14, 20)))
+        self.assertEqual(Refs.ranges, 7)
+
+        # utilities without a BTree of ids are iterated over
+        uidutil = IntIdsStub()
+        for i in range(3):
+            uidutil.register(object())
+        self.assertEqual(list(_uidsAfter(uidutil, 1, 4)), [2, 3])
+
+    def test_resume(self):
+        def interrupt(indexed, rate):
+            raise KeyboardInterrupt()
+        first, second, third = [uid for uid, ob
+                                in self.cat._visitSublocations()]
+        with self.assertRaises(KeyboardInterrupt):
+            self.cat.updateIndex(self.cat['name'], chunk_size=2,
+                                 progress=interrupt)
+        self.assertEqual(dict(self.cat._update_checkpoints), {'name': second})
+        self.cat['name'].clear()
+        self.cat.updateIndex(self.cat['name'], chunk_size=2, resume=True)
+        self.assertEqual(list(self.cat['name'].doc), [third])
+        self.assertEqual(dict(self.cat._update_checkpoints), {})
+
+        # without resume, everything is indexed again
+        with self.assertRaises(KeyboardInterrupt):
+            self.cat.updateIndexes(chunk_size=1, progress=interrupt)
+        self.assertEqual(dict(self.cat._update_checkpoints), {None: first})
+        self.cat.updateIndexes()
+        self.assertEqual(len(self.cat['name'].doc), 3)
+        self.assertEqual(dict(self.cat._update_checkpoints), {})
+
+    def test_build(self):
+        reports = []
+        index = self.cat['field'] = FieldIndex('__name__')
+        self.cat.updateIndex(
+            index, progress=lambda *report: reports.append(report))
+        self.assertEqual(sorted(index._fwd_index),
+                         ['folder1_1', 'folder1_1_1', 'folder1_1_2'])
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0][0], 3)
+
+        # indexes that aren't empty are updated
+        built = []
+        index.build = built.append
+        self.cat.updateIndex(index)
+        index.clear()
+        self.cat.updateIndex(index, chunk_size=10)
+        self.assertEqual(built, [])
+        self.assertEqual(index.documentCount(), 3)
+
+    def test_no_build_with_overridden_index_doc(self):
+        class UpperIndex(FieldIndex):
+            def index_doc(self, docid, ob):
+                super().index_doc(docid, stoopid(__name__=ob.__name__.upper()))
+
+        index = self.cat['field'] = UpperIndex('__name__')
+        self.cat.updateIndex(index)
+        self.assertEqual(sorted(index._fwd_index),
+                         ['FOLDER1_1', 'FOLDER1_1_1', 'FOLDER1_1_2'])
+
+    def test_rebuildIndex(self):
+        old = self.cat['field'] = FieldIndex('__name__')
+        self.cat.updateIndexes()
+        folder = self.root['folder1']['folder1_1']
+        id = self.utility.getId(folder['folder1_1_1'])
+        removed = self.utility.getId(folder['folder1_1_2'])
+
+        def progress(indexed, rate):
+            # searches use the old index while the new one is filled
+            self.assertIs(self.cat['field'], old)
+            self.assertEqual(self.cat['field'].documentValue(id),
+                             'folder1_1_1')
+            ob = self.utility.getObject(id)
+            ob.__name__ = 'renamed'
+            self.cat.index_doc(id, ob)
+            self.cat.unindex_doc(removed)
+            self.assertEqual(old.documentValue(id), 'renamed')
+        self.cat.rebuildIndex('field', progress=progress)
+        new = self.cat['field']
+        self.assertIsNot(new, old)
+        self.assertIs(new.__parent__, self.cat)
+        self.assertEqual(new.__name__, 'field')
+        self.assertIsNone(old.__parent__)
+        self.assertEqual(dict(self.cat._rebuilds), {})
+        self.assertEqual(sorted(new._fwd_index), ['folder1_1', 'renamed'])
+        self.assertEqual(len(self.cat), 2)
+
+        # changes are no longer logged
+        self.cat.index_doc(removed, folder['folder1_1_2'])
+        self.assertEqual(new.documentCount(), 3)
+
+    def test_writers_conflict_with_rebuilds(self):
+        import ZODB
+
+        from zope.catalog.pending import ConflictError
+        db = ZODB.DB(None)
+        self.addCleanup(db.close)
+        tm_writer = transaction.TransactionManager()
+        tm_rebuild = transaction.TransactionManager()
+        catalog = db.open(tm_writer).root()['catalog'] = Catalog()
+        catalog['field'] = FieldIndex('x')
+        tm_writer.commit()
+        catalog.index_doc(1, stoopid(x=1))
+        rebuilt = db.open(tm_rebuild).root()['catalog']
+        rebuilt._rebuilds['field'] = (FieldIndex('x'), IFSet())
+        tm_rebuild.commit()
+        self.assertRaises(ConflictError, tm_writer.commit)
+        tm_writer.abort()
+
+        # but not with checkpoints of chunks of the update
+        catalog.index_doc(1, stoopid(x=1))
+        rebuilt._setCheckpoint('field', 1)
+        tm_rebuild.commit()
+        tm_writer.commit()
+
+        # catalogs created before the rebuilds were kept apart read
+        # the catalog itself
+        del rebuilt._rebuilds
+        tm_rebuild.commit()
+        tm_writer.begin()
+        catalog.index_doc(2, stoopid(x=2))
+        rebuilt._mapping('_rebuilds')['field'] = (FieldIndex('x'), IFSet())
+        self.assertIsInstance(rebuilt._rebuilds, PersistentMapping)
+        tm_rebuild.commit()
+        self.assertRaises(ConflictError, tm_writer.commit)
+        tm_writer.abort()
+
+    def test_rebuildIndex_empty_copy(self):
+        from zope.index.text.lexicon import Splitter
+
+        from zope.catalog.keyword import KeywordIndex
+        from zope.catalog.text import Lexicon
+        from zope.catalog.text import TextIndex
+        old = FieldIndex('__name__', field_callable=True)
+        old.skip_unchanged = True
+        old.index_doc(1, stoopid(__name__=lambda: 'a'))
+        new = old._emptyCopy()
+        self.assertIs(type(new), FieldIndex)
+        self.assertEqual((new.field_name, new.interface, new.field_callable),
+                         ('__name__', None, True))
+        self.assertTrue(new.skip_unchanged)
+        self.assertEqual(new.documentCount(), 0)
+        self.assertEqual(old.documentCount(), 1)
+
+        old = KeywordIndex('tags', family=BTrees.family64)
+        new = old._emptyCopy()
+        self.assertIs(new.family, BTrees.family64)
+        self.assertIsInstance(new._rev_index, BTrees.family64.IO.BTree)
+
+        lexicon = Lexicon(Splitter())
+        old = TextIndex('body', field_callable=False, lexicon=lexicon)
+        old.index_doc(1, stoopid(body='Some Text'))
+        new = old._emptyCopy()
+        self.assertIsNot(new.lexicon, lexicon)
+        self.assertIs(new.index.lexicon, new.lexicon)
+        self.assertEqual(new.lexicon._pipeline, lexicon._pipeline)
+        self.assertEqual(new.documentCount(), 0)
+
+        self.cat['stub'] = StubIndex('__name__')
+        with self.assertRaises(ValueError):
+            self.cat.rebuildIndex('stub')
+
+    def test_rebuildIndex_commit(self):
+        self.cat['field'] = FieldIndex('__name__')
+        self.cat.updateIndexes()
+        index = FieldIndex('__name__')
+        folder = self.root['folder1']['folder1_1']
+        id = self.utility.getId(folder)
+
+        def progress(indexed, rate):
+            log = self.cat._rebuilds['field'][1]
+
+            def concurrentChange():
+                # the change of a transaction committing with the swap
+                folder.__name__ = 'renamed'
+                log.insert(id)
+            transaction.get().addBeforeCommitHook(concurrentChange)
+        self.cat.rebuildIndex('field', index, commit=True,
+                              progress=progress)
+        self.assertIs(self.cat['field'], index)
+        self.assertEqual(index.documentValue(id), 'renamed')
+        self.assertEqual(index.documentCount(), 3)
+
     def test_index_added(self):
         from zope.catalog.catalog import indexAdded
         index = self.cat['name']
@@ -689,6 +2784,168 @@ class TestAttributeIndex(cleanup.CleanUp,
         with self.assertRaises(ValueError):
             AttributeIndex()
 
+    def test_generation(self):
+        from zope.catalog.attribute import AttributeIndex
+        from zope.catalog.interfaces import IIndexGeneration
+        idx = AttributeIndex(field_name='foo')
+        verifyObject(IIndexGeneration, idx)
+        self.assertEqual(idx.generation(), 0)
+
+    def test_skip_unchanged(self):
+        from zope.catalog.text import TextIndex
+        idx = TextIndex('body')
+        idx.skip_unchanged = True
+        idx.index_doc(1, stoopid(body='the quick brown fox'))
+        generation = idx.generation()
+        idx.index_doc(1, stoopid(body='the quick brown fox'))
+        self.assertEqual(idx.skipped(), 1)
+        self.assertEqual(idx.generation(), generation)
+        idx.index_doc(1, stoopid(body='the lazy dog'))
+        self.assertEqual(idx.skipped(), 1)
+        self.assertEqual(len(idx.apply('lazy')), 1)
+
+        # unindexed documents are indexed again
+        idx.index_doc(1, stoopid(body=None))
+        idx.index_doc(1, stoopid(body='the lazy dog'))
+        idx.unindex_doc(1)
+        idx.index_doc(1, stoopid(body='the lazy dog'))
+        idx.clear()
+        idx.index_doc(1, stoopid(body='the lazy dog'))
+        self.assertEqual(idx.skipped(), 1)
+        self.assertEqual(len(idx.apply('lazy')), 1)
+
+        # changes made while not skipping are noticed afterwards
+        idx.skip_unchanged = False
+        idx.index_doc(1, stoopid(body='the quick brown fox'))
+        idx.skip_unchanged = True
+        idx.index_doc(1, stoopid(body='the lazy dog'))
+        self.assertEqual(idx.skipped(), 1)
+        self.assertEqual(len(idx.apply('lazy')), 1)
+
+    def test_fingerprint(self):
+        import datetime
+
+        from zope.catalog.attribute import _fingerprint
+
+        class Message(str):
+            domain = 'other'
+
+        self.assertEqual(_fingerprint('a'), _fingerprint('a'))
+        self.assertNotEqual(_fingerprint('1'), _fingerprint(1))
+        self.assertNotEqual(_fingerprint(['a']), _fingerprint(('a',)))
+        self.assertIsNotNone(_fingerprint(
+            (datetime.date(2026, 1, 1), [1.5, {b'x'}], True)))
+        self.assertIsNone(_fingerprint(Message('a')))
+        self.assertIsNone(_fingerprint(['a', object()]))
+
+    def test_accessor(self):
+        from zope.catalog.field import FieldIndex
+        idx = FieldIndex('x')
+        idx.index_doc(1, stoopid(x=1, y=2))
+        accessor = idx._accessor()
+        self.assertIs(idx._accessor(), accessor)
+        idx.field_name = 'y'
+        idx.index_doc(1, stoopid(x=1, y=2))
+        self.assertEqual(idx.documentValue(1), 2)
+        idx.field_callable = True
+        idx.index_doc(1, stoopid(y=lambda: 3))
+        idx.index_doc(2, stoopid(y=None))
+        self.assertEqual(idx.documentValue(1), 3)
+        self.assertEqual(idx.documentCount(), 1)
+
+    def test_index_docs(self):
+        from zope.catalog.field import FieldIndex
+        from zope.catalog.interfaces import IBulkInjection
+
+        def interface(ob, default):
+            return default if ob is self else ob
+
+        documents = [(3, stoopid(x='b')), (1, stoopid(x='a')),
+                     (2, stoopid(x='b')), (4, stoopid(x='c')),
+                     (4, stoopid()), (1, stoopid(x='c')), (1, self)]
+        bulk = FieldIndex('x', interface)
+        verifyObject(IBulkInjection, bulk)
+        bulk.index_doc(4, stoopid(x='a'))
+        bulk.index_docs(iter(documents))
+        one_by_one = FieldIndex('x', interface)
+        one_by_one.index_doc(4, stoopid(x='a'))
+        for docid, ob in documents:
+            one_by_one.index_doc(docid, ob)
+        self.assertEqual(dict(bulk._rev_index), {1: 'c', 2: 'b', 3: 'b'})
+        self.assertEqual(dict(bulk._rev_index),
+                         dict(one_by_one._rev_index))
+        self.assertEqual(
+            {value: list(docids)
+             for value, docids in bulk._fwd_index.items()},
+            {'b': [2, 3], 'c': [1]})
+        self.assertEqual(bulk.documentCount(), 3)
+
+        bulk.unindex_docs([3, 1, 42])
+        self.assertEqual(dict(bulk._rev_index), {2: 'b'})
+
+    def test_build(self):
+        from zope.catalog.field import FieldIndex
+        from zope.catalog.interfaces import IIndexBuild
+
+        def interface(ob, default):
+            return default if ob is self else ob
+
+        documents = [(docid, stoopid(x=docid % 7 if docid % 5 else None))
+                     for docid in range(200, 0, -1)]
+        documents.append((201, self))
+        built = FieldIndex('x', interface)
+        verifyObject(IIndexBuild, built)
+        built.build_run_size = 16
+        built.skip_unchanged = True
+        generation = built.generation()
+        built.build(iter(documents))
+        one_by_one = FieldIndex('x', interface)
+        for docid, ob in documents:
+            one_by_one.index_doc(docid, ob)
+        self.assertEqual(list(built._rev_index.items()),
+                         list(one_by_one._rev_index.items()))
+        self.assertEqual(
+            [(value, list(docids))
+             for value, docids in built._fwd_index.items()],
+            [(value, list(docids))
+             for value, docids in one_by_one._fwd_index.items()])
+        self.assertEqual(built.documentCount(), 160)
+        self.assertEqual(built.generation(), generation + 1)
+        self.assertIsNone(built._fingerprints)
+
+        with self.assertRaises(ValueError):
+            built.build(documents)
+        built.clear()
+        built.build([])
+        self.assertEqual(built.documentCount(), 0)
+
+    def test_index_docs_overridden_index_doc(self):
+        from zope.catalog.field import FieldIndex as BaseFieldIndex
+
+        class LowerIndex(BaseFieldIndex):
+            def index_doc(self, docid, ob):
+                super().index_doc(docid, stoopid(x=ob.x.lower()))
+
+        index = LowerIndex('x')
+        index.index_docs([(1, stoopid(x='ABC')), (2, stoopid(x='Def'))])
+        self.assertEqual(index.documentValue(1), 'abc')
+        self.assertEqual(index.documentValue(2), 'def')
+        catalog = Catalog()
+        catalog['x'] = LowerIndex('x')
+        catalog.index_docs([(1, stoopid(x='ABC')), (2, stoopid(x='Def'))])
+        self.assertEqual(catalog['x'].documentValue(1), 'abc')
+
+    def test_indexing_order(self):
+        from zope.catalog.attribute import AttributeIndex
+        from zope.catalog.field import FieldIndex
+        values = [(3, 'b'), (1, None), (4, 'a'), (2, 'b'), (5, None)]
+        self.assertEqual(
+            FieldIndex('x')._indexingOrder(values),
+            [(1, None), (5, None), (4, 'a'), (2, 'b'), (3, 'b')])
+        self.assertEqual(
+            AttributeIndex('x')._indexingOrder(values),
+            [(1, None), (2, 'b'), (3, 'b'), (4, 'a'), (5, None)])
+
     def test_index_doc_interface_returns_none(self):
         from zope.catalog.attribute import AttributeIndex
 
@@ -721,6 +2978,36 @@ class TestAttributeIndex(cleanup.CleanUp,
                          'field_name')
 
 
+class TestBulk(unittest.TestCase):
+
+    def test_buildTree(self):
+        from BTrees.check import check
+
+        from zope.catalog.bulk import buildTree
+        family = BTrees.family32
+        for size in (0, 1, 120, 121, 120 * 500 + 1):
+            tree = buildTree(family.IF.TreeSet, range(size))
+            check(tree)
+            self.assertEqual(list(tree), list(range(size)))
+            tree.insert(size)
+            check(tree)
+            items = sorted((str(i), i) for i in range(size))
+            tree = buildTree(family.OI.BTree, items)
+            check(tree)
+            self.assertEqual(list(tree.items()), items)
+
+    def test_external_sort(self):
+        from zope.catalog.bulk import ExternalSorter
+        sorter = ExternalSorter(run_size=10)
+        sorter.block_size = 3
+        items = [(i * 7919 % 101, str(i)) for i in range(101)]
+        for item in items:
+            sorter.add(item)
+        self.assertEqual(len(sorter._files), 10)
+        self.assertEqual(list(sorter.sorted()), sorted(items))
+        self.assertTrue(all(file.closed for file in sorter._files))
+
+
 class TestTextIndex(unittest.TestCase):
 
     def test_constructor(self):
@@ -729,6 +3016,154 @@ class TestTextIndex(unittest.TestCase):
 
         verifyObject(ITextIndex, TextIndex(field_name='foo'))
 
+    def test_default_lexicon_and_index(self):
+        import zope.index.text.lexicon
+        import zope.index.text.okapiindex
+
+        from zope.catalog.text import Lexicon
+        from zope.catalog.text import OkapiIndex
+        from zope.catalog.text import TextIndex
+        index = TextIndex('foo')
+        self.assertIsInstance(index.lexicon, Lexicon)
+        self.assertIsInstance(index.index, OkapiIndex)
+        self.assertIs(index.index.lexicon, index.lexicon)
+        lexicon = zope.index.text.lexicon.Lexicon()
+        index = TextIndex('foo', lexicon=lexicon)
+        self.assertIs(index.lexicon, lexicon)
+        self.assertIs(index.index.lexicon, lexicon)
+        okapi = zope.index.text.okapiindex.OkapiIndex(lexicon)
+        self.assertIs(TextIndex('foo', index=okapi).index, okapi)
+
+    def test_lexicon(self):
+        from zope.catalog.text import Lexicon
+        lexicon = Lexicon()
+        wids = lexicon.sourceToWordIds(['a', 'b'])
+        self.assertEqual(wids[1], wids[0] + 1)
+        self.assertTrue(0 < wids[0] < 2 ** 14)
+        lexicon._v_nextwid = wids[0]
+        wid = lexicon.sourceToWordIds(['c'])[0]
+        self.assertNotIn(wid, wids)
+        self.assertEqual(lexicon.wordCount(), 3)
+        self.assertEqual(lexicon.get_word(wid), 'c')
+
+    def test_okapi_postings(self):
+        from zope.catalog.text import Lexicon
+        from zope.catalog.text import OkapiIndex
+
+        # rare words keep their documents in dictionaries by default
+        index = OkapiIndex(Lexicon())
+        for docid in range(1, index.DICT_CUTOFF + 1):
+            index.index_doc(docid, ['a', 'b' if docid % 2 else 'c'])
+        index.index_doc(1, ['a', 'c'])
+        wordinfo = index._wordinfo
+        a, b, c = map(index._lexicon.get_wid, 'abc')
+        self.assertIsInstance(wordinfo[a], dict)
+        self.assertIsInstance(wordinfo[c], dict)
+        self.assertEqual(sorted(wordinfo[c]), [1, 2, 4, 6, 8, 10])
+        index.index_doc(11, ['a'])
+        self.assertIsInstance(wordinfo[a], BTrees.IFBTree.IFBTree)
+        self.assertEqual(len(index.search('a')), 11)
+        index.unindex_doc(1)
+        self.assertEqual(sorted(wordinfo[c]), [2, 4, 6, 8, 10])
+        self.assertEqual(len(wordinfo[b]), 4)
+        self.assertEqual(index.wordCount(), 3)
+
+        index = OkapiIndex(Lexicon())
+        index.word_trees = True
+        index.index_doc(1, ['a', 'b'])
+        index.index_doc(2, ['b', 'c'])
+        wid = index._lexicon.get_wid('a')
+        self.assertIsInstance(index._wordinfo[wid], BTrees.IFBTree.IFBTree)
+        # postings kept in dictionaries by the base class are converted
+        index._wordinfo[wid] = dict(index._wordinfo[wid])
+        index.index_doc(1, ['a', 'a', 'c'])
+        self.assertIsInstance(index._wordinfo[wid], BTrees.IFBTree.IFBTree)
+        self.assertEqual(sorted(index.search('c')), [1, 2])
+        self.assertEqual(index.wordCount(), 3)
+        index._wordinfo[wid] = dict(index._wordinfo[wid])
+        index.unindex_doc(1)
+        self.assertNotIn(wid, index._wordinfo)
+        index.unindex_doc(2)
+        self.assertEqual(index.wordCount(), 0)
+
+    def test_index_word_ids(self):
+        import zope.index.text.lexicon
+        import zope.index.text.okapiindex
+
+        from zope.catalog.text import Lexicon
+        from zope.catalog.text import OkapiIndex
+
+        def state(index):
+            words = index._lexicon.get_word
+            return ({words(wid): dict(docs)
+                     for wid, docs in index._wordinfo.items()},
+                    dict(index._docweight),
+                    {docid: [words(wid) for wid in index.get_words(docid)]
+                     for docid in index._docwords},
+                    index.documentCount(),
+                    index._totaldoclen())
+
+        # the same as indexing with the base class
+        for word_trees in (False, True):
+            index = OkapiIndex(Lexicon())
+            index.word_trees = word_trees
+            classic = zope.index.text.okapiindex.OkapiIndex(
+                zope.index.text.lexicon.Lexicon())
+            for docid, words in [(1, ['a', 'b', 'b']), (2, ['b', 'c']),
+                                 (1, ['b', 'c', 'c', 'd']), (2, ['b', 'c'])]:
+                wids = index._lexicon.wordIdsFor(words)
+                self.assertEqual(index.indexWordIds(docid, wids),
+                                 classic.index_doc(docid, words))
+                self.assertEqual(state(index), state(classic))
+
+    def _index(self, executor):
+        from zope.catalog.text import TextIndex
+        index = TextIndex('body', field_callable=False)
+        index.skip_unchanged = True
+        index.index_docs([(1, stoopid(body='The quick brown fox')),
+                          (2, stoopid(body='jumps over')),
+                          (3, stoopid(body='the lazy dog'))])
+        index.index_docs([(2, stoopid(body='jumps over')),
+                          (3, stoopid(body=['Lazy dogs', 'and foxes'])),
+                          (1, stoopid(body=None)),
+                          (4, stoopid(body='a quick, quick dog'))],
+                         executor)
+        return index
+
+    def _state(self, index):
+        return (sorted(index.lexicon.words()),
+                index.documentCount(),
+                index.skipped(),
+                {docid: [index.lexicon.get_word(wid)
+                         for wid in index.index.get_words(docid)]
+                 for docid in index.index._docwords},
+                dict(index.apply('quick OR dog')),
+                index.index._totaldoclen())
+
+    def test_index_docs_executor(self):
+        import concurrent.futures
+        expected = self._state(self._index(None))
+        self.assertEqual(expected[1], 3)
+        self.assertEqual(expected[2], 1)
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            self.assertEqual(self._state(self._index(executor)), expected)
+        with concurrent.futures.ProcessPoolExecutor(1) as executor:
+            self.assertEqual(self._state(self._index(executor)), expected)
+
+    def test_update_with_executor(self):
+        import concurrent.futures
+
+        from zope.catalog.text import TextIndex
+        catalog = Catalog()
+        catalog['body'] = TextIndex('body', field_callable=False)
+        catalog['title'] = FieldIndex('title')
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            catalog.index_docs([(1, stoopid(title='a', body='some text')),
+                                (2, stoopid(title='b', body='more text'))],
+                               executor)
+        self.assertEqual(sorted(catalog['body'].apply('text')), [1, 2])
+        self.assertEqual(catalog['title'].documentCount(), 2)
+
 
 class TestKeywordIndex(unittest.TestCase):
 
@@ -744,6 +3179,123 @@ class TestKeywordIndex(unittest.TestCase):
                 field_name='foo'))
 
 
+class TestWriteContention(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+
+        import ZODB
+        import ZODB.FileStorage
+
+        from zope.catalog.contention import createCatalog
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.db = ZODB.DB(ZODB.FileStorage.FileStorage(
+            os.path.join(tmp.name, 'Data.fs')))
+        self.addCleanup(self.db.close)
+        createCatalog(self.db, word_trees=True)
+
+    def _catalog(self):
+        with self.db.transaction() as conn:
+            catalog = conn.root()['catalog']
+            return (len(catalog._extent),
+                    catalog['title'].documentCount(),
+                    catalog['tags'].documentCount(),
+                    len(catalog['body'].apply('common')),
+                    catalog['body'].lexicon.wordCount())
+
+    def test_concurrent_documents(self):
+        # Transactions indexing different documents with the same
+        # field values, keywords and words, and new words, don't
+        # conflict.
+        import random
+
+        from zope.catalog.contention import Document
+        from zope.catalog.pending import ConflictError
+
+        # new words in different transactions get different ids
+        self.addCleanup(random.setstate, random.getstate())
+        random.seed(0)
+        managers = []
+        for docid in (101, 102, 103):
+            tm = transaction.TransactionManager()
+            managers.append(tm)
+            catalog = self.db.open(tm).root()['catalog']
+            catalog.index_doc(docid, Document(docid))
+        for tm in managers:
+            try:
+                tm.commit()
+            except ConflictError:  # pragma: no cover
+                self.fail('Indexing different documents conflicted')
+        self.assertEqual(self._catalog(), (23, 23, 23, 23, 25))
+
+        # neither does unindexing them
+        managers = []
+        for docid in (101, 102):
+            tm = transaction.TransactionManager()
+            managers.append(tm)
+            catalog = self.db.open(tm).root()['catalog']
+            catalog.unindex_doc(docid)
+        for tm in managers:
+            try:
+                tm.commit()
+            except ConflictError:  # pragma: no cover
+                self.fail('Unindexing different documents conflicted')
+        self.assertEqual(self._catalog(), (21, 21, 21, 21, 25))
+
+    def test_harness(self):
+        from zope.catalog.contention import Document
+        from zope.catalog.contention import writeContention
+
+        # writers indexing different documents with known words don't
+        # conflict; writers indexing the same document do
+        documents = [[[(docid, stoopid(title='title0', tags=['tag0'],
+                                       body='common text'))]]
+                     for docid in (101, 102, 103)]
+        conflicts, rate = writeContention(self.db, documents)
+        self.assertEqual(conflicts, 0)
+        self.assertGreater(rate, 0)
+        self.assertEqual(self._catalog(), (23, 23, 23, 23, 22))
+        with self.db.transaction() as conn:
+            index = conn.root()['catalog']['body'].index
+            index.unindex_doc(101)
+            # only the documents of the words change
+            self.assertFalse(index._wordinfo._p_changed)
+        documents = [[[(104, Document(docid))]] for docid in (104, 105)]
+        conflicts, rate = writeContention(self.db, documents)
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(self._catalog(), (24, 24, 24, 23, 24))
+
+    def test_harness_errors(self):
+        from zope.catalog.contention import Document
+        from zope.catalog.contention import writeContention
+
+        class Broken:
+            @property
+            def title(self):
+                raise ValueError('broken')
+
+        # the other writers don't wait for one that failed
+        documents = [[[(docid, Document(docid))]] for docid in (101, 102)]
+        documents.append([[(103, Broken())]])
+        with self.assertRaises(ValueError):
+            writeContention(self.db, documents, timeout=10)
+        self.assertEqual(self._catalog(), (20, 20, 20, 20, 22))
+
+    def test_main(self):
+        import contextlib
+        import io
+
+        from zope.catalog.contention import main
+        for options in ([], ['--classic'], ['--word-trees']):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                main(['--writers', '2', '--transactions', '2'] + options)
+            self.assertRegex(output.getvalue(),
+                             r'^\d+ conflicts in 4 transactions, ')
+
+
 # ------------------------------------------------------------------------
 # placeful setUp/tearDown
 def placefulSetUp(site=False):
@@ -839,6 +3391,8 @@ def test_suite():
         unittest.defaultTestLoader.loadTestsFromName(__name__),
         doctest.DocTestSuite('zope.catalog.attribute',
                              optionflags=doctest.ELLIPSIS),
+        doctest.DocTestSuite('zope.catalog.bulk'),
+        doctest.DocTestSuite('zope.catalog.query'),
     ))
 
     return suite
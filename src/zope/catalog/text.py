@@ -13,18 +13,43 @@
 ##############################################################################
 """Text catalog indexes
 """
+import functools
+import random
+
 import zope.container.contained
 import zope.index.text
 import zope.index.text.interfaces
+import zope.index.text.lexicon
+import zope.index.text.okapiindex
 import zope.interface
 from zope.i18nmessageid import ZopeMessageFactory as _
+from zope.index.text import widcode
+from zope.index.text.baseindex import inverse_doc_frequency
+from zope.index.text.lexicon import CaseNormalizer
+from zope.index.text.lexicon import Splitter
+from zope.index.text.lexicon import StopWordRemover
+from zope.index.text.queryparser import QueryParser
+from zope.index.text.setops import mass_weightedUnion
 
 import zope.catalog.attribute
 import zope.catalog.interfaces
 
 
+# How many texts are sent to a worker process at once.
+_SPLIT_CHUNK_SIZE = 64
+
+# Word ids can't have more than 28 bits, see zope.index.text.widcode.
+_MAX_WID = 2 ** 28
+
+# Word ids are picked among at least this many, which all have
+# encodings of at most two bytes.
+_MIN_WID_RANGE = 2 ** 14
+
+
 class ITextIndex(zope.catalog.interfaces.IAttributeIndex,
-                 zope.catalog.interfaces.ICatalogIndex):
+                 zope.catalog.interfaces.ICatalogIndex,
+                 zope.catalog.interfaces.IIndexEstimate,
+                 zope.catalog.interfaces.IRestrictedIndexSearch):
     """
     Interface-based catalog text index.
 
@@ -62,4 +87,320 @@ class ITextIndex(zope.catalog.interfaces.IAttributeIndex,
 class TextIndex(zope.catalog.attribute.AttributeIndex,
                 zope.index.text.TextIndex,
                 zope.container.contained.Contained):
-    """Default implementation of :class:`ITextIndex`."""
+    """Default implementation of :class:`ITextIndex`.
+
+    Unless a *lexicon* or an *index* is passed, the text is indexed by
+    an `OkapiIndex` with a `Lexicon` of this module. With the
+    ``word_trees`` of the index set, transactions indexing different
+    documents concurrently rarely conflict.
+    """
+
+    #: When restricted to candidate documents that are at most this
+    #: fraction of the documents containing a word, an Okapi index
+    #: scores the candidates by looking them up in the documents of
+    #: the word instead of scoring all of them.
+    restrict_scan_ratio = 0.1
+
+    def __init__(self, field_name=None, interface=None, field_callable=False,
+                 lexicon=None, index=None):
+        if index is None:
+            if lexicon is None:
+                lexicon = Lexicon(
+                    Splitter(), CaseNormalizer(), StopWordRemover())
+            index = OkapiIndex(lexicon)
+        super().__init__(field_name, interface, field_callable,
+                         lexicon, index)
+
+    def _emptyCopy(self):
+        # The copy gets a new lexicon with the same pipeline.
+        lexicon = type(self.lexicon)(*self.lexicon._pipeline)
+        index = type(self.index)(lexicon, self.index.family)
+        return super()._emptyCopy(lexicon, index)
+
+    def estimate(self, query):
+        """
+        Text queries are comparatively expensive to evaluate, so
+        they are assumed to match every indexed document. This makes
+        the catalog apply them last.
+        """
+        return self.documentCount()
+
+    def _indexValues(self, values, executor):
+        """
+        Index the ``(docid, text)`` pairs *values*.
+
+        With an *executor*, the texts are split and normalized by the
+        pipeline of the lexicon in it. Only looking up the ids of the
+        words and updating the index are left to this process. This
+        needs a `Lexicon` and an `OkapiIndex` of this module; other
+        indexes are indexed here completely.
+        """
+        lexicon = self.index._lexicon
+        pipeline = getattr(lexicon, '_pipeline', None)
+        if (executor is None or pipeline is None
+                or not hasattr(lexicon, 'wordIdsFor')
+                or not hasattr(self.index, 'indexWordIds')):
+            return super()._indexValues(values, executor)
+        changed = []
+        for docid, text in values:
+            if text is None:
+                self._indexValue(docid, text)
+                continue
+            fingerprint = self._fingerprintIfChanged(docid, text)
+            if fingerprint is not zope.catalog.attribute._UNCHANGED:
+                changed.append((docid, text, fingerprint))
+        splits = executor.map(functools.partial(_splitText, pipeline),
+                              [change[1] for change in changed],
+                              chunksize=_SPLIT_CHUNK_SIZE)
+        for (docid, text, fingerprint), words in zip(changed, splits):
+            self._changed()
+            self.index.indexWordIds(docid, lexicon.wordIdsFor(words))
+            self._setFingerprint(docid, fingerprint)
+
+    def apply(self, querytext, start=0, count=None, restrict_to=None):
+        """
+        Apply *querytext*, optionally restricted to the candidate
+        documents in *restrict_to*.
+
+        The restriction is applied to the result of each term of the
+        query, so the intersections and unions that combine the terms
+        only deal with candidate documents. See `restrict_scan_ratio`
+        for how Okapi indexes score the candidates.
+        """
+        if restrict_to is None:
+            return super().apply(querytext, start, count)
+        tree = QueryParser(self.lexicon).parseQuery(querytext)
+        results = tree.executeQuery(_RestrictedSearch(
+            self.index, restrict_to, self.restrict_scan_ratio))
+        if results:
+            qw = self.index.query_weight(tree.terms())
+            # Hack to avoid ZeroDivisionError
+            qw = float(qw or 1)
+            for docid, score in results.items():
+                try:
+                    results[docid] = score / qw
+                except TypeError:  # pragma: no cover
+                    # We overflowed the score, perhaps wildly unlikely.
+                    results[docid] = 2**64 // 10
+        return results
+
+
+class Lexicon(zope.index.text.lexicon.Lexicon):
+    """
+    A lexicon giving new words random ids.
+
+    The base class numbers words consecutively, so transactions adding
+    new words concurrently give them the same id, and always conflict.
+    Like :class:`zope.intid.IntIds`, this lexicon starts at a random id
+    in each transaction and counts up from there. The ids are picked
+    among four times as many as there are words, which keeps their
+    encodings short.
+    """
+
+    def _new_wid(self):
+        self.wordCount.change(1)
+        wid = getattr(self, '_v_nextwid', None)
+        while wid is None or wid >= _MAX_WID or wid in self._words:
+            wid = random.randrange(1, min(
+                _MAX_WID, max(_MIN_WID_RANGE, 4 * self.wordCount())))
+        self._v_nextwid = wid + 1
+        return wid
+
+    def wordIdsFor(self, words):
+        """
+        Return the ids of *words*, which went through the pipeline of
+        the lexicon already, giving new words new ids.
+        """
+        return [self._getWordIdCreate(word) for word in words]
+
+
+class OkapiIndex(zope.index.text.okapiindex.OkapiIndex):
+    """
+    An Okapi index that can keep the documents of each word in a BTree
+    of its own.
+
+    By default, like the base class, the documents of rare words are
+    kept in dictionaries stored in the buckets of the mapping from
+    words to documents, so that transactions indexing documents with
+    the same rare word conflict; set `word_trees` to avoid that.
+    Concurrent changes to BTrees usually can be resolved. Removing a
+    document from the BTree of a word doesn't store the BTree in the
+    mapping again.
+    """
+
+    #: If true, every word keeps its documents in a BTree, not only
+    #: the words of more than ``DICT_CUTOFF`` documents. This makes
+    #: fewer transactions conflict, but stores a persistent object for
+    #: each word. Words whose documents are kept in a dictionary
+    #: already get a BTree when a document is added to them.
+    word_trees = False
+
+    def index_doc(self, docid, text):
+        return self.indexWordIds(docid, self._lexicon.sourceToWordIds(text))
+
+    def indexWordIds(self, docid, wids):
+        """
+        Index the document *docid* with the ids *wids* of its words,
+        in order, and return their number.
+
+        Like `index_doc`, but the words were looked up in the lexicon
+        already, for instance with :meth:`Lexicon.wordIdsFor`.
+        """
+        if docid in self._docwords:
+            self._change_doc_len(-self._docweight[docid])
+            self._reindexWordIds(docid, wids)
+        else:
+            wid2weight, docweight = self._get_frequencies(wids)
+            self._mass_add_wordinfo(wid2weight, docid)
+            self._docweight[docid] = docweight
+            self._docwords[docid] = widcode.encode(wids)
+            self.documentCount.change(1)
+        self._change_doc_len(len(wids))
+        return len(wids)
+
+    def _reindexWordIds(self, docid, new_wids):
+        # Like the base class's _reindex_doc, only changes the
+        # documents of the words whose frequency changed.
+        old_wid2w, _ = self._get_frequencies(self.get_words(docid))
+        new_wid2w, new_docw = self._get_frequencies(new_wids)
+        for wid in old_wid2w.keys() - new_wid2w.keys():
+            self._del_wordinfo(wid, docid)
+        for wid, weight in new_wid2w.items():
+            if old_wid2w.get(wid) != weight:
+                self._add_wordinfo(wid, weight, docid)
+        self._docweight[docid] = new_docw
+        self._docwords[docid] = widcode.encode(new_wids)
+
+    def _postings(self, wid):
+        # The BTree of the documents of the word *wid* to their scores,
+        # created if needed, or None if they belong in a dictionary.
+        doc2score = self._wordinfo.get(wid)
+        if doc2score is None:
+            if not self.word_trees:
+                return None
+            doc2score = self._wordinfo[wid] = self.family.IF.BTree()
+            self.wordCount.change(1)
+        elif isinstance(doc2score, dict):
+            if not self.word_trees and len(doc2score) < self.DICT_CUTOFF:
+                return None
+            doc2score = self._wordinfo[wid] = self.family.IF.BTree(doc2score)
+        return doc2score
+
+    def _add_wordinfo(self, wid, f, docid):
+        doc2score = self._postings(wid)
+        if doc2score is None:
+            super()._add_wordinfo(wid, f, docid)
+        else:
+            doc2score[docid] = f
+
+    def _mass_add_wordinfo(self, wid2weight, docid):
+        for wid, weight in wid2weight.items():
+            self._add_wordinfo(wid, weight, docid)
+
+    def _del_wordinfo(self, wid, docid):
+        doc2score = self._wordinfo[wid]
+        if isinstance(doc2score, dict):
+            super()._del_wordinfo(wid, docid)
+            return
+        # unlike the base class, don't store the BTree in the mapping
+        # again, which changes the bucket holding it
+        del doc2score[docid]
+        if not doc2score:
+            del self._wordinfo[wid]
+            self.wordCount.change(-1)
+
+
+class _RestrictedSearch:
+    """
+    Wraps a :class:`zope.index.text.interfaces.IExtendedQuerying`
+    index, limiting the results of its searches to candidate documents.
+
+    Words and patterns searched in an Okapi index are scored by the
+    same formula as :meth:`OkapiIndex._search_wids`, but only for the
+    candidates if they are at most *scan_ratio* of the documents
+    containing a word.
+    """
+
+    def __init__(self, index, restrict_to, scan_ratio=0):
+        self.index = index
+        self.family = index.family
+        self.restrict_to = restrict_to
+        self.scan_ratio = scan_ratio
+        self.okapi = isinstance(index, zope.index.text.okapiindex.OkapiIndex)
+
+    def _restrict(self, result):
+        if result is None:
+            # all documents match
+            return None
+        # only keep the scores of the searched index
+        _, result = self.family.IF.weightedIntersection(
+            result, self.restrict_to, 1, 0)
+        return result
+
+    def search(self, term):
+        if not self.okapi:
+            return self._restrict(self.index.search(term))
+        wids = self.index._lexicon.termToWordIds(term)
+        if not wids:
+            return None
+        return self._searchWids(wids)
+
+    def search_glob(self, pattern):
+        if not self.okapi:
+            return self._restrict(self.index.search_glob(pattern))
+        return self._searchWids(self.index._lexicon.globToWordIds(pattern))
+
+    def search_phrase(self, phrase):
+        return self._restrict(self.index.search_phrase(phrase))
+
+    def _searchWids(self, wids):
+        index = self.index
+        wids = index._remove_oov_wids(wids)
+        if not wids:
+            return self.family.IF.Bucket()
+        candidates = self.restrict_to
+        docid2len = index._docweight
+        N = float(index.documentCount())
+        try:
+            meandoclen = index._totaldoclen() / N
+        except TypeError:  # pragma: no cover
+            # _totaldoclen has not yet been upgraded
+            meandoclen = index._totaldoclen / N
+        scores = []
+        for wid in wids:
+            d2f = index._wordinfo[wid]
+            idf = inverse_doc_frequency(len(d2f), N)
+            result = self.family.IF.Bucket()
+            if len(candidates) <= self.scan_ratio * len(d2f):
+                items = [(docid, d2f[docid])
+                         for docid in candidates if docid in d2f]
+                _okapiScore(index, result, items, docid2len, idf, meandoclen)
+            else:
+                _okapiScore(index, result, list(d2f.items()), docid2len, idf,
+                            meandoclen)
+                result = self._restrict(result)
+            scores.append((result, 1))
+        return mass_weightedUnion(scores, self.family)
+
+
+def _okapiScore(index, result, items, docid2len, idf, meandoclen):
+    # Scores the (docid, frequency) pairs *items* of a word into
+    # *result* like the C or Python version of OkapiIndex._search_wids.
+    if zope.index.text.okapiindex.score is not None:
+        zope.index.text.okapiindex.score(
+            result, items, docid2len, idf, meandoclen)
+        return
+    K1 = index.K1
+    B = index.B
+    for docid, f in items:
+        lenweight = 1.0 - B + B * docid2len[docid] / meandoclen
+        result[docid] = f * (K1 + 1.0) / (f + K1 * lenweight) * idf
+
+
+def _splitText(pipeline, text):
+    # Runs *text*, a string or a list of strings, through the pipeline
+    # of a lexicon.
+    words = [text] if isinstance(text, str) else text
+    for element in pipeline:
+        words = element.process(words)
+    return words